@@ -36,8 +36,6 @@ XXX Missing bug fixing, esp when a file fails to load
 XXX Missing command line options (debuglevel, openfromclipboard, etc)
 XXX Read/store settings with QSettings (Window position, MRU, zoom, fit mode, 
     slideshow timer interval, see saveGeometry, restoreGeometry)
-XXX Use numpy for image effects (gamma, auto-gamma, brightness, contrast, etc)
-    See https://note.nkmk.me/en/python-numpy-image-processing/
 XXX Take a look on whether logging needs %r because of unicode (print to non
     unicode consoles raises UnicodeEncodeError)
     See https://stackoverflow.com/questions/21129020/how-to-fix-unicodedecodeerror-ascii-codec-cant-decode-byte
@@ -45,15 +43,21 @@ XXX Take a look on whether logging needs %r because of unicode (print to non
     See https://stackoverflow.com/questions/5419/python-unicode-and-the-windows-console
 """
 
+import collections
 import datetime
+import hashlib
+import heapq
 import logging
+import mmap
 import multiprocessing
 import os
 import Queue as queue
 import re
 import stat
 import string
+import struct
 import sys
+import tempfile
 import threading
 import time
 
@@ -182,6 +186,264 @@ def os_path_safelong(filepath):
             
     return long_filepath
 
+# Filesystem types considered remote, see os_path_isremote. "smb" is used for
+# Windows network shares and mapped network drives
+network_fstypes = set([
+    "smb", "cifs", "smbfs", "smb3", "nfs", "nfs4", "9p", "davfs", "fuse.sshfs", 
+    "fuse.gvfsd-fuse", "fuse.rclone"
+])
+g_mounts = None
+g_mounts_lock = threading.Lock()
+def os_path_mount(path):
+    """
+    @return (mountpoint, fstype) tuple of the filesystem path lives in. On
+            Windows, mountpoint is the drive or the \\host\share\ pair and
+            fstype is "smb" for network shares and mapped network drives and
+            "local" otherwise.
+    """
+    global g_mounts
+    abspath = os_path_abspath(path)
+
+    if (sys.platform.startswith("win")):
+        if (abspath.startswith(r"\\")):
+            # \\host\share\dir1 splits into ['', '', 'host', 'share', 'dir1']
+            names = abspath.split(os.sep)
+            mountpoint = os.sep.join(names[:4]) + os.sep
+            return mountpoint, "smb"
+
+        mountpoint = os.path.splitdrive(abspath)[0] + os.sep
+        fstype = "local"
+        try:
+            import ctypes
+            DRIVE_REMOTE = 4
+            if (ctypes.windll.kernel32.GetDriveTypeW(unicode(mountpoint)) == DRIVE_REMOTE):
+                fstype = "smb"
+        except:
+            exc("Unable to get drive type for %r", mountpoint)
+
+        return mountpoint, fstype
+
+    with g_mounts_lock:
+        if (g_mounts is None):
+            # XXX This is never refreshed, mounts done after starting the app
+            #     will be reported as belonging to the parent mount
+            g_mounts = []
+            try:
+                with open("/proc/mounts", "r") as f:
+                    for line in f:
+                        fields = line.split()
+                        # Spaces and other characters are octal escaped, eg \040
+                        mountpoint = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1])
+                        g_mounts.append((mountpoint, fields[2]))
+
+            except (IOError, OSError, IndexError):
+                # Not Linux or no procfs, assume everything is local
+                warn("Unable to read mounts")
+
+            # Sort by decreasing length so the first prefix match is the
+            # deepest mountpoint
+            g_mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+            info("Found mounts %r", g_mounts)
+
+    for mountpoint, fstype in g_mounts:
+        if ((abspath == mountpoint) or 
+            abspath.startswith(mountpoint if mountpoint.endswith(os.sep) else mountpoint + os.sep)):
+            return mountpoint, fstype
+
+    return os.sep, "local"
+
+
+def os_path_isremote(path):
+    mountpoint, fstype = os_path_mount(path)
+    return (fstype in network_fstypes)
+
+
+def os_listdir_types(dirpath):
+    """
+    Same as os.listdir but also telling directories apart without a stat per
+    entry where possible, using the entry type returned by the directory read
+    itself (d_type on Linux, the FindFirstFile attributes on Windows) via
+    os.scandir on Python 3 or the scandir package on Python 2.
+
+    Note scandir still needs a stat for entries with unknown d_type and for
+    symlinks, but those are a minority.
+
+    @return (names, is_dirs, filestats) where is_dirs is a dict of name ->
+            bool and filestats a dict of name -> stat, with the entries
+            known without extra round trips. Both are empty if scandir is not
+            available.
+    @raise OSError if dirpath cannot be listed
+    """
+    try:
+        try:
+            from os import scandir
+        except ImportError:
+            from scandir import scandir
+
+    except ImportError:
+        info("Can't import scandir, directories will need a stat per entry")
+        return os.listdir(dirpath), {}, {}
+
+    names = []
+    is_dirs = {}
+    filestats = {}
+    for entry in scandir(dirpath):
+        names.append(entry.name)
+        try:
+            is_dirs[entry.name] = entry.is_dir()
+            if (sys.platform.startswith("win")):
+                # On Windows the stat comes for free with the directory read,
+                # except for st_ino, st_dev and st_nlink which are not used
+                filestats[entry.name] = entry.stat()
+
+        except OSError as e:
+            # Leave it to the caller to stat it
+            exc("Unable to get the type of %r", entry.path)
+
+    return names, is_dirs, filestats
+
+
+# Filter parameters are (gamma, brightness, contrast, levels) with levels the
+# (black, white) input levels of the red, green and blue channels, see
+# qFilterImage
+FILTER_IDENTITY = (1.0, 0.0, 1.0, ((0, 255), (0, 255), (0, 255)))
+
+g_filter_luts = {}
+g_filter_luts_lock = threading.Lock()
+def get_filter_lut(params):
+    """
+    @return numpy 3x256 array with the red, green and blue lookup tables for
+            the filter params, see FILTER_IDENTITY
+    """
+    import numpy as np
+    with g_filter_luts_lock:
+        lut = g_filter_luts.get(params)
+    if (lut is not None):
+        return lut
+
+    gamma, brightness, contrast, levels = params
+    x = np.arange(256, dtype=np.float64)
+    luts = []
+    for black, white in levels:
+        y = np.clip((x - black) / max(white - black, 1), 0.0, 1.0)
+        y = np.clip((y - 0.5) * contrast + 0.5 + brightness, 0.0, 1.0)
+        y = y ** (1.0 / gamma)
+        luts.append(np.round(y * 255.0).astype(np.uint8))
+    lut = np.array(luts)
+
+    with g_filter_luts_lock:
+        # The parameters change in small steps, no need for an LRU
+        if (len(g_filter_luts) >= 64):
+            g_filter_luts.clear()
+        g_filter_luts[params] = lut
+
+    return lut
+
+def compute_auto_levels(image):
+    """
+    See https://stackoverflow.com/questions/61695773/how-to-set-the-best-value-for-gamma-correction
+
+    @param image QImage in any format
+    @return (gamma, levels) that stretch each channel to the full range and
+            bring the mean luminance to the middle, see FILTER_IDENTITY
+    """
+    import numpy as np
+
+    # The histogram of a small downsample is as good and costs the same
+    # regardless of the image resolution. The downsample keeps the format, 
+    # which can be the screen format for images from QPixmap.toImage (eg
+    # RGB16), convert it to 32-bit non premultiplied colors
+    image = image.scaled(auto_levels_sample_px, auto_levels_sample_px, 
+        Qt.KeepAspectRatio, Qt.FastTransformation)
+    has_alpha = image.hasAlphaChannel()
+    image = image.convertToFormat(QImage.Format_ARGB32 if (has_alpha) else QImage.Format_RGB32)
+    width = image.width()
+    height = image.height()
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    pixels = np.ndarray((height, width, 4), np.uint8, ptr, strides=(image.bytesPerLine(), 4, 1))
+    offsets = (2, 1, 0) if (sys.byteorder == "little") else (1, 2, 3)
+    alpha_offset = 3 if (sys.byteorder == "little") else 0
+
+    # Leave the transparent pixels out, their color is meaningless
+    if (has_alpha):
+        pixels = pixels[pixels[:, :, alpha_offset] != 0]
+    else:
+        pixels = pixels.reshape(-1, 4)
+
+    count = len(pixels)
+    if (count == 0):
+        return (1.0, FILTER_IDENTITY[3])
+    clip = count * auto_levels_clip
+    levels = []
+    for offset in offsets:
+        histogram = np.bincount(pixels[:, offset], minlength=256)
+        cumulative = np.cumsum(histogram)
+        black = int(np.searchsorted(cumulative, clip, side="right"))
+        white = int(np.searchsorted(cumulative, count - clip))
+        if (white <= black):
+            # Flat channel, don't stretch
+            black, white = 0, 255
+        levels.append((black, white))
+    levels = tuple(levels)
+
+    # Mean luminance after applying the levels, using Rec. 601 weights
+    lut = get_filter_lut((1.0, 0.0, 1.0, levels))
+    mean = 0.0
+    for weight, lut_channel, offset in zip((0.299, 0.587, 0.114), lut, offsets):
+        mean += weight * lut_channel[pixels[:, offset]].mean()
+    mean /= 255.0
+
+    gamma = 1.0
+    if (0.0 < mean < 1.0):
+        # mean ** (1 / gamma) = 0.5
+        gamma = max(auto_gamma_min, min(auto_gamma_max, np.log(mean) / np.log(0.5)))
+
+    return (round(float(gamma), 2), levels)
+
+def qFilterImage(image, params):
+    """
+    @param image QImage in any format, RGB32 or ARGB32_Premultiplied don't
+           need a conversion, see qReadImage
+    @return filtered copy of image in the same format or image if numpy is
+            not installed
+    """
+    try:
+        import numpy as np
+
+    except ImportError:
+        warn("Can't import numpy, image won't be filtered")
+        return image
+
+    lut = get_filter_lut(params)
+    image_format = image.format()
+    # The lookup tables need to be applied to 8-bit non premultiplied colors,
+    # images from QPixmap.toImage come in the screen format (eg RGB16 or
+    # RGB30), convert them too. The conversion is also the copy
+    if (image.hasAlphaChannel()):
+        image = image.convertToFormat(QImage.Format_ARGB32)
+    elif (image_format == QImage.Format_RGB32):
+        image = image.copy()
+    else:
+        image = image.convertToFormat(QImage.Format_RGB32)
+
+    width = image.width()
+    height = image.height()
+    ptr = image.bits()
+    ptr.setsize(image.byteCount())
+    # 32-bit pixels are 0xAARRGGBB, view them as bytes respecting the line
+    # padding
+    pixels = np.ndarray((height, width, 4), np.uint8, ptr, strides=(image.bytesPerLine(), 4, 1))
+    offsets = (2, 1, 0) if (sys.byteorder == "little") else (1, 2, 3)
+    for lut_channel, offset in zip(lut, offsets):
+        pixels[:, :, offset] = lut_channel[pixels[:, :, offset]]
+
+    if (image.format() != image_format):
+        image = image.convertToFormat(image_format)
+
+    return image
+
+
 g_image_reader_lock = threading.Lock()
 def qThreadSafeImageReader(buffer):
     """
@@ -300,6 +562,216 @@ def qThreadSafeImageReader(buffer):
         reader.safe_buffer = buffer
     return reader
 
+def qReadImage(reader, scale):
+    """
+    @param scale QSize to fit the image to or None to read it at the reader's
+           scaled size, if any
+    @return (image, size) with the image read in the display format, null on
+            error, and the full size from the header, invalid for some formats
+    """
+    # Note the size is the full size even if the reader has a scaled size
+    size = reader.size()
+    if (scale is not None):
+        # Have the decoder produce a reduced image directly instead of
+        # decoding at full resolution and scaling down (eg JPEG DCT scaling
+        # decodes at 1/2, 1/4 or 1/8 for a fraction of the cost). Decode
+        # somewhat larger than needed so the final smooth scaling below still
+        # has enough detail to antialias
+        decode_size = size.scaled(scale * thumbnail_decode_oversample, Qt.KeepAspectRatio)
+        if (size.isValid() and (decode_size.width() < size.width())):
+            info("Decoding at %dx%d instead of %dx%d", decode_size.width(), 
+                decode_size.height(), size.width(), size.height())
+            reader.setScaledSize(decode_size)
+
+    image = reader.read()
+    if (image.isNull()):
+        return image, size
+
+    if (scale is not None):
+        image = image.scaled(scale, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    # Convert to the formats the pixmap can be created from without a
+    # conversion in the GUI thread
+    image_format = QImage.Format_ARGB32_Premultiplied if (image.hasAlphaChannel()) else QImage.Format_RGB32
+    if (image.format() != image_format):
+        image = image.convertToFormat(image_format)
+
+    return image, size
+
+
+# Process pool for decoding, see use_process_decode. None decodes in the
+# PixmapReader threads
+g_decoder_pool = None
+def decode_in_process(file_data, filepath, scale, shm_dirpath):
+    """
+    Decode file_data in a g_decoder_pool process into a shared memory file so
+    the pixels are not pickled back, see PixmapReader.decodeInProcess
+
+    @param file_data file contents or None to read the file at filepath
+    @param scale (width, height) to fit the image to or None
+    @param shm_dirpath directory for the shared memory file or None
+    @return (shm_filepath, width, height, bytes_per_line, format, (full_width,
+            full_height)) or None if the image couldn't be decoded. The caller
+            owns the file
+    """
+    if (shm_dirpath is None):
+        shm_dirpath = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    # No need for qThreadSafeImageReader, this process is single threaded
+    if (file_data is None):
+        reader = QImageReader(filepath)
+    else:
+        buffer = QBuffer()
+        buffer.setData(file_data)
+        reader = QImageReader(buffer)
+    image, size = qReadImage(reader, None if (scale is None) else QSize(*scale))
+    if (image.isNull()):
+        warn("Unable to decode in process: %s", reader.errorString())
+        return None
+
+    fd, shm_filepath = tempfile.mkstemp(prefix="imageviewer", dir=shm_dirpath)
+    with os.fdopen(fd, "wb") as f:
+        f.write(image.constBits().asstring(image.byteCount()))
+
+    return (shm_filepath, image.width(), image.height(), image.bytesPerLine(), 
+        int(image.format()), (size.width(), size.height()))
+
+def close_image_mapping(image):
+    """
+    Unmap the shared memory pixels of an image decoded in process, see
+    PixmapReader.decodeInProcess. The image can't be used after this, it's
+    for the last user of the image once it's done with it (eg after
+    QPixmap.fromImage). Images that are not closed are unmapped when garbage
+    collected
+    """
+    mapping = getattr(image, "shm_mapping", None)
+    if (mapping is not None):
+        image.shm_mapping = None
+        mapping.close()
+
+
+class SharedMapping(mmap.mmap):
+    """
+    Read-only file mapping that is unmapped as soon as it's no longer in the
+    file cache nor used, instead of whenever it's garbage collected. This keeps
+    the address space in use bounded by the file cache budget and reduces the
+    window for SIGBUS when a mapped file is truncated on disk.
+
+    The file cache owns the mapping until it removes it, see uncache. Other
+    users (queued decodes, tiled images and animation readers) hold it with
+    acquire and release, which can be called from any thread, see
+    acquire_file_data and release_file_data. Readers over the mapping (see
+    MmapDevice) are covered by the use they are created for, or are
+    temporary in the GUI thread while the mapping is cached.
+    """
+    def __init__(self, *args, **kwargs):
+        # mmap.mmap is initialized in __new__
+        self.use_lock = threading.Lock()
+        self.use_count = 0
+        self.cached = True
+        self.unmapped = False
+
+    def closeIfUnused(self):
+        """
+        Must be called with the lock held
+        """
+        if ((not self.cached) and (self.use_count == 0) and (not self.unmapped)):
+            info("Unmapping %d bytes", len(self))
+            self.unmapped = True
+            self.close()
+
+    def acquire(self):
+        """
+        @return True if acquired, False if it was already unmapped
+        """
+        with self.use_lock:
+            if (self.unmapped):
+                return False
+            self.use_count += 1
+            return True
+
+    def release(self):
+        with self.use_lock:
+            self.use_count -= 1
+            self.closeIfUnused()
+
+    def uncache(self):
+        with self.use_lock:
+            self.cached = False
+            self.closeIfUnused()
+
+def acquire_file_data(file_data):
+    """
+    @param file_data file contents as a string, a SharedMapping or None
+    @return True if file_data can be used until released, False if it was
+            already unmapped
+    """
+    if (isinstance(file_data, SharedMapping)):
+        return file_data.acquire()
+    return True
+
+def release_file_data(file_data):
+    if (isinstance(file_data, SharedMapping)):
+        file_data.release()
+
+def uncache_file_data(file_data):
+    """
+    Drop the file cache ownership of file_data, see SharedMapping
+    """
+    if (isinstance(file_data, SharedMapping)):
+        file_data.uncache()
+
+
+class MmapDevice(QIODevice):
+    """
+    Read-only QIODevice over a memory mapped file, this allows QImageReader to
+    read straight from the mapped pages without copying the whole file into a
+    Python string and then again into a QBuffer.
+
+    Note readData still copies each chunk requested by the image handler, but
+    those are small compared to the file.
+    """
+    def __init__(self, mapping):
+        super(MmapDevice, self).__init__()
+        self.mapping = mapping
+        self.offset = 0
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+
+    def isSequential(self):
+        return False
+
+    def size(self):
+        return len(self.mapping)
+
+    def seek(self, pos):
+        if ((pos < 0) or (pos > len(self.mapping))):
+            return False
+        self.offset = pos
+        return super(MmapDevice, self).seek(pos)
+
+    def bytesAvailable(self):
+        return (len(self.mapping) - self.offset) + super(MmapDevice, self).bytesAvailable()
+
+    def readData(self, maxlen):
+        data = self.mapping[self.offset:self.offset + maxlen]
+        self.offset += len(data)
+        return data
+
+    def writeData(self, data):
+        return -1
+
+
+def qImageDevice(file_data):
+    """
+    @param file_data file contents as a string or as an mmap
+    @return QIODevice to read file_data from
+    """
+    if (isinstance(file_data, mmap.mmap)):
+        return MmapDevice(file_data)
+
+    buffer = QBuffer()
+    buffer.setData(file_data)
+    return buffer
+
+
 # XXX Support animations via QMovie of a local temp file or QImageReader of
 #     QBuffer/QIODevice of a python buffer in the file cache, to avoid PyQt
 #     locking the UI thread
@@ -339,19 +811,126 @@ slideshow_interval_ms = 5000
 #     between frames)?
 animation_interval_ms = 50
 most_recently_used_max_count = 10
-stat_timeout_secs = 0.25
+# Directories are listed by DirLister threads and the names are added to the
+# FileDialog in batches of this size
+dir_lister_count = 4
+dir_listing_batch_size = 500
+# Number of directories in the shared listing cache, see DirListingCache
+dir_listing_cache_max_count = 16
 # QApplication.keyboardInputInterval() is 400ms, which is too short
 listview_keyboard_search_timeout_secs = 0.75
 # XXX Have a config to disable placeholders to prevent flashing when browsing?
 use_image_placeholders = False
 use_thumbnail_placeholders = True
+# Byte budget for the file data cache, on top of the entry count limit
+# XXX Make this depend on the available physical memory?
+cached_files_max_bytes = 128 * 2 ** 20
+# Thumbnails are decoded to fit this size
+# XXX Use screen DPI to calculate the best thumbnail size?
+thumbnail_size_px = 150
+# Thumbnails are decoded at this factor of the thumbnail size and then
+# smoothly scaled down, see PixmapReader. 1.0 decodes at the final size
+thumbnail_decode_oversample = 2.0
+# Decode main images larger than the image widget at the widget size times
+# the headroom instead of at full resolution, the full resolution is decoded
+# when more pixels are needed, see ImageViewer.checkDecodeSize
+use_screen_resolution_decode = True
+screen_decode_headroom = 1.25
+# Display images with the EXIF orientation applied, see parse_exif
+use_exif_orientation = True
+# Render main images of at least tiled_min_pixels from tiles decoded on demand
+# instead of decoding them at full resolution when the screen resolution pixmap
+# doesn't have enough pixels, see TiledImage. Only used for formats that can
+# decode clip rects
+use_tiled_rendering = True
+tiled_min_pixels = 64 * 2 ** 20
+tile_size_px = 512
+tile_cache_max_count = 256
+tile_cache_max_bytes = 128 * 2 ** 20
+# Resizes of the main image scale from the nearest power of two downscale
+# larger than the target, built in the background once per image, see
+# PyramidBuilder. Levels smaller than the min size are not built
+use_pyramids = True
+pyramid_min_size_px = 256
+pyramid_cache_max_bytes = 64 * 2 ** 20
+# Decode requests without a reader (thumbnails) in a pool of processes instead
+# of in the PixmapReader threads, see decode_in_process. None process count
+# uses one per CPU, None shared memory dirpath uses /dev/shm if available or
+# the temp directory otherwise
+use_process_decode = False
+decoder_process_count = None
+decoder_shm_dirpath = None
+# Brightness and contrast increments of the filter actions and byte budget for
+# the filtered main images, see qFilterImage
+filter_brightness_step = 0.05
+filter_contrast_step = 0.1
+filtered_images_max_bytes = 64 * 2 ** 20
+# Auto levels clip this fraction of the darkest and brightest values of each
+# channel and clamp the auto gamma to the given range. They are computed on a
+# downsample of at most auto_levels_sample_px per side and cached per file, see
+# compute_auto_levels
+auto_levels_clip = 0.005
+auto_gamma_min = 0.5
+auto_gamma_max = 2.5
+auto_levels_sample_px = 256
+auto_levels_max_count = 4096
+# Persistent thumbnail store, see ThumbnailStoreWorker
+use_thumbnail_store = True
+thumbnail_store_max_bytes = 256 * 2 ** 20
+# Files are fetched in chunks of this size so fetches can be cancelled and
+# report progress
+fetch_chunk_size = 256 * 1024
+fetch_progress_interval_secs = 0.25
+# Number of concurrent FileFetchers, adapted between min and max counts
+# to maximize bandwidth, see FetcherPool
+fetcher_min_count = 1
+fetcher_max_count = 8
+fetcher_initial_count = 2
+# Fetcher busy time to measure before adapting the concurrency, and bandwidth
+# gain needed to keep changing the concurrency in the same direction
+fetcher_pool_window_secs = 2.0
+fetcher_pool_min_gain = 0.05
+# Requests are routed to a lane of fetchers per mount point, see FetcherLanes
+remote_fetcher_max_count = 4
+# Fetches without progress for this long are abandoned and failed, network
+# mounts hang more often and are abandoned earlier
+fetch_timeout_secs = 30
+remote_fetch_timeout_secs = 20
+# Abandoned fetchers still blocked on a read, per lane, that are replaced. Past
+# this, the lane runs with fewer fetchers until the blocked reads return
+abandoned_fetcher_max_count = 8
+# Show partially fetched main images larger than stream_min_bytes while they
+# are still being fetched, see FileFetcher.stream_filepath
+use_progressive_display = True
+stream_min_bytes = 1 * 2 ** 20
+stream_interval_secs = 0.5
+# Each partial emitted needs at least this factor of the previous partial's
+# bytes, this bounds the total copied for partials to a few times the file size
+stream_growth_factor = 1.5
+# Header bytes read by FileProber, EXIF is normally in the first 64KB
+probe_size_bytes = 64 * 1024
+# Probers per mount point, so a hung share doesn't block probing other mounts
+prober_count = 2
+probed_files_max_count = 4096
+# Memory map local files instead of reading them, see FileFetcher.mapFile
+use_mmap_local_files = True
+mmap_fstypes = set(["nfs", "nfs4"])
+# Local disk copy of recently viewed remote files, see FileFetcher. None
+# dirpath uses the generic cache location
+use_local_proxy_cache = False
+local_proxy_cache_dirpath = None
+local_proxy_cache_max_bytes = 2 * 2 ** 30
+# Decoded image cache for instant back/forward browsing, holds the current
+# image and the decoded neighbours
+decoded_images_neighbour_count = 1
+decoded_images_max_count = decoded_images_neighbour_count * 2 + 2
+decoded_images_max_bytes = 96 * 2 ** 20
+# Files tracked by PipelineStates
+pipeline_states_max_count = 4096
 
 
 # queue is an old style class, inherit from object to make newstyle
-# XXX Use PriorityQueue? Would allow two priorities one for thumbs and another
-#     for main image, or even rolling priorities where stale images (thumbs,
-#     main) are left with lower prio. Currently this is done by emptying the
-#     queue on nagivating away from the image
+# Note requests that need priorities use PriorityScheduler instead
 class Queue(queue.Queue, object):
     """
     Queue with a clear method to flush/drain the queue
@@ -361,30 +940,6 @@ class Queue(queue.Queue, object):
         # queue is
         queue.Queue.__init__(self, *args, **kwargs)
 
-    def move_to_front(self, item):
-        # This assumes the item was in the queue at some point, but will only 
-        # be re-inserted if found while traversing, since it's possible the item
-        # was removed from a different thread while traversing
-        info("move_to_front %r", item)
-        entries = []
-        found = False
-        try:
-            while (True):
-                entry = self.get_nowait()
-                if (entry != item):
-                    entries.append(entry)
-                else:
-                    found = True
-        except queue.Empty:
-            pass
-
-        if (found):
-            self.put(item)
-
-        info("move_to_front restoring %d entries", len(entries))
-        for entry in entries:
-            self.put(entry)
-
     def clear(self):
         """
         Clear the queue.
@@ -410,29 +965,668 @@ class Queue(queue.Queue, object):
         return entries
 
 
+# Priority classes for PriorityScheduler, lower is serviced first. Requests of
+# the same class are serviced in request order
+PRIORITY_MAIN = 0
+PRIORITY_VISIBLE = 1
+PRIORITY_NEXT_PAGE = 2
+PRIORITY_PREFETCH = 3
+# Requests left over from a previous navigation, see PriorityScheduler.demote
+PRIORITY_STALE = 4
+
+class PriorityScheduler(object):
+    """
+    Thread-safe priority queue of requests with get() compatible with Queue so
+    it can feed the worker threads.
+
+    Requests are identified by a key (the item itself by default) and can be
+    promoted or cancelled by key in O(log n). This is done with lazy deletion:
+    the heap entry is marked invalid and skipped at get time. Requests are only
+    lowered in priority in bulk, see demote.
+
+    None items are worker sentinels, they are not keyed and are serviced before
+    any other request.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Heap of [priority, seq, key, item, valid] lists, seq breaks ties so
+        # keys and items are never compared
+        self.heap = []
+        # key -> heap entry for the valid entries
+        self.entries = {}
+        self.seq = 0
+
+    def push(self, priority, key, item):
+        """
+        Must be called with the lock held
+        """
+        entry = [priority, self.seq, key, item, True]
+        self.seq += 1
+        heapq.heappush(self.heap, entry)
+        if (key is not None):
+            self.entries[key] = entry
+        
+        # Compact if the invalid entries dominate
+        if (len(self.heap) > 2 * len(self.entries) + 64):
+            self.heap = [e for e in self.heap if e[4]]
+            heapq.heapify(self.heap)
+
+        self.condition.notify()
+
+    def put(self, item, priority=PRIORITY_PREFETCH, key=None):
+        """
+        Queue the item with the given priority, if there's already a request
+        with the same key the item is replaced and the request keeps the
+        highest of both priorities
+
+        @return the replaced item or None
+        """
+        with self.condition:
+            if (item is None):
+                self.push(-1, None, None)
+                return None
+
+            if (key is None):
+                key = item
+            entry = self.entries.get(key, None)
+            replaced = None
+            if (entry is not None):
+                replaced = entry[3]
+                if (entry[0] <= priority):
+                    entry[3] = item
+                    return replaced
+                entry[4] = False
+
+            self.push(priority, key, item)
+            return replaced
+
+    def get(self):
+        """
+        Block until there's a request and return the item of the highest
+        priority one
+        """
+        with self.condition:
+            while (True):
+                while (len(self.heap) == 0):
+                    self.condition.wait()
+                priority, seq, key, item, valid = heapq.heappop(self.heap)
+                if (valid):
+                    if (key is not None):
+                        del self.entries[key]
+                    return item
+
+    def promote(self, key, priority):
+        """
+        Raise the priority of the request, if lower than priority
+
+        @return True if the request was queued, False if not queued
+        """
+        with self.condition:
+            entry = self.entries.get(key, None)
+            if (entry is None):
+                return False
+            if (entry[0] > priority):
+                entry[4] = False
+                self.push(priority, key, entry[3])
+            return True
+
+    def cancel(self, key):
+        """
+        @return the item of the cancelled request or None if not queued
+        """
+        with self.condition:
+            entry = self.entries.pop(key, None)
+            if (entry is None):
+                return None
+            entry[4] = False
+            return entry[3]
+
+    def demote(self, priority=PRIORITY_STALE):
+        """
+        Demote all the requests to priority and cancel the ones that were
+        already at that priority or lower.
+
+        This is called when navigating, the requests that are still wanted will
+        be promoted by the caller, the ones that were stale and are still
+        not wanted after another navigation are dropped.
+
+        @return list of items of the cancelled requests
+        """
+        with self.condition:
+            cancelled = []
+            for key, entry in self.entries.items():
+                if (entry[0] >= priority):
+                    cancelled.append(entry[3])
+                    entry[4] = False
+                    del self.entries[key]
+                else:
+                    # Changing the priority in place breaks the heap invariant,
+                    # heapify below
+                    entry[0] = priority
+            self.heap = [e for e in self.heap if e[4]]
+            heapq.heapify(self.heap)
+            info("demoted %d requests, cancelled %d", len(self.entries), len(cancelled))
+
+            return cancelled
+
+    def clear(self):
+        """
+        @return list of items of the cleared requests, in priority order
+        """
+        with self.condition:
+            items = [e[3] for e in sorted(self.heap) if (e[4] and (e[2] is not None))]
+            self.heap = []
+            self.entries = {}
+            info("PriorityScheduler.clear %d requests", len(items))
+
+            return items
+
+    def qsize(self):
+        with self.condition:
+            return len(self.entries)
+
+    def __contains__(self, key):
+        with self.condition:
+            return key in self.entries
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with O(1) lookup, touch and eviction, bounded
+    both by entry count and by byte size.
+
+    The most recently used entry is the last one in the underlying
+    OrderedDict, eviction pops from the front.
+
+    Also keeps running hit/miss/eviction counters for diagnostics.
+
+    XXX This is not thread-safe, it's expected to be accessed only from the GUI
+        thread
+    """
+    def __init__(self, max_count=None, max_bytes=None, sizeof=None, evicted=None):
+        """
+        @param max_count maximum number of entries or None for no limit
+        @param max_bytes maximum sum of entry sizes or None for no limit
+        @param sizeof function returning the size in bytes of a value, called
+               once at insertion time. None to count each entry as zero bytes
+        @param evicted function(key, value) called after evicting an entry to
+               make room, not called for removed or replaced entries
+        """
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.evicted = evicted
+
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        """
+        Check if the key is in the cache without touching the LRU order nor the
+        hit/miss counters
+        """
+        return key in self.entries
+
+    def keys(self):
+        return self.entries.keys()
+
+    def peek(self, key, default=None):
+        """
+        Get the value without touching the LRU order nor the hit/miss counters
+        """
+        entry = self.entries.get(key, None)
+        return default if (entry is None) else entry[0]
+
+    def get(self, key, default=None):
+        """
+        Get the value and make it the most recently used
+
+        @return the value or default if not in the cache
+        """
+        # Python 2.7 OrderedDict has no move_to_end, popping and reinserting is
+        # also O(1)
+        entry = self.entries.pop(key, None)
+        if (entry is None):
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value):
+        """
+        Insert or replace the value as the most recently used entry, evicting
+        least recently used entries as necessary
+
+        Note the entry being inserted is never evicted, even if it's larger than
+        max_bytes on its own, so the caller can always retrieve what was just
+        inserted.
+        """
+        self.remove(key)
+
+        size = 0 if (self.sizeof is None) else self.sizeof(value)
+        self.entries[key] = (value, size)
+        self.bytes += size
+
+        while ((len(self.entries) > 1) and (
+            ((self.max_count is not None) and (len(self.entries) > self.max_count)) or
+            ((self.max_bytes is not None) and (self.bytes > self.max_bytes))
+            )):
+            evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+            info("evicting %r %d bytes for %r", evicted_key, evicted_size, key)
+            if (self.evicted is not None):
+                self.evicted(evicted_key, evicted_value)
+
+    def remove(self, key):
+        """
+        @return the removed value or None if not in the cache
+        """
+        entry = self.entries.pop(key, None)
+        if (entry is None):
+            return None
+
+        value, size = entry
+        self.bytes -= size
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+# Per file pipeline states, see PipelineStates
+FILE_STATE_QUEUED = 0
+FILE_STATE_FETCHING = 1
+FILE_STATE_FETCHED = 2
+FILE_STATE_DECODE_QUEUED = 3
+FILE_STATE_DECODING = 4
+FILE_STATE_DECODED = 5
+FILE_STATE_FAILED = 6
+
+class PipelineStates(QObject):
+    """
+    Thread-safe registry of the fetch and decode pipeline state of each file,
+    updated by the GUI thread when queueing and by the workers when servicing.
+
+    Changed filepaths are accumulated in a dirty set and stateChanged is
+    emitted when the set goes from empty to non-empty, so the GUI thread only
+    needs to update the widgets for the filepaths returned by takeDirty
+    instead of scanning the queues.
+
+    Entries are kept in an LRU so the registry doesn't grow with every file
+    browsed, evicted entries are treated as unknown state.
+    """
+    stateChanged = pyqtSignal()
+
+    def __init__(self, max_count):
+        super(PipelineStates, self).__init__()
+        self.lock = threading.Lock()
+        self.states = LRUCache(max_count)
+        self.dirty = set()
+
+    def set(self, filepath, state):
+        with self.lock:
+            if (self.states.peek(filepath) == state):
+                return
+            self.states.put(filepath, state)
+            notify = (len(self.dirty) == 0)
+            self.dirty.add(filepath)
+
+        # Emit outside of the lock, note the emit is queued to the GUI thread
+        # when called from the workers
+        if (notify):
+            self.stateChanged.emit()
+
+    def get(self, filepath):
+        """
+        @return the state of filepath or None if unknown
+        """
+        with self.lock:
+            return self.states.peek(filepath)
+
+    def remove(self, filepath):
+        with self.lock:
+            if (self.states.remove(filepath) is None):
+                return
+            notify = (len(self.dirty) == 0)
+            self.dirty.add(filepath)
+
+        if (notify):
+            self.stateChanged.emit()
+
+    def takeDirty(self):
+        """
+        @return set of filepaths that changed state since the last call
+        """
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+
+        return dirty
+
+
+class FetcherPool(object):
+    """
+    Limits how many FileFetchers read concurrently, adapting the limit between
+    min_count and max_count to maximize the measured bandwidth.
+
+    The adaptation is a simple hill climb: every time the fetchers have been
+    busy for a measurement window, the bandwidth of that window is compared
+    with the previous one. If it improved, the concurrency keeps moving in the
+    same direction, otherwise it reverses. This finds the knee between a fast
+    local drive that benefits from parallel reads and a slow network link that
+    gets overloaded by them, and keeps probing in case conditions change.
+
+    This is safe to use from multiple threads.
+    """
+    def __init__(self, min_count, max_count, count):
+        self.min_count = min_count
+        self.max_count = max_count
+        self.count = max(min_count, min(max_count, count))
+        # Number of fetchers that acquired a slot
+        self.active_count = 0
+        self.shutting_down = False
+        self.condition = threading.Condition()
+
+        # Reads in flight and time when the first of them started, used to
+        # measure busy time, during which at least one read is in flight
+        self.read_count = 0
+        self.busy_start_time = None
+
+        self.window_bytes = 0
+        self.window_busy_secs = 0.0
+        self.window_latency_secs = 0.0
+        self.window_reads = 0
+        self.step = 1
+        self.prev_bandwidth = None
+
+        # Diagnostics from the last window
+        self.bandwidth = 0.0
+        self.latency_secs = 0.0
+
+    def acquire(self):
+        """
+        Block until the fetcher is allowed to take a request
+        """
+        with self.condition:
+            while ((self.active_count >= self.count) and (not self.shutting_down)):
+                self.condition.wait()
+            self.active_count += 1
+
+    def release(self):
+        with self.condition:
+            self.active_count -= 1
+            self.condition.notify()
+
+    def shutdown(self):
+        """
+        Unblock all the fetchers waiting for a slot so they can get the
+        sentinel from the queue
+        """
+        with self.condition:
+            self.shutting_down = True
+            self.condition.notify_all()
+
+    def beginRead(self):
+        with self.condition:
+            if (self.read_count == 0):
+                self.busy_start_time = time.time()
+            self.read_count += 1
+
+    def endRead(self, bytes_read, secs):
+        """
+        @param bytes_read bytes read or None if the read was cancelled or
+               failed, in which case it's not accounted
+        @param secs time the read took
+        """
+        with self.condition:
+            self.read_count -= 1
+            if (self.read_count == 0):
+                self.window_busy_secs += time.time() - self.busy_start_time
+                self.busy_start_time = None
+
+            if (bytes_read is None):
+                return
+
+            self.window_bytes += bytes_read
+            self.window_latency_secs += secs
+            self.window_reads += 1
+
+            busy_secs = self.window_busy_secs
+            if (self.busy_start_time is not None):
+                busy_secs += time.time() - self.busy_start_time
+            if (busy_secs >= fetcher_pool_window_secs):
+                self.adapt(busy_secs)
+
+    def adapt(self, busy_secs):
+        """
+        Must be called with the lock held
+        """
+        self.bandwidth = self.window_bytes / busy_secs
+        self.latency_secs = self.window_latency_secs / self.window_reads
+
+        if ((self.prev_bandwidth is not None) and 
+            (self.bandwidth < self.prev_bandwidth * (1.0 + fetcher_pool_min_gain))):
+            # No gain, reverse the direction
+            self.step = -self.step
+        new_count = self.count + self.step
+        if ((new_count < self.min_count) or (new_count > self.max_count)):
+            # Bounce off the limits
+            self.step = -self.step
+            new_count = self.count + self.step
+        new_count = max(self.min_count, min(self.max_count, new_count))
+
+        info("FetcherPool %s/s %0.3fs latency at %d fetchers, changing to %d", 
+            size_to_human_friendly_units(int(self.bandwidth)), self.latency_secs, 
+            self.count, new_count)
+
+        self.prev_bandwidth = self.bandwidth
+        self.count = new_count
+        self.condition.notify_all()
+
+        # Measure the window for the new count from scratch, note the reads in
+        # flight straddle both windows
+        self.window_bytes = 0
+        self.window_busy_secs = 0.0
+        self.window_latency_secs = 0.0
+        self.window_reads = 0
+        if (self.busy_start_time is not None):
+            self.busy_start_time = time.time()
+
+    def getStats(self):
+        """
+        @return (concurrency, bandwidth in bytes per second, average read
+                latency in seconds) as measured in the last window
+        """
+        with self.condition:
+            return (self.count, self.bandwidth, self.latency_secs)
+
+
 # XXX Merge FileFetcher and PixmapReader common functionality into an ancestor
 #     class QueuedTaskWorker
 
 class FileFetcher(QThread):
+    """
+    Fetches files in chunks so the fetch of the current request can be
+    cancelled from a different thread and progress can be reported.
+
+    Cancelled fetches are dropped without emitting fileFetched, it's up to the
+    canceller to re-request the file if needed.
+
+    The data read so far for stream_filepath is emitted in filePartial so it
+    can be decoded and displayed before the fetch finishes.
+    """
     fileFetched = pyqtSignal(str, tuple)
+    fileProgress = pyqtSignal(str, tuple)
+    filePartial = pyqtSignal(str, tuple)
 
-    def __init__(self, request_queue, parent=None):
+    def __init__(self, request_queue, proxy_store=None, pool=None, states=None, parent=None):
         """
+        @param proxy_store DiskCache to keep local copies of remote files in,
+               or None
+        @param pool FetcherPool limiting the concurrency of this fetcher and
+               measuring its bandwidth, or None
+        @param states PipelineStates to update or None
         @param parent must be not None or the thread will get garbage collected
         """
         super(FileFetcher, self).__init__(parent)
         self.request_queue = request_queue
+        self.proxy_store = proxy_store
+        self.pool = pool
+        self.states = states
+
+        # The lock protects current_filepath and the cancel event from the
+        # race between the fetch finishing and a cancel
+        self.lock = threading.Lock()
+        self.current_filepath = None
+        self.cancel_event = threading.Event()
+        # Set from the GUI thread to the main image filepath, note attribute
+        # assignment is atomic so no locking is needed
+        self.stream_filepath = None
+        # Time of the last progress of the current fetch, see abandon
+        self.progress_time = None
+        self.abandoned = False
+
+    def cancel(self, keep_filepath=None):
+        """
+        Cancel the fetch in flight, if any, unless it's for keep_filepath.
+
+        This is called from a different thread than the one running the
+        fetcher.
+
+        @return the filepath cancelled or None if nothing was cancelled
+        """
+        with self.lock:
+            filepath = self.current_filepath
+            if ((filepath is None) or (filepath == keep_filepath) or 
+                self.cancel_event.is_set()):
+                return None
+            info("Cancelling fetch %r", filepath)
+            self.cancel_event.set()
+
+        return filepath
+
+    def abandon(self, min_progress_time):
+        """
+        Abandon the fetch in flight if it didn't progress since
+        min_progress_time. The fetcher will exit once the blocked read returns,
+        without emitting nor releasing its pool slot.
+
+        This is called from a different thread than the one running the
+        fetcher.
+
+        @return (filepath, cancelled) with the filepath abandoned and whether it
+                had already been cancelled, or (None, None) if nothing was
+                abandoned
+        """
+        with self.lock:
+            filepath = self.current_filepath
+            if ((filepath is None) or self.abandoned or 
+                (self.progress_time >= min_progress_time)):
+                return None, None
+            self.abandoned = True
+            cancelled = self.cancel_event.is_set()
+            self.cancel_event.set()
+
+        return filepath, cancelled
+
+    def mapFile(self, filepath, long_filepath):
+        """
+        @return (data, filestat) where data is a read-only mmap of the file
+        """
+        t = time.time()
+        with open(long_filepath, "rb") as f:
+            filestat = os.fstat(f.fileno())
+            if (filestat.st_size == 0):
+                # Empty files can't be mapped
+                data = ""
+            else:
+                # The mapping stays valid after closing the file
+                data = SharedMapping(f.fileno(), 0, access=mmap.ACCESS_READ)
+        t = time.time() - t
+        info("worker mapped data in %0.2fs %r %d in queue", t, long_filepath, self.request_queue.qsize())
+        
+        return data, filestat
+
+    def readFile(self, filepath, long_filepath):
+        """
+        @return (data, filestat) or (None, None) if cancelled
+        """
+        t = time.time()
+        report_time = t
+        stream_time = t
+        stream_bytes = 0
+        with open(long_filepath, "rb") as f:
+            # fstat on the open file saves a round trip over a path stat on
+            # network drives
+            filestat = os.fstat(f.fileno())
+            chunks = []
+            bytes_read = 0
+            while (not self.cancel_event.is_set()):
+                chunk = f.read(fetch_chunk_size)
+                if (len(chunk) == 0):
+                    break
+                chunks.append(chunk)
+                bytes_read += len(chunk)
+                self.progress_time = time.time()
+
+                if (time.time() - report_time > fetch_progress_interval_secs):
+                    report_time = time.time()
+                    self.fileProgress.emit(filepath, (bytes_read, filestat.st_size))
+
+                # Check stream_filepath every time since it can change while
+                # fetching, eg when the prefetch of the next image becomes the
+                # main image
+                if (use_progressive_display and (filepath == self.stream_filepath) and 
+                    (filestat.st_size >= stream_min_bytes) and 
+                    (time.time() - stream_time > stream_interval_secs) and
+                    (bytes_read >= stream_bytes * stream_growth_factor)):
+                    stream_time = time.time()
+                    stream_bytes = bytes_read
+                    # The chunks are kept as they are, only the partial is
+                    # joined. The partial needs its own copy since the decoder
+                    # thread holds it while more data is read
+                    self.filePartial.emit(filepath, ("".join(chunks), filestat.st_size))
+
+        if (self.cancel_event.is_set()):
+            info("worker cancelled %r after %d bytes", long_filepath, bytes_read)
+            return None, None
+
+        data = "".join(chunks)
+        t = time.time() - t
+        info("worker prefetched data in %0.2fs %0.2fKB/s %r %d in queue", t, len(data) / (t * 1024.0) if t > 0 else 0, long_filepath, self.request_queue.qsize())
+        
+        return data, filestat
 
     def run(self):
         info("FileFetcher.run")
         request_queue = self.request_queue
         while (True):
+            # Wait for a slot before taking a request so the requests are not
+            # held by fetchers over the pool's concurrency
+            if (self.pool is not None):
+                self.pool.acquire()
             data = request_queue.get()
             if (data is None):
                 break
 
             filepath = data
             info("worker prefetching %r (%d in queue)", filepath, self.request_queue.qsize())
+            with self.lock:
+                self.current_filepath = filepath
+                self.progress_time = time.time()
+                self.cancel_event.clear()
+            if (self.states is not None):
+                self.states.set(filepath, FILE_STATE_FETCHING)
             # Store file contents, don't use QImage yet because:
             # - Using QImage.load will block the GUI thread for the whole duration
             #   of the load and conversion, which makes prefetching useless.
@@ -450,88 +1644,852 @@ class FileFetcher(QThread):
                 # Caller expects the original filepath in the reply (specifically,
                 # to use as the cache key), don't modify it
                 long_filepath = os_path_safelong(filepath)
+
+                # Remote files are checked against the local proxy store by
+                # size and mtime before fetching them
+                data = None
+                filestat = None
+                proxy_key = None
+                if ((self.proxy_store is not None) and os_path_isremote(filepath)):
+                    filestat = os.stat(long_filepath)
+                    proxy_key = (os_path_abspath(filepath), filestat.st_size, filestat.st_mtime)
+                    data = self.proxy_store.get(proxy_key)
+                    if ((data is not None) and (len(data) != filestat.st_size)):
+                        warn("Proxy size mismatch for %r, ignoring", filepath)
+                        data = None
+                    info("worker proxy %s for %r", "miss" if (data is None) else "hit", filepath)
                 
-                t = time.time()
-                with open(long_filepath, "rb") as f:
-                    # XXX Read in chunks to reduce chance of network failures? Could
-                    #     also allow aborting to give higher prio to queued transfer
-                    #     and to report progress, but the latter would need to be
-                    #     cross-thread compatible (in some shared variable?)
-                    data = f.read()
-                t = time.time() - t
-                info("worker prefetched data in %0.2fs %0.2fKB/s %r %d in queue", t, len(data) / (t * 1024.0) if t > 0 else 0, long_filepath, self.request_queue.qsize())
-                t = time.time()
-                filestat = os.stat(long_filepath)
-                t = time.time() - t
-                info("worker prefetched stat in %0.2fs %r %d in queue", t, long_filepath, self.request_queue.qsize())
+                if ((data is None) and use_mmap_local_files and (proxy_key is None)):
+                    # Map local files so the mapping is used for the cache and
+                    # for decoding without copies. Also map NFS since it's
+                    # known to page in efficiently
+                    mountpoint, fstype = os_path_mount(filepath)
+                    if ((fstype not in network_fstypes) or (fstype in mmap_fstypes)):
+                        data, filestat = self.mapFile(filepath, long_filepath)
+
+                if (data is None):
+                    # Only reads are measured by the pool, proxy hits and
+                    # mapped files don't tell anything about the bandwidth
+                    if (self.pool is not None):
+                        self.pool.beginRead()
+                    t = time.time()
+                    try:
+                        data, filestat = self.readFile(filepath, long_filepath)
+                    finally:
+                        if (self.pool is not None):
+                            self.pool.endRead(None if (data is None) else len(data), time.time() - t)
+
+                    if ((proxy_key is not None) and (data is not None)):
+                        self.proxy_store.put(proxy_key, data)
+
             except:
                 # If there was an error, let the caller handle it by placing None
                 # data
                 exc("Unable to prefetch %r", long_filepath)
                 data = None
                 filestat = None
+
+            # Check for cancellation under the lock, a cancel after this point
+            # will find no current filepath and the caller will know it wasn't
+            # cancelled
+            with self.lock:
+                cancelled = self.cancel_event.is_set()
+                self.current_filepath = None
+
+            if (cancelled):
+                info("worker dropping cancelled %r", filepath)
+
+            else:
+                if (self.states is not None):
+                    self.states.set(filepath, FILE_STATE_FAILED if (data is None) else FILE_STATE_FETCHED)
+                self.fileFetched.emit(filepath, (data, filestat))
+
+            if (self.abandoned):
+                # The lane already released the slot and replaced this fetcher
+                break
+
+            if (self.pool is not None):
+                self.pool.release()
+
+        info("FileFetcher.run ends")
+
+
+class FetcherLanes(object):
+    """
+    Routes fetch requests to a lane per mount point, each lane with its own
+    request queue, FetcherPool and FileFetchers, so a slow or hung network
+    share only delays the files in that share.
+
+    Lanes are created lazily the first time a file in that mount point is
+    requested. Lanes for network filesystems are limited to
+    remote_fetcher_max_count fetchers, local ones to fetcher_max_count.
+
+    This is not thread-safe and should only be used from the GUI thread.
+    """
+    def __init__(self, proxy_store, states, connect_fetcher, parent):
+        """
+        @param states PipelineStates to update, requests are set to queued
+               when put and the fetchers update them when serviced
+        @param connect_fetcher function called with each new FileFetcher to
+               connect its signals
+        @param parent must be not None or the threads will get garbage collected
+        """
+        self.proxy_store = proxy_store
+        self.states = states
+        self.connect_fetcher = connect_fetcher
+        self.parent = parent
+        self.stream_filepath = None
+        # mountpoint -> lane dict with "mountpoint", "fstype", "request_queue",
+        # "pool", "max_count", "timeout_secs", "fetchers" and "abandoned" keys,
+        # the latter holds the abandoned fetchers whose thread is still
+        # blocked, see checkTimeouts
+        self.lanes = {}
+
+    def createFetcher(self, lane):
+        t = FileFetcher(lane["request_queue"], self.proxy_store, lane["pool"], self.states, self.parent)
+        t.stream_filepath = self.stream_filepath
+        self.connect_fetcher(t)
+        t.start()
+        lane["fetchers"].append(t)
+
+    def getLane(self, filepath):
+        mountpoint, fstype = os_path_mount(filepath)
+        lane = self.lanes.get(mountpoint, None)
+        if (lane is None):
+            if (fstype in network_fstypes):
+                max_count = remote_fetcher_max_count
+                timeout_secs = remote_fetch_timeout_secs
+            else:
+                max_count = fetcher_max_count
+                timeout_secs = fetch_timeout_secs
+            info("Creating fetcher lane for %r %s with up to %d fetchers", mountpoint, fstype, max_count)
+            lane = {
+                "mountpoint" : mountpoint,
+                "fstype" : fstype,
+                "request_queue" : PriorityScheduler(),
+                "pool" : FetcherPool(fetcher_min_count, max_count, min(max_count, fetcher_initial_count)),
+                "max_count" : max_count,
+                "timeout_secs" : timeout_secs,
+                "fetchers" : [],
+                "abandoned" : [],
+            }
+            self.lanes[mountpoint] = lane
+            self.fillLane(lane)
+
+        return lane
+
+    def fillLane(self, lane):
+        """
+        Create fetchers up to the current count of the lane pool.
+
+        Fetchers are created lazily as the pool grows instead of up to the max
+        count, since most lanes never need that many threads.
+        """
+        while ((len(lane["fetchers"]) < lane["pool"].count) and 
+            (len(lane["abandoned"]) < abandoned_fetcher_max_count)):
+            dbg("Creating fetcher on %r, %d abandoned", lane["mountpoint"], len(lane["abandoned"]))
+            self.createFetcher(lane)
+
+    def put(self, filepath, priority=PRIORITY_PREFETCH):
+        self.states.set(filepath, FILE_STATE_QUEUED)
+        lane = self.getLane(filepath)
+        lane["request_queue"].put(filepath, priority)
+        # The pool count adapts from the fetcher threads, catch up here
+        self.fillLane(lane)
+
+    def promote(self, filepath, priority):
+        """
+        @return True if the request was queued, False if not queued (eg in
+                flight), see PriorityScheduler.promote
+        """
+        return self.getLane(filepath)["request_queue"].promote(filepath, priority)
+
+    def demote(self, priority=PRIORITY_STALE):
+        """
+        @return list of filepaths cancelled in all the lanes, see
+                PriorityScheduler.demote
+        """
+        entries = []
+        for lane in self.lanes.itervalues():
+            entries.extend(lane["request_queue"].demote(priority))
+
+        return entries
+
+    def clear(self):
+        """
+        @return list of filepaths cleared from all the lanes
+        """
+        entries = []
+        for lane in self.lanes.itervalues():
+            entries.extend(lane["request_queue"].clear())
+
+        return entries
+
+    def cancel(self, keep_filepath=None):
+        """
+        @return list of filepaths cancelled in all the lanes
+        """
+        cancelled = []
+        for lane in self.lanes.itervalues():
+            cancelled.extend([fetcher.cancel(keep_filepath) for fetcher in lane["fetchers"]])
+
+        return [filepath for filepath in cancelled if (filepath is not None)]
+
+    def setStreamFilepath(self, filepath):
+        self.stream_filepath = filepath
+        for lane in self.lanes.itervalues():
+            for fetcher in lane["fetchers"]:
+                fetcher.stream_filepath = filepath
+
+    def checkTimeouts(self):
+        """
+        Abandon the fetches that haven't progressed in the lane timeout, fail
+        them and replace the fetchers so the rest of the lane can proceed.
+
+        Note the abandoned thread stays blocked until the read returns, at
+        which point it exits. Only abandoned_fetcher_max_count blocked threads
+        per lane are replaced, so a flaky share doesn't leak threads without
+        bound, the rest are replaced as the blocked threads exit.
+        """
+        now = time.time()
+        for mountpoint, lane in self.lanes.iteritems():
+            lane["abandoned"] = [fetcher for fetcher in lane["abandoned"] if (not fetcher.isFinished())]
+            for fetcher in list(lane["fetchers"]):
+                filepath, cancelled = fetcher.abandon(now - lane["timeout_secs"])
+                if (filepath is None):
+                    continue
+
+                warn("Abandoning fetch %r on %r after %ds without progress", filepath, mountpoint, lane["timeout_secs"])
+                lane["fetchers"].remove(fetcher)
+                lane["abandoned"].append(fetcher)
+                # The abandoned fetcher won't release its slot
+                lane["pool"].release()
+                # Fail the file, the user can refresh to retry. Cancelled
+                # fetches were already accounted by the canceller
+                if (not cancelled):
+                    self.states.set(filepath, FILE_STATE_FAILED)
+                    fetcher.fileFetched.emit(filepath, (None, None))
+
+            self.fillLane(lane)
+
+    def getStats(self):
+        """
+        @return (concurrency, bandwidth) added over all the lanes
+        """
+        stats = [lane["pool"].getStats() for lane in self.lanes.itervalues()]
+        return (sum([count for (count, bandwidth, latency) in stats]),
+            sum([bandwidth for (count, bandwidth, latency) in stats]))
+
+    def shutdown(self):
+        self.cancel()
+        for lane in self.lanes.itervalues():
+            lane["pool"].shutdown()
+            for _ in lane["fetchers"]:
+                lane["request_queue"].put(None)
+                # XXX Missing .wait the QThread
+
+
+def parse_exif(data):
+    """
+    Parse the EXIF orientation and capture date from the header of a JPEG or
+    TIFF file
+
+    See https://www.media.mit.edu/pia/Research/deepview/exif.html
+    See https://www.awaresystems.be/imaging/tiff/tifftags/privateifd/exif.html
+
+    @param data the first bytes of the file, the EXIF information is normally
+           in the first 64KB
+    @return dict with "orientation" (1 to 8, as in the EXIF tag) and
+            "datetime" (datetime.datetime) keys for the tags found
+    """
+    exif = {}
+
+    if (data[:2] == "\xff\xd8"):
+        # JPEG, find the APP1 marker with the Exif header
+        offset = 2
+        tiff_offset = None
+        while (offset + 4 <= len(data)):
+            marker, length = struct.unpack(">HH", data[offset:offset+4])
+            if ((marker & 0xff00) != 0xff00) or (marker == 0xffda):
+                # Not a marker or start of scan, no more metadata after this
+                break
+            if ((marker == 0xffe1) and (data[offset+4:offset+10] == "Exif\x00\x00")):
+                tiff_offset = offset + 10
+                break
+            offset += 2 + length
+
+        if (tiff_offset is None):
+            return exif
+
+    elif (data[:4] in ["II*\x00", "MM\x00*"]):
+        tiff_offset = 0
+
+    else:
+        return exif
+
+    tiff = data[tiff_offset:]
+    endian = "<" if (tiff[:2] == "II") else ">"
+
+    def read_ifd(ifd_offset):
+        """
+        @return dict of tag -> (type, count, value or offset)
+        """
+        entries = {}
+        if (ifd_offset + 2 > len(tiff)):
+            return entries
+        entry_count = struct.unpack(endian + "H", tiff[ifd_offset:ifd_offset+2])[0]
+        for i in xrange(entry_count):
+            entry_offset = ifd_offset + 2 + i * 12
+            if (entry_offset + 12 > len(tiff)):
+                break
+            tag, tag_type, count = struct.unpack(endian + "HHI", tiff[entry_offset:entry_offset+8])
+            if (tag_type == 3):
+                # SHORT, left justified in the 4 value bytes
+                value = struct.unpack(endian + "H", tiff[entry_offset+8:entry_offset+10])[0]
+            else:
+                value = struct.unpack(endian + "I", tiff[entry_offset+8:entry_offset+12])[0]
+            entries[tag] = (tag_type, count, value)
+        return entries
+
+    def read_ascii(entry):
+        tag_type, count, value = entry
+        # ASCII values longer than 4 bytes are stored at the value offset
+        s = tiff[value:value+count] if (count > 4) else ""
+        return s.rstrip("\x00")
+
+    try:
+        ifd0 = read_ifd(struct.unpack(endian + "I", tiff[4:8])[0])
+
+        EXIF_TAG_ORIENTATION = 0x0112
+        EXIF_TAG_DATETIME = 0x0132
+        EXIF_TAG_EXIF_IFD = 0x8769
+        EXIF_TAG_DATETIME_ORIGINAL = 0x9003
+
+        if (EXIF_TAG_ORIENTATION in ifd0):
+            orientation = ifd0[EXIF_TAG_ORIENTATION][2]
+            if (1 <= orientation <= 8):
+                exif["orientation"] = orientation
+
+        datetime_entry = ifd0.get(EXIF_TAG_DATETIME, None)
+        if (EXIF_TAG_EXIF_IFD in ifd0):
+            exif_ifd = read_ifd(ifd0[EXIF_TAG_EXIF_IFD][2])
+            datetime_entry = exif_ifd.get(EXIF_TAG_DATETIME_ORIGINAL, datetime_entry)
+
+        if (datetime_entry is not None):
+            exif["datetime"] = datetime.datetime.strptime(read_ascii(datetime_entry), "%Y:%m:%d %H:%M:%S")
+
+    except (struct.error, ValueError):
+        # Truncated or corrupt EXIF, return whatever was found
+        warn("Unable to parse EXIF")
+
+    return exif
+
+# Transform for each EXIF orientation from the stored pixels to the upright
+# image, without translation, see QPixmap.trueMatrix
+# See https://magnushoff.com/articles/jpeg-orientation/
+EXIF_ORIENTATION_TRANSFORMS = {
+    1 : QTransform(1, 0, 0, 1, 0, 0),
+    2 : QTransform(-1, 0, 0, 1, 0, 0),
+    3 : QTransform(-1, 0, 0, -1, 0, 0),
+    4 : QTransform(1, 0, 0, -1, 0, 0),
+    5 : QTransform(0, 1, 1, 0, 0, 0),
+    6 : QTransform(0, 1, -1, 0, 0, 0),
+    7 : QTransform(0, -1, -1, 0, 0, 0),
+    8 : QTransform(0, -1, 1, 0, 0, 0),
+}
+
+
+class FileProber(QThread):
+    """
+    Probes the file header to get metadata (dimensions, format, frame count,
+    EXIF orientation and capture date) without transferring the whole file.
+
+    The probe is emitted in fileProbed as a dict with keys "filestat", "size"
+    (QSize), "format", "frame_count", "orientation" and "datetime", or None if
+    the file couldn't be probed.
+    """
+    fileProbed = pyqtSignal(str, tuple)
+
+    def __init__(self, request_queue, parent=None):
+        """
+        @param parent must be not None or the thread will get garbage collected
+        """
+        super(FileProber, self).__init__(parent)
+        self.request_queue = request_queue
+
+    def run(self):
+        info("FileProber.run")
+        while (True):
+            filepath = self.request_queue.get()
+            if (filepath is None):
+                break
+
+            info("Probing %r (%d in queue)", filepath, self.request_queue.qsize())
+            try:
+                long_filepath = os_path_safelong(filepath)
+                with open(long_filepath, "rb") as f:
+                    filestat = os.fstat(f.fileno())
+                    data = f.read(probe_size_bytes)
+
+                # QImageReader only needs the header for the size and format.
+                # Note the frame count is a lower bound if the frames extend
+                # past the probed data, but it's still good to tell animated
+                # from non-animated
+                reader = qThreadSafeImageReader(qImageDevice(data))
+                exif = parse_exif(data)
+                probe = {
+                    "filestat" : filestat,
+                    "size" : reader.size(),
+                    "format" : str(reader.format()),
+                    "frame_count" : reader.imageCount(),
+                    "orientation" : exif.get("orientation", 1),
+                    "datetime" : exif.get("datetime", None),
+                }
+                info("Probed %r %r", filepath, probe)
+
+            except:
+                exc("Unable to probe %r", filepath)
+                probe = None
+
+            # Tuple signals need to wrap the dict
+            self.fileProbed.emit(filepath, (probe,))
+
+        info("FileProber.run ends")
+
+
+class PixmapReader(QThread):
+    """
+    Decodes images and emits them in imageReady as (image, imageWidget, size).
+
+    Only QImages are used since QPixmaps are not supported outside of the GUI
+    thread on some platforms (eg X11), the images are scaled and converted to
+    the display format so the GUI thread only needs to create the pixmap.
+    """
+    # XXX See https://mayaposch.wordpress.com/2011/11/01/how-to-really-truly-use-qthreads-the-full-explanation/
+    # XXX See https://stackoverflow.com/questions/10776509/qthreads-qobject-and-sleep-function
+    # XXX See https://woboq.com/blog/qthread-you-were-not-doing-so-wrong.html
+    
+    imageReady = pyqtSignal(str, tuple)
+    
+    def __init__(self, request_queue, states=None, parent=None):
+        """
+        @param states PipelineStates to update or None
+        @param parent must be not None or the thread will get garbage collected
+        """
+        info("PixmapReader.__init__")
+        super(PixmapReader, self).__init__(parent)
+        self.request_queue = request_queue
+        self.states = states
+        
+    def run(self):
+        info("PixmapReader.run")
+        request_queue = self.request_queue
+
+        while (True):
+            data = request_queue.get()
+            if (data is None):
+                break
+
+            filepath, (file_data, imageWidget, scale, reader) = data
+            if (self.states is not None):
+                self.states.set(filepath, FILE_STATE_DECODING)
+
+            if ((reader is None) and (g_decoder_pool is not None)):
+                # Readers can't be sent to other processes, only requests
+                # without one are decoded in the pool
+                image, size = self.decodeInProcess(filepath, file_data, scale)
+
+            else:
+                if (reader is None):
+                    info("Creating reader")
+                    reader = qThreadSafeImageReader(qImageDevice(file_data))
+                    info("Created new reader %r", reader)
+
+                else:
+                    # Note this will fail if a recycled reader is used in multiple
+                    # threads simultaneously making the resulting pixmap None.
+                    # Readers should only be recycled when used for different frames
+                    # of the same image, but code in nextFrame prevents from queueing
+                    # multiple frames for the same image, so this should be safe.
+                    # XXX Prevent by having a single main image queue?
+                    info("Recycling reader %r", reader)
+
+                info("Reading image from buffer %r %d", filepath, len(file_data or []))
+                image, size = qReadImage(reader, scale)
+                if (image.isNull()):
+                    warn("Unable to decode %r: %s", filepath, reader.errorString())
+
+            info("Emitting image %r null %s", filepath, image.isNull())
             
-            self.fileFetched.emit(filepath, (data, filestat))
+            if (self.states is not None):
+                self.states.set(filepath, FILE_STATE_FAILED if image.isNull() else FILE_STATE_DECODED)
+            # Release the use taken when queueing, see ImageViewer.requestDecode
+            release_file_data(file_data)
+            self.imageReady.emit(filepath, (image, imageWidget, size))
+
+        info("PixmapReader.run ends")
+
+    def decodeInProcess(self, filepath, file_data, scale):
+        """
+        Decode in g_decoder_pool, blocking this thread but not the GIL until
+        the process is done
+
+        @return (image, size) with the decoded image, null on error, and the
+                full size
+        """
+        info("Decoding %r in process", filepath)
+        long_filepath = None
+        if (isinstance(file_data, mmap.mmap)):
+            # Mapped files are local, have the process read the file instead
+            # of copying and pickling the contents. Contents read into memory
+            # (remote files) are still pickled
+            long_filepath = os_path_safelong(filepath)
+            file_data = None
+        try:
+            result = g_decoder_pool.apply(decode_in_process, (
+                file_data, 
+                long_filepath,
+                None if (scale is None) else (scale.width(), scale.height()), 
+                decoder_shm_dirpath
+            ))
+
+        except:
+            exc("Unable to decode %r in process", filepath)
+            result = None
+
+        if (result is None):
+            return QImage(), QSize()
+
+        shm_filepath, width, height, bytes_per_line, image_format, (full_width, full_height) = result
+        try:
+            with open(shm_filepath, "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Wrap the shared pixels without copying. The image wrapper keeps
+            # the mapping alive, it's passed along as the same Python object
+            # (Python queues and tuple signals) so the pixels stay mapped
+            # until the last user closes it or drops it, see
+            # close_image_mapping
+            image = QImage(m, width, height, bytes_per_line, QImage.Format(image_format))
+            if (os.name == "nt"):
+                # Windows can't remove the file while it's mapped, copy
+                image = image.copy()
+                m.close()
+            else:
+                image.shm_mapping = m
+
+        except:
+            exc("Unable to read decoded %r from %r", filepath, shm_filepath)
+            image = QImage()
+
+        finally:
+            # The mapping stays valid after removing the file
+            try:
+                os.remove(shm_filepath)
+            except OSError:
+                exc("Unable to remove %r", shm_filepath)
+
+        return image, QSize(full_width, full_height)
+
+
+class PyramidBuilder(QThread):
+    """
+    Builds power of two downscales of an image so resizes don't need to
+    smooth scale the full resolution image, see ImageWidget.setPyramid
+
+    Request queue entries are (filepath, (cache_key, image)), the levels are
+    emitted in pyramidReady as (cache_key, images) from larger to smaller.
+    """
+    pyramidReady = pyqtSignal(str, tuple)
+
+    def __init__(self, request_queue, parent=None):
+        """
+        @param parent must be not None or the thread will get garbage collected
+        """
+        super(PyramidBuilder, self).__init__(parent)
+        self.request_queue = request_queue
+
+    def run(self):
+        info("PyramidBuilder.run")
+        while (True):
+            entry = self.request_queue.get()
+            if (entry is None):
+                break
+
+            filepath, (cache_key, image) = entry
+            info("Building pyramid for %r %dx%d", filepath, image.width(), image.height())
+            images = []
+            # Each level is built from the previous one, so every scaling is
+            # by one half
+            while ((image.width() / 2 >= pyramid_min_size_px) and 
+                   (image.height() / 2 >= pyramid_min_size_px)):
+                image = image.scaled(image.width() / 2, image.height() / 2, 
+                    Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+                images.append(image)
+
+            info("Built %d pyramid levels for %r", len(images), filepath)
+            self.pyramidReady.emit(filepath, (cache_key, images))
+
+        info("PyramidBuilder.run ends")
+
+
+class ImageFilterWorker(QThread):
+    """
+    Applies filters to images so they don't block the GUI thread, see
+    qFilterImage
+
+    Request queue entries are (filepath, (cache_key, image, params)), the
+    results are emitted in imageFiltered as (cache_key, params, image). None
+    params request computing the auto levels instead, emitted in
+    autoLevelsComputed as (gamma, levels), see compute_auto_levels
+    """
+    imageFiltered = pyqtSignal(str, tuple)
+    autoLevelsComputed = pyqtSignal(str, tuple)
+
+    def __init__(self, request_queue, parent=None):
+        """
+        @param parent must be not None or the thread will get garbage collected
+        """
+        super(ImageFilterWorker, self).__init__(parent)
+        self.request_queue = request_queue
+
+    def run(self):
+        info("ImageFilterWorker.run")
+        while (True):
+            entry = self.request_queue.get()
+            if (entry is None):
+                break
+
+            filepath, (cache_key, image, params) = entry
+            if (params is None):
+                info("Computing auto levels %r", filepath)
+                try:
+                    auto_levels = compute_auto_levels(image)
+
+                except ImportError:
+                    warn("Can't import numpy, auto levels disabled")
+                    auto_levels = (1.0, FILTER_IDENTITY[3])
+
+                except:
+                    # Fall back to the identity levels, this thread needs to
+                    # keep serving requests
+                    exc("Unable to compute auto levels %r", filepath)
+                    auto_levels = (1.0, FILTER_IDENTITY[3])
+
+                info("Computed auto levels %r %s", filepath, auto_levels)
+                self.autoLevelsComputed.emit(filepath, auto_levels)
+
+            else:
+                info("Filtering %r with %s", filepath, params)
+                try:
+                    image = qFilterImage(image, params)
+
+                except:
+                    # Display it unfiltered, this thread needs to keep serving
+                    # requests
+                    exc("Unable to filter %r", filepath)
+
+                self.imageFiltered.emit(filepath, (cache_key, params, image))
+
+        info("ImageFilterWorker.run ends")
+
+
+class DiskCache(object):
+    """
+    Persistent cache of byte strings stored one per file in a local directory,
+    bounded by size.
+
+    Keys are tuples that are hashed into filenames, so stale entries (eg for a
+    modified source file whose key includes the mtime) are never hit again and
+    eventually get pruned as least recently used.
+
+    This is safe to use from multiple threads and processes, files are written
+    to a temporary name and then renamed into place.
+    """
+    def __init__(self, dirpath, max_bytes, extension=""):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.lock = threading.Lock()
+        # Lazily initialized since scanning the directory can take time, that
+        # way the scan happens on whatever worker thread accesses it first
+        self.bytes = None
+
+    def getFilepath(self, key):
+        digest = hashlib.md5(repr(key)).hexdigest()
+        return os.path.join(self.dirpath, digest + self.extension)
+
+    def scan(self):
+        """
+        @return list of (mtime, size, filepath) for all the entries
+        """
+        entries = []
+        try:
+            for filename in os.listdir(self.dirpath):
+                filepath = os.path.join(self.dirpath, filename)
+                try:
+                    filestat = os.stat(filepath)
+                    entries.append((filestat.st_mtime, filestat.st_size, filepath))
+
+                except OSError:
+                    # Possibly pruned by a different process
+                    pass
+
+        except OSError:
+            warn("Unable to list disk cache %r", self.dirpath)
+
+        return entries
+
+    def initialize(self):
+        with self.lock:
+            if (self.bytes is None):
+                if (not os.path.exists(self.dirpath)):
+                    try:
+                        os.makedirs(self.dirpath)
+                    except OSError:
+                        # Possibly created by a different thread or process
+                        pass
+                self.bytes = sum([size for mtime, size, filepath in self.scan()])
+                info("Disk cache %r has %d bytes", self.dirpath, self.bytes)
+
+    def get(self, key):
+        """
+        @return the stored bytes or None if not present
+        """
+        self.initialize()
+        filepath = self.getFilepath(key)
+        try:
+            with open(filepath, "rb") as f:
+                data = f.read()
+            # Update the mtime so pruning is least recently used and not least
+            # recently stored
+            os.utime(filepath, None)
+
+        except (IOError, OSError):
+            data = None
+
+        return data
 
-        info("FileFetcher.run ends")
+    def put(self, key, data):
+        self.initialize()
+        filepath = self.getFilepath(key)
+        temp_filepath = "%s.%d.%d.tmp" % (filepath, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(temp_filepath, "wb") as f:
+                f.write(data)
+            if (os.path.exists(filepath)):
+                # On Windows rename fails if the destination exists
+                os.remove(filepath)
+            os.rename(temp_filepath, filepath)
+
+        except (IOError, OSError):
+            exc("Unable to store %r in disk cache", filepath)
+            try:
+                os.remove(temp_filepath)
+            except OSError:
+                pass
+            return
 
+        with self.lock:
+            self.bytes += len(data)
+            needs_pruning = (self.bytes > self.max_bytes)
 
-class PixmapReader(QThread):
-    # XXX See https://mayaposch.wordpress.com/2011/11/01/how-to-really-truly-use-qthreads-the-full-explanation/
-    # XXX See https://stackoverflow.com/questions/10776509/qthreads-qobject-and-sleep-function
-    # XXX See https://woboq.com/blog/qthread-you-were-not-doing-so-wrong.html
-    
-    pixmapReady = pyqtSignal(str, tuple)
-    
-    def __init__(self, request_queue, parent=None):
+        if (needs_pruning):
+            self.prune()
+
+    def prune(self):
+        """
+        Remove the least recently used entries until the cache is 90% of the
+        max size, this hysteresis prevents pruning on every put once full
+        """
+        with self.lock:
+            entries = self.scan()
+            entries.sort()
+            self.bytes = sum([size for mtime, size, filepath in entries])
+            info("Pruning disk cache %r with %d bytes", self.dirpath, self.bytes)
+            for mtime, size, filepath in entries:
+                if (self.bytes <= self.max_bytes * 0.9):
+                    break
+                try:
+                    os.remove(filepath)
+                    self.bytes -= size
+
+                except OSError:
+                    pass
+            info("Pruned disk cache %r to %d bytes", self.dirpath, self.bytes)
+
+
+class ThumbnailStoreWorker(QThread):
+    """
+    Looks up and stores thumbnails in the persistent thumbnail DiskCache.
+
+    Request queue entries are (filepath, filestat, image) tuples:
+    - image None is a lookup, the file is stat'ed to build the key (filestat is
+      ignored) and the result is emitted in thumbnailLookedUp as (image or None,
+      filestat)
+    - image not None stores the image with the key built from filestat
+
+    Lookups and stores should use different workers and queues so stores don't
+    get discarded when lookups are cleared and lookups don't wait behind stores.
+    """
+    thumbnailLookedUp = pyqtSignal(str, tuple)
+
+    def __init__(self, store, request_queue, parent=None):
         """
         @param parent must be not None or the thread will get garbage collected
         """
-        info("PixmapReader.__init__")
-        super(PixmapReader, self).__init__(parent)
+        super(ThumbnailStoreWorker, self).__init__(parent)
+        self.store = store
         self.request_queue = request_queue
-        
-    def run(self):
-        info("PixmapReader.run")
-        request_queue = self.request_queue
 
+    @staticmethod
+    def getKey(filepath, filestat):
+        return (os_path_abspath(filepath), filestat.st_size, filestat.st_mtime, thumbnail_size_px)
+
+    def run(self):
+        info("ThumbnailStoreWorker.run")
         while (True):
-            data = request_queue.get()
-            if (data is None):
+            entry = self.request_queue.get()
+            if (entry is None):
                 break
 
-            filepath, (file_data, imageWidget, scale, reader) = data
-            
-            if (reader is None):
-                info("Creating reader")
-                buffer = QBuffer()
-                buffer.setData(file_data)
-                reader = qThreadSafeImageReader(buffer)
-                info("Created new reader %r", reader)
+            filepath, filestat, image = entry
+            if (image is None):
+                info("Looking up stored thumbnail %r", filepath)
+                try:
+                    filestat = os.stat(os_path_safelong(filepath))
+                    data = self.store.get(self.getKey(filepath, filestat))
+
+                except:
+                    exc("Unable to look up stored thumbnail %r", filepath)
+                    filestat = None
+                    data = None
+
+                if (data is not None):
+                    buffer = QBuffer()
+                    buffer.setData(data)
+                    reader = qThreadSafeImageReader(buffer)
+                    image = reader.read()
+                    if (image.isNull()):
+                        warn("Corrupt stored thumbnail for %r", filepath)
+                        image = None
+
+                info("Looked up stored thumbnail %r found %s", filepath, image is not None)
+                self.thumbnailLookedUp.emit(filepath, (image, filestat))
 
             else:
-                # Note this will fail if a recycled reader is used in multiple
-                # threads simultaneously making the resulting pixmap None.
-                # Readers should only be recycled when used for different frames
-                # of the same image, but code in nextFrame prevents from queueing
-                # multiple frames for the same image, so this should be safe.
-                # XXX Prevent by having a single main image queue?
-                info("Recycling reader %r", reader)
-            info("Reading image from buffer %r %d", filepath, len(file_data or []))
-            image = reader.read()
-            info("Converting image to pixmap %r", filepath)
-            pixmap = QPixmap.fromImage(image)
-            info("Scaling pixmap %r", filepath)
-            if ((not pixmap.isNull()) and (scale is not None)):
-                pixmap = pixmap.scaled(scale, 
-                    Qt.KeepAspectRatioByExpanding if (False) else Qt.KeepAspectRatio, 
-                        Qt.SmoothTransformation)
+                info("Storing thumbnail %r", filepath)
+                byte_array = QByteArray()
+                buffer = QBuffer(byte_array)
+                buffer.open(QIODevice.WriteOnly)
+                if (image.save(buffer, "PNG")):
+                    buffer.close()
+                    self.store.put(self.getKey(filepath, filestat), byte_array.data())
 
-            info("Emitting pixmap %r null %s error %s", filepath, pixmap.isNull(), reader.errorString())
-            
-            self.pixmapReady.emit(filepath, (pixmap, imageWidget))
+                else:
+                    warn("Unable to encode thumbnail %r", filepath)
+                close_image_mapping(image)
 
-        info("PixmapReader.run ends")
+        info("ThumbnailStoreWorker.run ends")
 
 
 def split_base_index(s):
@@ -635,6 +2593,93 @@ def size_to_human_friendly_units(u):
     return "%0.2f %s" % (u * 1.0/d, unit)
 
 
+class DirListingCache(object):
+    """
+    Cache of directory listings and the stats of their entries, shared by the
+    image viewer and the file dialog.
+
+    Listings are revalidated with a single stat of the directory: creating,
+    deleting or renaming entries updates the directory mtime, so the listing
+    is only redone when the mtime changes. Note modifying a file doesn't
+    update the directory mtime, so entry stats can be stale wrt size and
+    dates, but not wrt file vs. directory.
+
+    This is thread-safe.
+    """
+    # Filesystems like FAT have 2 second mtime granularity, don't trust
+    # listings done within that time of the last directory modification since
+    # there could be further modifications with the same mtime
+    mtime_granularity_secs = 2.0
+
+    def __init__(self, max_count):
+        self.lock = threading.Lock()
+        # dirpath -> (dir_mtime, listing_time, names, {name: stat},
+        # {name: is_dir})
+        self.listings = LRUCache(max_count)
+
+    def listdir(self, dirpath):
+        """
+        Same as os.listdir but cached
+
+        @return list of names in dirpath, the same list object is returned
+                while the listing is valid so it must not be modified
+        @raise OSError if dirpath cannot be listed
+        """
+        dir_mtime = os.stat(dirpath).st_mtime
+        with self.lock:
+            listing = self.listings.get(dirpath)
+
+        if ((listing is not None) and (listing[0] == dir_mtime) and
+            (listing[1] - dir_mtime > self.mtime_granularity_secs)):
+            info("dir listing cache hit for %r", dirpath)
+            return listing[2]
+
+        info("dir listing cache miss for %r", dirpath)
+        listing_time = time.time()
+        names, is_dirs, filestats = os_listdir_types(dirpath)
+        with self.lock:
+            self.listings.put(dirpath, (dir_mtime, listing_time, names, filestats, is_dirs))
+
+        return names
+
+    def getIsDir(self, dirpath, name):
+        """
+        @return True or False if the entry type is known from the listing or a
+                stat, None otherwise
+        """
+        with self.lock:
+            listing = self.listings.peek(dirpath)
+            if (listing is None):
+                return None
+            filestat = listing[3].get(name, None)
+            if (filestat is not None):
+                return stat.S_ISDIR(filestat.st_mode)
+            return listing[4].get(name, None)
+
+    def getStat(self, dirpath, name):
+        """
+        @return the cached stat of the entry or None if not cached
+        """
+        with self.lock:
+            listing = self.listings.peek(dirpath)
+            return None if (listing is None) else listing[3].get(name, None)
+
+    def setStat(self, dirpath, name, filestat):
+        """
+        Cache the stat of the entry, ignored if the directory is not cached
+        """
+        with self.lock:
+            listing = self.listings.peek(dirpath)
+            if ((listing is not None) and (filestat is not None)):
+                listing[3][name] = filestat
+
+    def invalidate(self, dirpath):
+        with self.lock:
+            self.listings.remove(dirpath)
+
+g_dir_listing_cache = DirListingCache(dir_listing_cache_max_count)
+
+
 class StatFetcher(QThread):
     statFetched = pyqtSignal(tuple)
 
@@ -648,7 +2693,8 @@ class StatFetcher(QThread):
         while (True):
             entry = self.request_queue.get()
             if (entry is None):
-                self.response_queue.put(None)
+                if (self.response_queue is not None):
+                    self.response_queue.put(None)
                 break
             request_id, filepath = entry
             
@@ -666,7 +2712,8 @@ class StatFetcher(QThread):
 
             entry = (request_id, filepath, filestat)            
             info("Responding stat request id %d for %r", request_id, filepath)
-            self.response_queue.put(entry)
+            if (self.response_queue is not None):
+                self.response_queue.put(entry)
             # Theoretically if this queue fills and blocks it would deadlock
             # updateDirpath, but Qt connection queue sizes are supposed to be
             # bounded only by memory. Other options would be to call statFetched
@@ -677,6 +2724,93 @@ class StatFetcher(QThread):
         info("StatFetcher ended")
 
 
+class DirLister(QThread):
+    """
+    Lists directories and emits the names in batches of dir_listing_batch_size
+    as (request_id, dirpath, names, done) tuples. names is None if the
+    directory couldn't be listed.
+
+    Requests older than latest_request_id are skipped, and the ones in flight
+    stop emitting. Note a listdir blocked on an unreachable host can't be
+    cancelled, but requests for other directories are serviced by the other
+    listers meanwhile.
+    """
+    entriesListed = pyqtSignal(tuple)
+
+    def __init__(self, request_queue):
+        self.request_queue = request_queue
+        # Set from the GUI thread, note attribute assignment is atomic so no
+        # locking is needed
+        self.latest_request_id = None
+        return super(DirLister, self).__init__()
+
+    def run(self):
+        info("DirLister started")
+        while (True):
+            entry = self.request_queue.get()
+            if (entry is None):
+                break
+            request_id, dirpath = entry
+
+            if (request_id != self.latest_request_id):
+                info("Skipping stale listing request id %d for %r", request_id, dirpath)
+                continue
+
+            info("Listing request id %d for %r", request_id, dirpath)
+            try:
+                names = g_dir_listing_cache.listdir(dirpath)
+
+            except Exception as e:
+                exc("Exception when listing request id %d for %r", request_id, dirpath)
+                self.entriesListed.emit((request_id, dirpath, None, True))
+                continue
+
+            info("Listed request id %d %d names for %r", request_id, len(names), dirpath)
+            # Emit at least once so empty directories are also done
+            for i in xrange(0, max(1, len(names)), dir_listing_batch_size):
+                if (request_id != self.latest_request_id):
+                    info("Cancelled listing request id %d for %r", request_id, dirpath)
+                    break
+                done = (i + dir_listing_batch_size >= len(names))
+                self.entriesListed.emit((request_id, dirpath, names[i:i+dir_listing_batch_size], done))
+
+        info("DirLister ended")
+
+
+class FileDialogItem(QListWidgetItem):
+    """
+    QListWidgetItem that sorts ".." first, then directories, then files,
+    pseudo-numerically.
+
+    This allows streaming entries into a sorting QListWidget in any order and
+    turning files into directories as the stats come.
+    """
+    def __init__(self, name, is_dir=False):
+        super(FileDialogItem, self).__init__(name)
+        self.is_dir = False
+        self.setDir(is_dir)
+
+    def setDir(self, is_dir):
+        # Set before the font since setting the font re-sorts the item
+        self.is_dir = is_dir
+        font = self.font()
+        font.setBold(is_dir)
+        self.setFont(font)
+
+    def getSortClass(self):
+        if (self.text() == ".."):
+            return 0
+        return 1 if self.is_dir else 2
+
+    def __lt__(self, other):
+        a = self.getSortClass()
+        b = other.getSortClass()
+        if (a != b):
+            return a < b
+
+        return cmp_numerically(self.text(), other.text()) < 0
+
+
 class FileDialog(QDialog):
     """
     Qt file dialog (native or not) is extremely slow on SMB network drives with
@@ -688,8 +2822,13 @@ class FileDialog(QDialog):
     - Mouse navigation
     - Keyboard history navigation
     - Keyboard substring search
-    - Threaded file stat
-    - Background file stat if foreground exceeded a given timeout
+    - Threaded directory listing, streamed in batches and cancelled when
+      navigating elsewhere
+    - Directory entry types from the listing itself where possible, see
+      os_listdir_types
+    - Threaded file stat otherwise, entries are filtered, sorted and marked as
+      directories as the stats come
+    - Lazy stat of the current entry for the size and date
 
     """
     # XXX Think about what initialization should be elsewhere if the dialog is
@@ -698,13 +2837,13 @@ class FileDialog(QDialog):
     def __init__(self, filepath, parent=None):
         super(FileDialog, self).__init__(parent)
 
-        self.statRequestQueue = Queue()
-        # XXX Remove response queue since with signals it's not necessary? (but
-        #     it's still used for the blocking phase of updateDirpath, until the
-        #     timer fires, and using the notify path has decreased quality like
-        #     filtering out unsupported files and sorting?)
-        self.statResponseQueue = Queue()
+        self.statRequestQueue = PriorityScheduler()
+        self.listRequestQueue = Queue()
         self.requestId = 0
+        # name -> FileDialogItem for the names in the current listing
+        self.items = {}
+        # Name of the item to make current when listed, see updateDirpath
+        self.focusName = None
 
         # navigationHistoryIndex points to the current entry in the history, -1
         # if empty. updateDirpath will add the current dirpath to the history
@@ -717,13 +2856,21 @@ class FileDialog(QDialog):
         self.statFetchers = []
         for i in xrange(num_stat_fetchers):
             info("Creating statFetcher %d", i)
-            statFetcher = StatFetcher(self.statRequestQueue, self.statResponseQueue)
+            statFetcher = StatFetcher(self.statRequestQueue)
             # Note the default connection parameter AutoConnection will use
             # QueuedConnection (verified), which is what is desired in this case
             # that uses cross thread signals
             statFetcher.statFetched.connect(self.statFetched)
             statFetcher.start()
             self.statFetchers.append(statFetcher)
+
+        self.dirListers = []
+        for i in xrange(dir_lister_count):
+            info("Creating dirLister %d", i)
+            dirLister = DirLister(self.listRequestQueue)
+            dirLister.entriesListed.connect(self.entriesListed)
+            dirLister.start()
+            self.dirListers.append(dirLister)
             
         self.setWindowTitle("Open File")
 
@@ -745,8 +2892,13 @@ class FileDialog(QDialog):
         listWidget = QListWidget()
         listWidget.itemDoubleClicked.connect(self.entryDoubleClicked)
         listWidget.itemSelectionChanged.connect(lambda : self.edit.setText(listWidget.currentItem().text()))
+        # currentItemChanged also passes the previous item, drop it
+        listWidget.currentItemChanged.connect(lambda current, previous: self.updateDetails(current))
         listWidget.installEventFilter(self)
         listWidget.setTabKeyNavigation(False)
+        # Entries are streamed in any order, let the list keep them sorted,
+        # see FileDialogItem
+        listWidget.setSortingEnabled(True)
         self.listWidget = listWidget
         self.listKeyDownTime = 0
         self.listKeyDownText = ""
@@ -757,6 +2909,10 @@ class FileDialog(QDialog):
         self.total = total
         self.layout.addWidget(total)
 
+        details = QLabel()
+        self.details = details
+        self.layout.addWidget(details)
+
         buttonBox = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         buttonBox.accepted.connect(self.navigate)
         buttonBox.rejected.connect(self.reject)
@@ -779,27 +2935,27 @@ class FileDialog(QDialog):
         info("fetched stat %r", entry)
         
         request_id, filepath, filestat = entry
+        # Cache the stat even if stale, it's still valid for that filepath
+        dirpath, name = os.path.split(filepath)
+        g_dir_listing_cache.setStat(dirpath, name, filestat)
+
         # This could get emits for a previous id, discard them, in particular
         # this could receive emits after the dialog has been dismissed (since
         # dismissing the dialog doesn't close it, just hides it)
         if (self.requestId == request_id):
-            if (stat.S_ISDIR(filestat.st_mode)):
-                filename = os.path.basename(filepath)
-                items = self.listWidget.findItems(filename, Qt.MatchExactly)
-                if (len(items) == 1):
-                    item = items[0]
-                    # XXX Cache this font?
-                    bold_font = item.font()
-                    bold_font.setBold(True)
-                    item.setFont(bold_font)
-
+            # filestat could be None if there was a transient error, etc, in
+            # that case, default to non directory
+            self.classifyEntry(name, (filestat is not None) and stat.S_ISDIR(filestat.st_mode))
+            item = self.listWidget.currentItem()
+            if ((item is not None) and (item.text() == name)):
+                if (filestat is None):
+                    # Don't request it again
+                    self.details.setText("")
                 else:
-                    error("found %d items for stat %r, expected one", len(items), filepath)
-
-            # XXX This could check if it's in deferred mode and remove any one
-            #     entry (or all) from the queue, since the queue is not used
-            #     once in deferred mode. This prevent the bulk of the stales
-            #     puts that need to be cleanup the next updateDirpath
+                    # Pass the stat, the directory may have been evicted from
+                    # the listing cache, in which case the stat wasn't cached
+                    # and looking it up would request it again
+                    self.updateDetails(item, filestat)
 
         else:
             info("Ignoring stale statFetched emit id %d vs. %d %r vs %r for %r", 
@@ -822,6 +2978,11 @@ class FileDialog(QDialog):
         for fetcher in self.statFetchers:
             self.statRequestQueue.put(None)
         info("Signaled")
+        info("Signaling %d listers to end", len(self.dirListers))
+        for lister in self.dirListers:
+            lister.latest_request_id = None
+            self.listRequestQueue.put(None)
+        info("Signaled")
         # Wait for each fetcher after queing as many stop items as fetchers,
         # can't send and wait individually since the queue is shared by fetchers
         # and it's not deterministic which fetcher will end when
@@ -829,6 +2990,8 @@ class FileDialog(QDialog):
         for fetcher in self.statFetchers:
             fetcher.wait()
         info("Waited")
+        # Note the listers are not waited for, since one could be blocked
+        # listing an unreachable directory
         
 
     def clearQueues(self):
@@ -840,7 +3003,7 @@ class FileDialog(QDialog):
         """
         info("clearQueues")
         self.statRequestQueue.clear()
-        self.statResponseQueue.clear()
+        self.listRequestQueue.clear()
 
     def accept(self, *args, **kwargs):
         info("accept")
@@ -861,113 +3024,25 @@ class FileDialog(QDialog):
         # Only navigate calls this, should pass absolute and unicode
         assert os.path.isabs(dirpath) and isinstance(dirpath, unicode)
 
-        # listdir and isdir can take time on network drives
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-
-        # Clear any pending (stale) requests or responses
-        # Note there may be stale emits and puts in the response queue even
-        # after clearing, but they are discarded at fetchedStat time based on
-        # the request id
+        # Clear any pending (stale) requests
+        # Note there may be stale emits even after clearing, but they are
+        # discarded at entriesListed and statFetched time based on the request
+        # id
         self.clearQueues()
-        
-        # XXX Do this in a thread and block with timeout so the box can at least
-        #     be dismissed when network paths are slow?
-        # XXX Also do the stat fetching in a similar way?
-        info("listdir %r", dirpath)
-        names = os.listdir(dirpath)
-        info("listdired %d files", len(names))
-
-        filenames = []
-        dirnames = []
-
-        # Create a new request id and request all stats, the request id will be
-        # used in the puts and emits to be able to tell the current
-        # updateDirpath from stale reponses from a previous updateDirpath
-        self.requestId += 1
-        for name in names:
-            path = os.path.join(dirpath, name)
-            info("Requesting stat id %d for %r", self.requestId, path)
-            self.statRequestQueue.put((self.requestId, path))
-
-        stat_start_time_secs = time.time()
-        processed_names = len(names)
-        while (processed_names > 0):
-            if (time.time() - stat_start_time_secs > stat_timeout_secs):
-                info("Stat timed out, deferring further stats")
-                # Switch all to non directories, this will cause a different
-                # list than with non deferred stats in the following ways:
-                # - directories won't be clustered on top
-                # - the not-yet-processed directories won't be displayed in bold
-                #   until the deferred stat is processed
-                # - files won't be filtered by supported extensions
-                #
-                # but there's little that can be done in that case since there's
-                # no filename vs. dir information until all the stats have been
-                # fetched, and modifying the list after it's show is bad UX
-                # since the user may be interacting with it
-                #
-                # XXX Switching to deferred will leave all remaining puts as
-                #     stale items in the response queue since the statFetched
-                #     handler doesn't remove them (it's not aware of deferred
-                #     vs. non deferred). These stale puts will be discarded with
-                #     the next requestId but it's not clean to leave those
-                #     around, fix?
-                #     Note most of these puts will be removed by clearQueues()
-                #     rather than filtered by request id anyway.
-                #     Note this is not the only source of stale puts, there's a
-                #     small source of stale puts even after clearQueues() if
-                #     some thread was still servicing a request when
-                #     clearQueues() happened
-                
-                filenames = names
-                dirnames = []
-                break
-            request_id, filepath, filestat = self.statResponseQueue.get()
-            # filestat could be None if there was a transient error, etc, in that
-            # case, default to non directory
-            is_dir = ((filestat is not None) and stat.S_ISDIR(filestat.st_mode))
-            name = os.path.basename(filepath)
-
-            # Ignore stale requests from old IDs.
-            #
-            # This could use the dirpath to tell requests apart, but it's not
-            # clear if it's theoretically possible to get stale requests for the
-            # current path if there's a fast switch from pathA to pathB to pathA
-            # again
-            if (request_id == self.requestId):
-                _, ext = os.path.splitext(name)
-                
-                if (is_dir):
-                    dirnames.append(name)
-
-                # XXX This filter is missing when deferring because has to be
-                #     applied only to files and not dirs, reapply when the stats
-                #     come?
-
-                elif (ext.lower() in supported_extensions):
-                    filenames.append(name)
-                processed_names -= 1
-
-            else:
-                info("Ignoring stale put id %d vs. %d %r vs. %r for %r", 
-                    self.requestId, request_id, dirpath, os.path.dirname(filepath), filepath)
-
-        # XXX Allow sorting by date if stats were not deferred?
-        dirnames.sort(cmp=cmp_numerically)
-        filenames.sort(cmp=cmp_numerically)
-
-        self.listWidget.clear()
-        # Add ".." to navigate to parent if not root
-        if (not os_path_isroot(dirpath)):
-            self.listWidget.addItem("..")
-        self.listWidget.addItems(dirnames)
-        self.listWidget.addItems(filenames)
 
-        self.total.setText("%d files and dirs" % self.listWidget.count())
+        # Create a new request id and request the listing, the request id will
+        # be used in the emits to be able to tell the current updateDirpath from
+        # stale reponses from a previous updateDirpath
+        self.requestId += 1
+        for lister in self.dirListers:
+            lister.latest_request_id = self.requestId
+        info("Requesting listing id %d for %r", self.requestId, dirpath)
+        self.listRequestQueue.put((self.requestId, dirpath))
 
-        # Focus on the child coming from, if any
+        # Focus on the child coming from, if any, once it's listed
         # XXX If this is doing history navigation it should focus on the
         #     previous entry in the history?
+        self.focusName = None
         if (self.dirpath.startswith(dirpath)):
             dirname = ""
             basename = self.dirpath
@@ -977,18 +3052,17 @@ class FileDialog(QDialog):
             info("path %r dirpath %r dirname %r ", dirpath, self.dirpath, dirname)
 
             if (dirname != ""):
-                items = self.listWidget.findItems(dirname, Qt.MatchExactly)
-                if (len(items) == 1):
-                    self.listWidget.setCurrentItem(items[0])
+                self.focusName = dirname
 
-                else:
-                    error("Expected one item for %r, found %d %s", dirname, len(items), [item.text() for item in items])
-        
-        # Count could be 0 on empty root dirs
-        # XXX Also on invalid ones, but that's probably not properly handled yet
-        #     anyway
-        elif (self.listWidget.count() > 0):
-            self.listWidget.setCurrentItem(self.listWidget.item(0))
+        self.listWidget.clear()
+        self.items = {}
+        # Add ".." to navigate to parent if not root
+        if (not os_path_isroot(dirpath)):
+            item = FileDialogItem("..")
+            self.listWidget.addItem(item)
+            self.listWidget.setCurrentItem(item)
+
+        self.total.setText("Listing...")
 
         # Clear the path buttons by removing from the layout and setting the
         # parent to None (otherwise the parent will still keep a reference and 
@@ -1029,10 +3103,83 @@ class FileDialog(QDialog):
         self.pathLayout.addStretch()
         
         self.dirpath = dirpath
-        self.dirnames = dirnames
-        self.filenames = filenames
 
-        QApplication.restoreOverrideCursor()
+    def entriesListed(self, entry):
+        request_id, dirpath, names, done = entry
+        # Ignore stale emits from previous ids
+        if (request_id != self.requestId):
+            info("Ignoring stale entriesListed emit id %d vs. %d for %r", 
+                self.requestId, request_id, dirpath)
+            return
+
+        if (names is None):
+            self.total.setText("Unable to list %s" % dirpath)
+            return
+
+        info("Adding %d entries for %r", len(names), dirpath)
+        for name in names:
+            is_dir = g_dir_listing_cache.getIsDir(dirpath, name)
+            if (is_dir is not None):
+                self.classifyEntry(name, is_dir)
+                
+            else:
+                # Show the supported files right away, they will be marked as
+                # directories if the stat says so. Other names are only shown
+                # if the stat says they are directories
+                _, ext = os.path.splitext(name)
+                if (ext.lower() in supported_extensions):
+                    self.addEntry(name, False)
+                path = os.path.join(dirpath, name)
+                info("Requesting stat id %d for %r", self.requestId, path)
+                self.statRequestQueue.put((self.requestId, path), PRIORITY_VISIBLE)
+
+        self.total.setText("%d files and dirs%s" % (self.listWidget.count(), "" if done else "..."))
+
+    def updateDetails(self, item, filestat=None):
+        """
+        Show the size and date of the current item, requesting the stat if not
+        cached
+
+        @param filestat stat of the item, None to get it from the cache
+        """
+        if ((item is None) or (item.text() == "..") or (self.dirpath is None)):
+            self.details.setText("")
+            return
+
+        name = item.text()
+        if (filestat is None):
+            filestat = g_dir_listing_cache.getStat(self.dirpath, name)
+        if (filestat is None):
+            self.details.setText("...")
+            path = os.path.join(self.dirpath, name)
+            info("Requesting details stat id %d for %r", self.requestId, path)
+            # Put it in front of the pending stats, if any
+            self.statRequestQueue.put((self.requestId, path), PRIORITY_MAIN)
+            return
+
+        filedate = datetime.datetime.fromtimestamp(filestat.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+        if (stat.S_ISDIR(filestat.st_mode)):
+            self.details.setText(filedate)
+        else:
+            self.details.setText("%s %s" % (size_to_human_friendly_units(filestat.st_size), filedate))
+
+    def addEntry(self, name, is_dir):
+        item = FileDialogItem(name, is_dir)
+        self.listWidget.addItem(item)
+        self.items[name] = item
+        if ((name == self.focusName) or (self.listWidget.currentItem() is None)):
+            self.listWidget.setCurrentItem(item)
+
+    def classifyEntry(self, name, is_dir):
+        item = self.items.get(name, None)
+        if (item is not None):
+            if (is_dir and (not item.is_dir)):
+                item.setDir(True)
+
+        else:
+            _, ext = os.path.splitext(name)
+            if (is_dir or (ext.lower() in supported_extensions)):
+                self.addEntry(name, is_dir)
 
 
     def navigate(self, path = None, add_to_history = True):
@@ -1196,6 +3343,161 @@ class FileDialog(QDialog):
         self.navigate()
 
 
+class ImageTile(object):
+    """
+    Tile of a TiledImage queued for decoding, PixmapReader carries it in place
+    of the image widget so receive_pixmap can route the decoded tile
+    """
+    def __init__(self, tiledImage, level, col, row):
+        self.tiledImage = tiledImage
+        self.level = level
+        self.col = col
+        self.row = row
+        # Queued or being decoded, see ImageViewer.requestTile
+        self.queued = False
+
+
+class TiledImage(object):
+    """
+    Image too large to decode as a single pixmap, rendered from tiles decoded
+    on demand.
+
+    Tiles are tile_size_px square at power of two downscale levels, a tile at
+    level L covers tile_size_px * L source pixels per side. The level used is
+    the coarsest one that still has as many pixels as the display, so tiles
+    are reused across window resizes. Missing tiles are requested and the
+    reduced overview pixmap is drawn in their place meanwhile.
+    """
+    def __init__(self, filepath, file_data, size, tiles, request_tile, request_filter):
+        """
+        @param size QSize with the full resolution of the image
+        @param tiles LRUCache of (filepath, level, col, row) -> pixmap, shared
+               across images
+        @param request_tile function(tile, priority) to queue decoding an
+               ImageTile
+        @param request_filter function(cache_key, image, params) to queue
+               filtering a composition of tiles, see
+               ImageWidget.renderTiledPixmap
+        """
+        self.filepath = filepath
+        # Hold the file data until closed since tiles are decoded from it on
+        # demand, see SharedMapping
+        acquire_file_data(file_data)
+        self.file_data = file_data
+        self.size = size
+        self.tiles = tiles
+        self.request_tile = request_tile
+        self.request_filter = request_filter
+        # Requested tiles not received yet, (level, col, row) -> ImageTile
+        self.pending = {}
+        # Incremented with every tile received, so compositions can be reused
+        # while no new tiles arrive
+        self.generation = 0
+        # Size of the whole image as displayed, updated when rendering
+        self.display_size = size
+
+    def close(self):
+        """
+        Release the file data, the queued tiles hold their own use
+        """
+        release_file_data(self.file_data)
+        self.file_data = None
+
+    def getLevel(self, scale):
+        """
+        @param scale display pixels per source pixel
+        """
+        level = 1
+        while (level * 2 * scale <= 1.0):
+            level *= 2
+        return level
+
+    def getTileRect(self, level, col, row):
+        """
+        @return QRect of the tile in source coordinates, clipped to the image
+        """
+        tile_span = tile_size_px * level
+        return QRect(col * tile_span, row * tile_span, tile_span, tile_span).intersected(
+            QRect(QPoint(0, 0), self.size))
+
+    def requestTile(self, level, col, row, priority):
+        tile = self.pending.get((level, col, row))
+        if (tile is None):
+            tile = ImageTile(self, level, col, row)
+            self.pending[(level, col, row)] = tile
+        self.request_tile(tile, priority)
+
+    def receiveTile(self, tile, pixmap):
+        """
+        Store the decoded tile, failed tiles are stored as null pixmaps so they
+        are not requested again
+        """
+        self.pending.pop((tile.level, tile.col, tile.row), None)
+        self.tiles.put((self.filepath, tile.level, tile.col, tile.row), pixmap)
+        self.generation += 1
+
+    def cancelTile(self, tile):
+        """
+        Forget the request of a tile that was dropped from the decode queue so
+        it's requested again if still needed
+        """
+        tile.queued = False
+        self.pending.pop((tile.level, tile.col, tile.row), None)
+
+    def render(self, source_rect, scale, overview):
+        """
+        @param source_rect QRect to render in source coordinates
+        @param scale display pixels per source pixel
+        @param overview reduced pixmap of the whole image
+        @return pixmap with source_rect at the resolution of the tile level
+        """
+        level = self.getLevel(scale)
+        tile_span = tile_size_px * level
+        pixmap = QPixmap(
+            max(1, (source_rect.width() + level - 1) / level), 
+            max(1, (source_rect.height() + level - 1) / level)
+        )
+
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        overview_scale = overview.width() * 1.0 / self.size.width()
+        painter.drawPixmap(QRectF(pixmap.rect()), overview, QRectF(
+            source_rect.x() * overview_scale, source_rect.y() * overview_scale, 
+            source_rect.width() * overview_scale, source_rect.height() * overview_scale
+        ))
+
+        first_col = source_rect.left() / tile_span
+        last_col = source_rect.right() / tile_span
+        first_row = source_rect.top() / tile_span
+        last_row = source_rect.bottom() / tile_span
+        for row in xrange(first_row, last_row + 1):
+            for col in xrange(first_col, last_col + 1):
+                tile_pixmap = self.tiles.get((self.filepath, level, col, row))
+                if (tile_pixmap is None):
+                    self.requestTile(level, col, row, PRIORITY_MAIN)
+
+                elif (not tile_pixmap.isNull()):
+                    painter.drawPixmap(
+                        (col * tile_span - source_rect.x()) / level, 
+                        (row * tile_span - source_rect.y()) / level, 
+                        tile_pixmap
+                    )
+        painter.end()
+
+        # Request the ring of tiles around the visible ones so they are already
+        # decoded when scrolling
+        col_count = (self.size.width() + tile_span - 1) / tile_span
+        row_count = (self.size.height() + tile_span - 1) / tile_span
+        for row in xrange(max(0, first_row - 1), min(row_count, last_row + 2)):
+            for col in xrange(max(0, first_col - 1), min(col_count, last_col + 2)):
+                if ((first_row <= row <= last_row) and (first_col <= col <= last_col)):
+                    continue
+                if ((self.filepath, level, col, row) not in self.tiles):
+                    self.requestTile(level, col, row, PRIORITY_NEXT_PAGE)
+
+        return pixmap
+
+
 class ImageWidget(QLabel):
     # See https://stackoverflow.com/questions/30553467/resizable-pyqt-widget-displaying-an-image-with-fixed-aspect-ratio
     # XXX Have a message capability for when in fullscreen
@@ -1213,16 +3515,142 @@ class ImageWidget(QLabel):
         
         self.originalPixmap = None
         self.text = None
+        # EXIF orientation of originalPixmap, applied before rotation_degrees
+        self.orientation = 1
         self.rotation_degrees = 0
-        self.gamma = 1.0
         self.fitToSmallest = False
         self.scroll = 0
 
-    def setPixmap(self, pixmap):
+        # Memoized filtered, rotated and scaled pixmap, see resizePixmap. The
+        # scroll and the text are applied on top of this
+        self.transformedPixmap = None
+        self.transformedKey = None
+
+        # Tiles to render on top of originalPixmap, see TiledImage
+        self.tiledImage = None
+
+        # Downscales of the source pixmap from larger to smaller and the
+        # cacheKey of the pixmap they were built from, see PyramidBuilder
+        self.pyramid = []
+        self.pyramidKey = None
+
+        # Filter parameters and originalPixmap filtered with them, filtered in
+        # the background, see setFilteredPixmap
+        self.filterParams = FILTER_IDENTITY
+        self.filteredPixmap = None
+        self.filteredKey = None
+        # Composition of tiles filtered in the background, see
+        # setFilteredTiles
+        self.filteredTiles = None
+        self.filteredTilesKey = None
+
+    def setPixmap(self, pixmap, orientation=1):
         """
         Caller needs to call resizePixmap to update
+
+        @param orientation EXIF orientation of pixmap, see parse_exif
         """
         self.originalPixmap = pixmap
+        self.orientation = orientation if (orientation in EXIF_ORIENTATION_TRANSFORMS) else 1
+        self.setTiledImage(None)
+        self.pyramid = []
+        self.pyramidKey = None
+        self.filteredPixmap = None
+        self.filteredKey = None
+
+    def setFilteredPixmap(self, cache_key, params, pixmap):
+        """
+        Display pixmap instead of the current pixmap, ignored if cache_key and
+        params don't match the current pixmap and filter parameters.
+        Caller needs to call resizePixmap to update
+
+        @return True if the pixmap was set
+        """
+        if ((self.originalPixmap is None) or (self.originalPixmap.cacheKey() != cache_key) or 
+            (params != self.filterParams)):
+            return False
+
+        self.filteredPixmap = pixmap
+        self.filteredKey = (cache_key, params)
+        return True
+
+    def getSourcePixmap(self):
+        """
+        @return the pixmap to display before rotating and scaling, this is the
+                unfiltered pixmap until the filtered one is set
+        """
+        if ((self.filterParams != FILTER_IDENTITY) and 
+            (self.filteredKey == (self.originalPixmap.cacheKey(), self.filterParams))):
+            return self.filteredPixmap
+
+        return self.originalPixmap
+
+    def setPyramid(self, cache_key, pixmaps):
+        """
+        Use the downscales in pixmaps when resizing, ignored if cache_key
+        doesn't match the current source pixmap, see PyramidBuilder
+        """
+        if ((self.originalPixmap is not None) and (self.getSourcePixmap().cacheKey() == cache_key)):
+            self.pyramid = pixmaps
+            self.pyramidKey = cache_key
+
+    def getPyramidLevel(self, pixmap, size):
+        """
+        @return the smallest pyramid level of pixmap that is still larger than
+                pixmap fitted to size, or pixmap if there's none
+        """
+        if ((self.pyramidKey is None) or (pixmap.cacheKey() != self.pyramidKey)):
+            return pixmap
+
+        if (self.isTransposed()):
+            size = size.transposed()
+        target_size = pixmap.size().scaled(size, 
+            Qt.KeepAspectRatioByExpanding if (self.fitToSmallest) else Qt.KeepAspectRatio)
+        level = pixmap
+        for level_pixmap in self.pyramid:
+            if ((level_pixmap.width() < target_size.width()) or 
+                (level_pixmap.height() < target_size.height())):
+                break
+            level = level_pixmap
+
+        return level
+
+    def setTiledImage(self, tiledImage):
+        """
+        Render tiledImage using the current pixmap as overview, None to go
+        back to rendering the pixmap alone.
+        Caller needs to call resizePixmap to update
+        """
+        if ((self.tiledImage is not None) and (self.tiledImage is not tiledImage)):
+            self.tiledImage.close()
+        self.tiledImage = tiledImage
+        self.filteredTiles = None
+        self.filteredTilesKey = None
+
+    def setFilteredTiles(self, cache_key, params, pixmap):
+        """
+        Store the filtered composition of tiles requested by
+        renderTiledPixmap, ignored if params don't match the current filter
+        parameters. 
+        Caller needs to call resizePixmap to update
+
+        @return True if the pixmap was set
+        """
+        if ((self.tiledImage is None) or (params != self.filterParams)):
+            return False
+
+        self.filteredTiles = pixmap
+        self.filteredTilesKey = (cache_key, params)
+        return True
+
+    def getDisplaySize(self):
+        """
+        @return size of the whole image as displayed, this is larger than the
+                widget pixmap when rendering tiles
+        """
+        if (self.tiledImage is not None):
+            return self.tiledImage.display_size
+        return self.pixmap().size()
 
     def setText(self, text):
         """
@@ -1260,6 +3688,34 @@ class ImageWidget(QLabel):
         self.scroll = 0
         self.resizePixmap(self.size())
 
+    def setOrientation(self, orientation):
+        """
+        Set the EXIF orientation of the current pixmap, eg when it's only known
+        after the pixmap was set.
+        Caller needs to call resizePixmap to update
+        """
+        info("setOrientation from %d to %d", self.orientation, orientation)
+        self.orientation = orientation if (orientation in EXIF_ORIENTATION_TRANSFORMS) else 1
+
+    def getTransform(self, orientation=None):
+        """
+        @param orientation EXIF orientation to use instead of the current one
+        @return QTransform with the EXIF orientation followed by the rotation,
+                without translation or scaling
+        """
+        if (orientation is None):
+            orientation = self.orientation
+        return EXIF_ORIENTATION_TRANSFORMS.get(orientation, QTransform()) * QTransform().rotate(self.rotation_degrees)
+
+    def isTransposed(self, orientation=None):
+        """
+        @param orientation EXIF orientation to use instead of the current one
+        @return True if the displayed image has the width and height of the
+                pixmap swapped
+        """
+        t = self.getTransform(orientation)
+        return (abs(t.m11()) < abs(t.m12()))
+
     def rotatePixmap(self, degrees):
         # XXX Have a -1 or > 360 rotation that rotates dynamically so it takes
         #     the most space?
@@ -1268,12 +3724,14 @@ class ImageWidget(QLabel):
         self.scroll = 0
         self.resizePixmap(self.size())
 
-    def gammaCorrectPixmap(self, gamma):
-        # Don't trigger repaint if already that value
-        if (gamma != self.gamma):
-            info("gammaCorrectPixmap from %d to %d", self.gamma, gamma)
-            self.gamma = gamma
-            self.resizePixmap(self.size())
+    def setFilterParams(self, params):
+        """
+        The pixmap is displayed unfiltered until the filtered one is set, see
+        setFilteredPixmap.
+        Caller needs to call resizePixmap to update
+        """
+        info("setFilterParams from %s to %s", self.filterParams, params)
+        self.filterParams = params
 
 
     def resizePixmap(self, size):
@@ -1282,80 +3740,52 @@ class ImageWidget(QLabel):
         # XXX Reset scroll if resizing window (resizes, fullscreen), or clamp 
         #     below
 
-        pixmap = self.originalPixmap
-
-        if (self.gamma != 1.0):
-            # XXX This is not very efficient, conversions from pixmap to image
-            #     and back are done every time and at the original image size,
-            #     should probably be cached and merged with the scaling/rotating
-            #     below? (still takes only 20ms time on laptop)
-            #     Also, .scaled does that conversion from QPixmap to QImage and back
-            #     again under the hood
-            #     See https://www.qt.io/blog/2009/12/16/qt-graphics-and-performance-an-overview
-            # XXX This processing could be done on a background thread on QImages,
-            #     but not on QPixmap
-            #     See https://stackoverflow.com/questions/10307860/what-is-the-difference-between-qimage-and-qpixmap
-            # XXX Do auto-gamma, see https://stackoverflow.com/questions/61695773/how-to-set-the-best-value-for-gamma-correction
-            try:
-                info("Gamma correcting %2.2f", self.gamma)
-                import numpy as np
-                image = pixmap.toImage()
-                width = image.width()
-                height = image.height()
-                depth = image.depth() / 8
-                
-                ptr = image.constBits()
-                ptr.setsize(width * height * depth)
-                im = np.frombuffer(ptr, np.uint8)
-
-                lut = np.array([int(255.0 * (i / 255.0) ** (1.0 / self.gamma)) for i in xrange(256)], dtype=np.uint8)
-                im = lut[im]
-
-                image = QImage(im.data, width, height, width * depth, QImage.Format_RGB32)
+        if (self.tiledImage is not None):
+            pixmap = self.renderTiledPixmap(size)
 
-                pixmap = QPixmap.fromImage(image)
-                info("Gamma corrected")
-
-            except ImportError as e:
-                warn("Can't import numpy, image won't be gamma corrected")
+        else:
+            pixmap = self.getSourcePixmap()
 
-        
-        if (self.rotation_degrees != 0):
-            # This transformation is lossless, could keep the rotated pixmap
-            # instead of the original one, but it doesn't seem to be a lengthy
-            # operation, so it's ok to do it
-            info("Rotating %d", self.rotation_degrees)
-            t = QTransform()
-            t.rotate(self.rotation_degrees)
-            pixmap = pixmap.transformed(t)
-            info("rotated")
-        
-        info("scaling %s", size)
-        pixmap = pixmap.scaled(size, 
-            Qt.KeepAspectRatioByExpanding if (self.fitToSmallest) else Qt.KeepAspectRatio, 
-            Qt.SmoothTransformation
-        )
-        info("scaled")
+            # Note cacheKey changes whenever the pixmap is set to a different one
+            # or modified in place
+            key = (pixmap.cacheKey(), size.width(), size.height(), 
+                self.orientation, self.rotation_degrees, self.fitToSmallest)
+            if (key == self.transformedKey):
+                info("Reusing transformed pixmap")
+                pixmap = self.transformedPixmap
 
-        if (self.fitToSmallest):
-            if (size.width() == pixmap.width()):
-                info("fit to width")
-                self.setAlignment(Qt.AlignTop | Qt.AlignHCenter)
-                info("scrolling %s", self.scroll)
-                pixmap.scroll(0, -self.scroll, 0, 0, size.width(), pixmap.height())
-                info("scrolled")
             else:
-                info("fit to height")
-                self.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-                info("scrolling %s", self.scroll)
-                pixmap.scroll(-self.scroll, 0, 0, 0, pixmap.width(), size.height())
-                info("scrolled %s", self.scroll)
+                pixmap = self.transformPixmap(pixmap, size)
+                self.transformedPixmap = pixmap
+                self.transformedKey = key
+
+            if (self.fitToSmallest):
+                if (size.width() == pixmap.width()):
+                    info("fit to width")
+                    self.setAlignment(Qt.AlignTop | Qt.AlignHCenter)
+                    if (self.scroll != 0):
+                        info("scrolling %s", self.scroll)
+                        # Scroll a copy, don't modify the memoized pixmap
+                        pixmap = pixmap.copy()
+                        pixmap.scroll(0, -self.scroll, 0, 0, size.width(), pixmap.height())
+                        info("scrolled")
+                else:
+                    info("fit to height")
+                    self.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+                    if (self.scroll != 0):
+                        info("scrolling %s", self.scroll)
+                        pixmap = pixmap.copy()
+                        pixmap.scroll(-self.scroll, 0, 0, 0, pixmap.width(), size.height())
+                        info("scrolled %s", self.scroll)
         
-        else:
-            info("fit to both")
-            self.setAlignment(Qt.AlignHCenter| Qt.AlignVCenter)
+            else:
+                info("fit to both")
+                self.setAlignment(Qt.AlignHCenter| Qt.AlignVCenter)
 
-        if (self.text is not None):
+        if (self.text):
+            if (pixmap is self.transformedPixmap):
+                # Draw on a copy, don't modify the memoized pixmap
+                pixmap = pixmap.copy()
             painter = QPainter(pixmap)
             pen = QPen(Qt.green, 3)
             font = painter.font()
@@ -1371,6 +3801,94 @@ class ImageWidget(QLabel):
 
         super(ImageWidget, self).setPixmap(pixmap)
 
+    def renderTiledPixmap(self, size):
+        """
+        @return pixmap with the part of the tiled image visible at the current
+                scroll, filtered, rotated and scaled
+        """
+        tiledImage = self.tiledImage
+        full_size = tiledImage.size
+        # Source to display transform, the orientation and rotation are moved
+        # back to the origin the same way QPixmap.transformed does
+        t = QPixmap.trueMatrix(self.getTransform(), full_size.width(), full_size.height())
+        rotated_size = t.mapRect(QRect(QPoint(0, 0), full_size)).size()
+        display_size = rotated_size.scaled(size, 
+            Qt.KeepAspectRatioByExpanding if (self.fitToSmallest) else Qt.KeepAspectRatio)
+        scale = display_size.width() * 1.0 / rotated_size.width()
+        t = t * QTransform.fromScale(scale, scale)
+        tiledImage.display_size = display_size
+
+        # Only fit to smallest scrolls, and only along the side that doesn't
+        # fit
+        visible_rect = QRect(QPoint(0, 0), display_size)
+        if (self.fitToSmallest):
+            if (size.width() == display_size.width()):
+                info("fit to width")
+                self.setAlignment(Qt.AlignTop | Qt.AlignHCenter)
+                visible_rect = QRect(0, self.scroll, size.width(), size.height())
+
+            else:
+                info("fit to height")
+                self.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+                visible_rect = QRect(self.scroll, 0, size.width(), size.height())
+            visible_rect = visible_rect.intersected(QRect(QPoint(0, 0), display_size))
+
+        else:
+            info("fit to both")
+            self.setAlignment(Qt.AlignHCenter| Qt.AlignVCenter)
+
+        source_rect = t.inverted()[0].mapRect(QRectF(visible_rect)).toAlignedRect().intersected(
+            QRect(QPoint(0, 0), full_size))
+        # Tiles are filtered after composing them. The composition is filtered
+        # in the background and displayed unfiltered meanwhile, the filtered
+        # one is reused until new tiles arrive or the visible part changes
+        key = (tiledImage.generation, source_rect.getRect(), scale, self.originalPixmap.cacheKey())
+        if ((self.filterParams != FILTER_IDENTITY) and 
+            (self.filteredTilesKey == (key, self.filterParams))):
+            info("Reusing filtered tiles for %s", source_rect)
+            pixmap = self.filteredTiles
+
+        else:
+            info("rendering tiles for %s at %2.4f", source_rect, scale)
+            pixmap = tiledImage.render(source_rect, scale, self.originalPixmap)
+            if (self.filterParams != FILTER_IDENTITY):
+                # The composition is not much larger than the widget, the copy
+                # to an image is cheap
+                tiledImage.request_filter(key, pixmap.toImage(), self.filterParams)
+
+        return self.transformPixmap(pixmap, visible_rect.size())
+
+    def transformPixmap(self, pixmap, size):
+        """
+        @return pixmap oriented, rotated and scaled to fit size
+        """
+        # Start from the smallest downscale that still has enough pixels so
+        # the cost doesn't depend on the image resolution
+        pixmap = self.getPyramidLevel(pixmap, size)
+        if (pixmap.isNull()):
+            return pixmap
+
+        # Orient, rotate and scale in a single pass writing only the target
+        # resolution pixels instead of creating a full size rotated copy and
+        # then scaling it.
+        # Qt uses the smooth scaling path when there's no orientation or
+        # rotation and bilinear filtering otherwise, the pyramid level keeps
+        # the downscale within 2x where bilinear doesn't alias
+        t = QPixmap.trueMatrix(self.getTransform(), pixmap.width(), pixmap.height())
+        rotated_size = t.mapRect(pixmap.rect()).size()
+        display_size = rotated_size.scaled(size, 
+            Qt.KeepAspectRatioByExpanding if (self.fitToSmallest) else Qt.KeepAspectRatio)
+        if (display_size.isEmpty()):
+            return QPixmap()
+        t = t * QTransform.fromScale(display_size.width() * 1.0 / rotated_size.width(), 
+            display_size.height() * 1.0 / rotated_size.height())
+        info("transforming orientation %d rotation %d to %s", self.orientation, 
+            self.rotation_degrees, display_size)
+        pixmap = pixmap.transformed(t, Qt.SmoothTransformation)
+        info("transformed")
+
+        return pixmap
+
     def resizeEvent(self, event):
         info("resizeEvent %s", event.size())
         if (self.originalPixmap is not None):
@@ -1401,11 +3919,15 @@ class ImageWidget(QLabel):
 # Image states
 # init -> loading (or queued) -> decoded (error)
 # init -> loading (or queued) -> loaded -> decoding -> decoded (or error)
+# Thumbnails can also go through the thumbnail store
+# init -> lookup -> decoded (found in the store)
+# init -> lookup -> loading (or queued) -> ... (not found in the store)
 IMAGE_STATE_INIT =  0
-IMAGE_STATE_LOADING = 1
-IMAGE_STATE_LOADED = 2
-IMAGE_STATE_DECODING = 3
-IMAGE_STATE_DECODED = 4
+IMAGE_STATE_LOOKUP = 1
+IMAGE_STATE_LOADING = 2
+IMAGE_STATE_LOADED = 3
+IMAGE_STATE_DECODING = 4
+IMAGE_STATE_DECODED = 5
 
 class ImageViewer(QMainWindow):
     
@@ -1417,6 +3939,8 @@ class ImageViewer(QMainWindow):
         self.animation_timer = None
         self.animation_timer_start = None
         self.animation_reader = None
+        # File data used by animation_reader, see SharedMapping
+        self.animation_file_data = None
         # Initialize to 0 and 1 so statusbar displays 1/1 on non-animated files
         self.animation_frame = 0
         self.animation_count = 1
@@ -1424,6 +3948,10 @@ class ImageViewer(QMainWindow):
 
         self.recent_filepaths = []
 
+        # (names, filepaths) with the last directory listing names and the
+        # resulting filtered and sorted filepaths, see gotoImage
+        self.listed_filepaths = None
+
         # Use the scripts directory as FileDialog opening dir
         self.image_filepath = sys.argv[0]
         
@@ -1431,13 +3959,19 @@ class ImageViewer(QMainWindow):
         self.thumbnail_columns = 5
         self.thumbnail_rows = 5
         self.thumbnails_per_page = self.thumbnail_columns * self.thumbnail_rows
-        self.cached_files = []
-        # XXX This could have a max_size_bytes instead
-        # XXX This is x2 because the cache has +- around the current image, 
+        # XXX This is x2 because the cache has +- around the current image,
         #     fix it so it has more in the direction of the movement?
         self.cached_files_max_count = self.thumbnails_per_page * 2 + 2
+        # Entries are filepath -> (file_data, file_stat), file_data can be None
+        # if the file failed to load, in which case it's cached anyway so it's
+        # not fetched again
+        # Mapped files are accounted by their full size too, the mapped pages
+        # can be reclaimed but the mappings use address space, which runs out
+        # on 32-bit systems, see SharedMapping
+        self.cached_files = LRUCache(self.cached_files_max_count, cached_files_max_bytes,
+            lambda data: 0 if (data[0] is None) else len(data[0]),
+            lambda filepath, data: uncache_file_data(data[0]))
 
-        self.prefetch_request_queue = Queue()
         # XXX Check any relationship between prefetch and cache counts, looks
         #     like there shouldn't be any even if the current is evicted from
         #     lru since the current is also kept separately? (although prefetch
@@ -1447,10 +3981,77 @@ class ImageViewer(QMainWindow):
         #     otherwise the cache is halved with typical forward browsing
         self.prefetched_images_max_count = self.thumbnails_per_page * 2
         self.prefetch_pending = set()
-        self.prefetcher_count = 2
 
-        self.decoder_request_queue = Queue()
+        # Fetch and decode state of each file, see updatePipelineStates
+        self.pipeline_states = PipelineStates(pipeline_states_max_count)
+        # Always queue the notification, even when the state is changed from
+        # this thread, so it's not handled in the middle of updateThumbnails
+        self.pipeline_states.stateChanged.connect(self.updatePipelineStates, Qt.QueuedConnection)
+
+        # Requests are keyed by (filepath, imageWidget) so they can be
+        # promoted or cancelled when the widget changes image
+        self.decoder_request_queue = PriorityScheduler()
         self.decoder_count = multiprocessing.cpu_count()
+
+        # Second cache tier with decoded pixmaps, see decoded_images_max_count
+        # Entries are filepath -> (pixmap, full_size), the pixmap may be smaller
+        # than the full size, see use_screen_resolution_decode
+        self.decoded_images = LRUCache(decoded_images_max_count, decoded_images_max_bytes,
+            lambda entry: entry[0].width() * entry[0].height() * entry[0].depth() / 8)
+        # Neighbour filepaths currently queued for decoding
+        self.decoded_pending = set()
+        # Tiles of images too large to decode whole, see TiledImage. Entries
+        # are (filepath, level, col, row) -> pixmap
+        self.tile_cache = LRUCache(tile_cache_max_count, tile_cache_max_bytes,
+            lambda pixmap: pixmap.width() * pixmap.height() * pixmap.depth() / 8)
+        self.tile_redraw_pending = False
+        # A composition of tiles is being filtered, see requestTilesFilter
+        self.tiles_filter_pending = False
+
+        # Pyramids of the recently displayed images, see PyramidBuilder.
+        # Entries are (filepath, cache_key) -> (cache_key, pixmaps), there can
+        # be both the unfiltered and the filtered pixmap pyramids of a file.
+        # Only the latest request is kept in the queue
+        self.pyramid_request_queue = Queue()
+        self.pyramid_cache = LRUCache(2 * decoded_images_max_count, pyramid_cache_max_bytes,
+            lambda entry: sum([pixmap.width() * pixmap.height() * pixmap.depth() / 8 for pixmap in entry[1]]))
+
+        # Filtered main images, see ImageFilterWorker. Entries are
+        # (filepath, cache_key, params) -> pixmap, only the latest request is
+        # kept in the queue
+        self.filter_request_queue = Queue()
+        self.filtered_images = LRUCache(None, filtered_images_max_bytes,
+            lambda pixmap: pixmap.width() * pixmap.height() * pixmap.depth() / 8)
+        # Decoded image of the main pixmap as (cache_key, image) so filtering
+        # doesn't need to convert the pixmap back
+        self.decoded_image = None
+        # Filter parameters chosen by the user, the auto levels are combined
+        # with these, see requestFilter
+        self.filter_params = FILTER_IDENTITY
+        # Entries are filepath -> (gamma, levels), see compute_auto_levels
+        self.auto_levels = LRUCache(auto_levels_max_count)
+
+        # Lookups and stores go in different queues, see ThumbnailStoreWorker
+        self.thumbnail_lookup_queue = Queue()
+        self.thumbnail_store_queue = Queue()
+
+        # Partial decodes of the main image go in their own queue so they
+        # don't wait behind thumbnails and only the latest is kept, see
+        # receive_partial
+        self.partial_decoder_request_queue = Queue()
+        # Filepath of the partial image currently displayed, if any
+        self.partial_filepath = None
+        # Full resolution of the main image, the pixmap is smaller if it was
+        # decoded at screen resolution, see use_screen_resolution_decode
+        self.image_full_size = None
+
+        # Header probes, see FileProber. Entries are filepath -> probe dict or
+        # None if the probe failed
+        # mountpoint -> probe request queue, the probers are created per mount
+        # point as files are probed, see getProbeQueue
+        self.probe_request_queues = {}
+        self.probe_pending = set()
+        self.probed_files = LRUCache(probed_files_max_count)
         
         def receive_file(filepath, data):
             for thumbWidget in self.thumbWidgets:
@@ -1468,25 +4069,91 @@ class ImageViewer(QMainWindow):
             # Note this evicts and inserts even if the file is invalid, which 
             # is good since it won't try to fetch the file again. If the problem
             # is transient, the user can reload manually
-            if (len(self.cached_files) >= self.cached_files_max_count):
-                info("evicting %r for %r", self.cached_files[-1][0], filepath)
-                self.cached_files.pop(-1)
             info("inserting in cache %r", filepath)
-            self.cached_files.insert(0, (filepath, data))
+            self.uncacheFile(filepath)
+            self.cached_files.put(filepath, data)
             info("inserted in cache %r", filepath)
             if (self.image_filepath == filepath):
                 self.updateImageData(filepath, None, data)
+
+            else:
+                self.requestNeighbourDecodes()
             
             self.updateThumbnails()
             self.updateStatus()
 
-        def receive_image(filepath, pixmap, imageWidget):
-            info("Receiving pixmap %r", filepath)
+        def receive_progress(filepath, progress):
+            bytes_read, bytes_total = progress
+            if ((filepath == self.image_filepath) and 
+                (self.imageWidget.image_state == IMAGE_STATE_LOADING)):
+                self.showMessage("Loading... %d%% (%s / %s)" % (
+                    (bytes_read * 100) / max(1, bytes_total),
+                    size_to_human_friendly_units(bytes_read),
+                    size_to_human_friendly_units(bytes_total)
+                ))
+
+        def receive_partial(filepath, payload):
+            file_data, bytes_total = payload
+            if ((filepath != self.image_filepath) or 
+                (self.imageWidget.image_state != IMAGE_STATE_LOADING)):
+                return
+
+            info("Requesting partial decode %r %d/%d", filepath, len(file_data), bytes_total)
+            # Decode at screen resolution like the full image. The reader is
+            # created in the decoder thread so the size is not known here, use
+            # the probed size if available so small images are not enlarged,
+            # otherwise fit to the image widget
+            # XXX The fallback doesn't cover the widget when fitting to the
+            #     smallest side, but it's only shown until the full image is
+            #     decoded
+            scale = None
+            if (use_screen_resolution_decode):
+                orientation = self.getOrientation(filepath)
+                probe = self.probed_files.peek(filepath)
+                if ((probe is not None) and probe["size"].isValid()):
+                    size = probe["size"]
+                    decode_size = self.getScreenDecodeSize(size, orientation=orientation)
+                    if ((probe["frame_count"] <= 1) and (decode_size != size)):
+                        scale = decode_size
+
+                else:
+                    scale = self.imageWidget.size() * screen_decode_headroom
+                    if (self.imageWidget.isTransposed(orientation)):
+                        scale.transpose()
+
+            # Only the most complete data is worth decoding
+            self.partial_decoder_request_queue.clear()
+            self.partial_decoder_request_queue.put((filepath, (file_data, self.imageWidget, scale, None)))
+
+        def receive_partial_image(filepath, payload):
+            image, imageWidget, _ = payload
+            # Ignore if the main image changed or the full file was fetched in
+            # the meantime
+            if ((filepath != self.image_filepath) or 
+                (imageWidget.image_state != IMAGE_STATE_LOADING) or 
+                image.isNull()):
+                info("Ignoring partial image %r", filepath)
+                close_image_mapping(image)
+                return
+
+            info("Displaying partial image %r", filepath)
+            self.partial_filepath = filepath
+            pixmap = QPixmap.fromImage(image)
+            close_image_mapping(image)
+            imageWidget.setPixmap(pixmap, self.getOrientation(filepath))
+            self.updateImage()
+
+        def receive_image(filepath, image, full_size, imageWidget):
+            info("Receiving image %r", filepath)
 
             if (filepath != self.image_filepath):
                 info("Main image changed after decoding, ignoring %r vs. %r", filepath, self.image_filepath)
                 return
 
+            # The image is already in the display format, this is the only
+            # conversion done in the GUI thread
+            pixmap = QPixmap.fromImage(image)
+
             self.clearMessage()
             info("Decoded %r %dx%d", filepath, pixmap.width(), pixmap.height())
         
@@ -1500,10 +4167,23 @@ class ImageViewer(QMainWindow):
                 QMessageBox.information(self, "Image Viewer",
                     "Invalid image file %s." % filepath)
                 pixmap = self.errorPixmap
+                full_size = None
                 
+            elif (self.animation_count == 1):
+                # Animated images are not cached since the cache only holds
+                # one frame
+                self.decoded_images.put(filepath, (pixmap, full_size))
+            self.image_full_size = full_size
+
             # XXX Is this image to pixmap to setpixmap redundant? should we use image?
             #     or pixmap?
-            self.imageWidget.setPixmap(pixmap)
+            self.imageWidget.setPixmap(pixmap, 
+                1 if (pixmap is self.errorPixmap) else self.getOrientation(filepath))
+            if (pixmap is not self.errorPixmap):
+                self.decoded_image = (pixmap.cacheKey(), image)
+            # XXX Filtered animation frames arrive after the next frame is
+            #     displayed, so animations show unfiltered
+            self.requestFilter()
 
             if ((self.animation_timer is not None) and (self.animationAct.isChecked())):
                 new_report_time = time.time()
@@ -1513,27 +4193,163 @@ class ImageViewer(QMainWindow):
             self.updateImage()
             self.updateStatus()
             self.updateActions()
+            # The window may have changed while decoding at reduced size
+            self.checkDecodeSize()
 
-        def receive_thumbnail(filepath, pixmap, thumbWidget):
-            info("Receiving pixmap %r", filepath)
+        def receive_thumbnail(filepath, image, thumbWidget):
+            info("Receiving image %r", filepath)
             
             # Ignore if this thumbnail no longer shows this filepath,
             # leave whatever state
             if (thumbWidget.image_filepath != filepath):
+                close_image_mapping(image)
                 return
 
+            pixmap = QPixmap.fromImage(image)
+
             thumbWidget.image_state = IMAGE_STATE_DECODED
+            file_stat = None if (thumbWidget.image_data is None) else thumbWidget.image_data[1]
             if (pixmap.isNull()):
                 pixmap = self.errorPixmap
-            thumbWidget.setPixmap(pixmap)
+
+            if ((pixmap is not self.errorPixmap) and use_thumbnail_store and (file_stat is not None)):
+                # The PNG encoding and writing happens in the store worker,
+                # which closes the image
+                self.thumbnail_store_queue.put((filepath, file_stat, image))
+
+            else:
+                close_image_mapping(image)
+
+            thumbWidget.setText(None)
+            thumbWidget.setPixmap(pixmap, 
+                1 if (pixmap is self.errorPixmap) else self.getOrientation(filepath))
             thumbWidget.resizePixmap(thumbWidget.size())
 
+        def receive_stored_thumbnail(filepath, payload):
+            image, filestat = payload
+            info("Receiving stored thumbnail %r found %s", filepath, image is not None)
+
+            lookup_missed = False
+            for thumbWidget in self.thumbWidgets:
+                # Ignore if this thumbnail no longer shows this filepath or it
+                # was already loaded by other means (eg prefetched)
+                if ((thumbWidget.image_filepath == filepath) and 
+                    (thumbWidget.image_state == IMAGE_STATE_LOOKUP)):
+                    if (image is None):
+                        # Not in the store, updateThumbnails will request the
+                        # file as usual
+                        thumbWidget.image_state = IMAGE_STATE_LOADING
+                        lookup_missed = True
+
+                    else:
+                        thumbWidget.image_state = IMAGE_STATE_DECODED
+                        thumbWidget.setText(None)
+                        thumbWidget.setPixmap(QPixmap.fromImage(image), self.getOrientation(filepath))
+                        thumbWidget.resizePixmap(thumbWidget.size())
+
+            if (lookup_missed):
+                self.updateThumbnails()
+
+        def receive_probe(filepath, payload):
+            probe, = payload
+            info("Receiving probe %r", filepath)
+            self.probe_pending.discard(filepath)
+            self.probed_files.put(filepath, probe)
+
+            # Show the metadata on the placeholders until the thumbnail is
+            # decoded
+            text = self.getProbeText(filepath)
+            orientation = self.getOrientation(filepath)
+            for thumbWidget in self.thumbWidgets:
+                if (thumbWidget.image_filepath != filepath):
+                    continue
+
+                if (thumbWidget.image_state != IMAGE_STATE_DECODED):
+                    thumbWidget.setText(text)
+                    thumbWidget.resizePixmap(thumbWidget.size())
+
+                elif ((thumbWidget.originalPixmap is not self.errorPixmap) and 
+                    (thumbWidget.orientation != orientation)):
+                    # Thumbnails from the store or decoded before the probe
+                    # arrived didn't know the orientation
+                    thumbWidget.setOrientation(orientation)
+                    thumbWidget.resizePixmap(thumbWidget.size())
+
+            if (filepath == self.image_filepath):
+                if (((self.imageWidget.image_state == IMAGE_STATE_DECODED) or 
+                     (self.partial_filepath == filepath)) and 
+                    (self.imageWidget.originalPixmap is not self.errorPixmap) and 
+                    (self.imageWidget.orientation != orientation)):
+                    self.imageWidget.setOrientation(orientation)
+                    self.imageWidget.resizePixmap(self.imageWidget.size())
+                    self.checkDecodeSize()
+                self.updateStatus()
+
+        def receive_neighbour(filepath, pixmap, full_size):
+            info("Receiving neighbour pixmap %r", filepath)
+            self.decoded_pending.discard(filepath)
+            if (not pixmap.isNull()):
+                self.decoded_images.put(filepath, (pixmap, full_size))
+
+        def receive_filtered(filepath, payload):
+            cache_key, params, image = payload
+            info("Receiving filtered %r", filepath)
+            pixmap = QPixmap.fromImage(image)
+            if (isinstance(cache_key, tuple)):
+                # Composition of tiles, not cached since it's only valid for
+                # the current view. Redraw even if stale so the current
+                # composition is requested
+                self.tiles_filter_pending = False
+                if (filepath == self.image_filepath):
+                    self.imageWidget.setFilteredTiles(cache_key, params, pixmap)
+                    if (self.imageWidget.tiledImage is not None):
+                        self.imageWidget.resizePixmap(self.imageWidget.size())
+                return
+
+            self.filtered_images.put((filepath, cache_key, params), pixmap)
+            if ((filepath == self.image_filepath) and 
+                self.imageWidget.setFilteredPixmap(cache_key, params, pixmap)):
+                self.imageWidget.resizePixmap(self.imageWidget.size())
+                if (self.animation_count == 1):
+                    self.requestPyramid(filepath, pixmap, image)
+
+        def receive_auto_levels(filepath, payload):
+            info("Receiving auto levels %r %s", filepath, payload)
+            self.auto_levels.put(filepath, payload)
+            if (filepath == self.image_filepath):
+                self.requestFilter()
+                self.imageWidget.resizePixmap(self.imageWidget.size())
+                self.updateStatus()
+
+        def receive_pyramid(filepath, payload):
+            cache_key, images = payload
+            info("Receiving %d pyramid levels %r", len(images), filepath)
+            pixmaps = [QPixmap.fromImage(image) for image in images]
+            self.pyramid_cache.put((filepath, cache_key), (cache_key, pixmaps))
+            # No need to redraw, the current pixmap has the same contents
+            self.imageWidget.setPyramid(cache_key, pixmaps)
+
+        def receive_tile(filepath, pixmap, tile):
+            info("Receiving tile %r %d %d,%d", filepath, tile.level, tile.col, tile.row)
+            if (pixmap.isNull()):
+                warn("Unable to decode tile %r %d %d,%d", filepath, tile.level, tile.col, tile.row)
+            tiledImage = tile.tiledImage
+            tiledImage.receiveTile(tile, pixmap)
+            # Coalesce the redraws of tiles received together
+            if ((tiledImage is self.imageWidget.tiledImage) and (not self.tile_redraw_pending)):
+                self.tile_redraw_pending = True
+                QTimer.singleShot(0, self.redrawTiles)
+
         def receive_pixmap(filepath, payload):
-            pixmap, imageWidget = payload
+            image, imageWidget, full_size = payload
             if (imageWidget is self.imageWidget):
-                receive_image(filepath, pixmap, imageWidget)
+                receive_image(filepath, image, full_size, imageWidget)
+            elif (imageWidget is None):
+                receive_neighbour(filepath, QPixmap.fromImage(image), full_size)
+            elif (isinstance(imageWidget, ImageTile)):
+                receive_tile(filepath, QPixmap.fromImage(image), imageWidget)
             else:
-                receive_thumbnail(filepath, pixmap, imageWidget)
+                receive_thumbnail(filepath, image, imageWidget)
 
         # XXX To use a threadpool needs to be a qrunnable but qrunnables are not
         #     qobjects so they cannot send signals, so the qrunnable needs to
@@ -1542,18 +4358,70 @@ class ImageViewer(QMainWindow):
         # QThreadPool.globalInstance().start(t)
         # threads.append(t)
 
-        # Create prefetcher threads and pool them via the prefetch_request_queue
-        for i in xrange(self.prefetcher_count):
-            info("Creating file fetcher %d", i)
-            t = FileFetcher(self.prefetch_request_queue, self)
+        proxy_store = None
+        if (use_local_proxy_cache):
+            dirpath = local_proxy_cache_dirpath
+            if (dirpath is None):
+                dirpath = os.path.join(
+                    QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation),
+                    "imageviewer", "proxies")
+            info("Using local proxy cache %r", dirpath)
+            proxy_store = DiskCache(dirpath, local_proxy_cache_max_bytes)
+
+        # Prefetcher threads are created per mount point as files are
+        # requested, see FetcherLanes
+        def connect_fetcher(t):
             t.fileFetched.connect(receive_file)
-            t.start()
+            t.fileProgress.connect(receive_progress)
+            t.filePartial.connect(receive_partial)
+
+        self.fetcher_lanes = FetcherLanes(proxy_store, self.pipeline_states, connect_fetcher, self)
+
+        timer = QTimer(self)
+        timer.timeout.connect(self.fetcher_lanes.checkTimeouts)
+        timer.start(1000)
+        self.fetch_timeout_timer = timer
 
         # Create decoder threads and pool them via the decoder_request_queue
         for i in xrange(self.decoder_count):
             info("Creating pixmap decoder %d", i)
-            t = PixmapReader(self.decoder_request_queue, self)
-            t.pixmapReady.connect(receive_pixmap)
+            t = PixmapReader(self.decoder_request_queue, self.pipeline_states, self)
+            t.imageReady.connect(receive_pixmap)
+            t.start()
+
+        info("Creating partial pixmap decoder")
+        t = PixmapReader(self.partial_decoder_request_queue, None, self)
+        t.imageReady.connect(receive_partial_image)
+        t.start()
+
+        info("Creating pyramid builder")
+        t = PyramidBuilder(self.pyramid_request_queue, self)
+        t.pyramidReady.connect(receive_pyramid)
+        t.start()
+
+        info("Creating image filter worker")
+        t = ImageFilterWorker(self.filter_request_queue, self)
+        t.imageFiltered.connect(receive_filtered)
+        t.autoLevelsComputed.connect(receive_auto_levels)
+        t.start()
+
+        # Probers are created per mount point as files are probed, see
+        # getProbeQueue
+        def connect_prober(t):
+            t.fileProbed.connect(receive_probe)
+
+        self.connect_prober = connect_prober
+
+        if (use_thumbnail_store):
+            dirpath = os.path.join(
+                QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation),
+                "imageviewer", "thumbnails")
+            info("Using thumbnail store %r", dirpath)
+            store = DiskCache(dirpath, thumbnail_store_max_bytes, ".png")
+            t = ThumbnailStoreWorker(store, self.thumbnail_lookup_queue, self)
+            t.thumbnailLookedUp.connect(receive_stored_thumbnail)
+            t.start()
+            t = ThumbnailStoreWorker(store, self.thumbnail_store_queue, self)
             t.start()
 
         w = QWidget(self)
@@ -1576,6 +4444,8 @@ class ImageViewer(QMainWindow):
         # gridlayout is added directly to the parent
         w.setLayout(gl)
         self.thumbWidgets = []
+        # filepath -> list of thumbWidgets, see getThumbWidgets
+        self.thumb_widgets_by_filepath = {}
         for i in xrange(self.thumbnails_per_page):
             col = i % self.thumbnail_columns
             row = i / self.thumbnail_columns
@@ -1674,45 +4544,533 @@ class ImageViewer(QMainWindow):
         info("clearRequests")
 
         info("Clearing requests")
-        entries = self.prefetch_request_queue.clear()
-        self.prefetch_pending -= set(entries)
+        entries = self.fetcher_lanes.clear()
+        # Also abort the fetches in flight so they don't compete for bandwidth
+        entries.extend(self.cancelFetches())
         info("removing %d stale prefetch requests", len(entries))
-        # XXX This could just set all pending thumbWidgets to INIT? (but may be
-        #     too conservative for files that were read just before clearing?)
-        entries = set(entries)
-        for thumbWidget in self.thumbWidgets:
-            if ((thumbWidget.image_filepath in entries) and 
-                (thumbWidget.image_state == IMAGE_STATE_LOADING)):
-                thumbWidget.image_state = IMAGE_STATE_INIT
+        self.cancelledFetches(entries)
                     
-        entries =[fp for (fp, payload) in self.decoder_request_queue.clear()]
+        entries = []
+        for filepath, (file_data, imageWidget, scale, reader) in self.decoder_request_queue.clear():
+            release_file_data(file_data)
+            if (isinstance(imageWidget, ImageTile)):
+                imageWidget.tiledImage.cancelTile(imageWidget)
+            else:
+                entries.append(filepath)
         info("removing %d stale decode requests", len(entries))
-        entries = set(entries)
-        for thumbWidget in self.thumbWidgets:
-            if ((thumbWidget.image_filepath in entries) and 
-                (thumbWidget.image_state == IMAGE_STATE_DECODING)):
-                thumbWidget.image_state = IMAGE_STATE_LOADED
+        self.decoded_pending -= set(entries)
+        for filepath in entries:
+            self.pipeline_states.set(filepath, FILE_STATE_FETCHED)
+        self.resetThumbnailStates(entries, IMAGE_STATE_DECODING, IMAGE_STATE_LOADED)
+
+        self.clearThumbnailLookups()
+
+        self.partial_decoder_request_queue.clear()
+
+        for request_queue in self.probe_request_queues.itervalues():
+            entries = request_queue.clear()
+            info("removing %d stale probe requests", len(entries))
+            self.probe_pending -= set(entries)
         info("Cleared requests")
+
+    def cancelFetches(self, keep_filepath=None):
+        """
+        Cancel the fetches in flight, except for keep_filepath.
+
+        The cancelled fetches are not emitted, so the caller must remove them
+        from prefetch_pending and fix up the thumbnail states as if they had
+        been removed from the request queue.
+
+        @return list of cancelled filepaths
+        """
+        cancelled = self.fetcher_lanes.cancel(keep_filepath)
+        info("cancelled %d fetches in flight", len(cancelled))
+        
+        return cancelled
+
+    def clearThumbnailLookups(self):
+        entries = [fp for (fp, filestat, image) in self.thumbnail_lookup_queue.clear()]
+        info("removing %d stale thumbnail lookups", len(entries))
+        self.resetThumbnailStates(entries, IMAGE_STATE_LOOKUP, IMAGE_STATE_INIT)
+
+    def cancelledFetches(self, filepaths):
+        """
+        Update the pending set, the pipeline states and the thumbnail states
+        for fetches removed from the queues or cancelled in flight
+        """
+        self.prefetch_pending -= set(filepaths)
+        for filepath in filepaths:
+            self.pipeline_states.remove(filepath)
+        self.resetThumbnailStates(filepaths, IMAGE_STATE_LOADING, IMAGE_STATE_INIT)
+
+    def getThumbWidgets(self, filepath):
+        """
+        @return list of thumbWidgets currently showing filepath
+        """
+        return [thumbWidget for thumbWidget in self.thumb_widgets_by_filepath.get(filepath, []) 
+            if (thumbWidget.image_filepath == filepath)]
+
+    def resetThumbnailStates(self, filepaths, from_state, to_state):
+        """
+        Set the state of the thumbWidgets showing filepaths to to_state if
+        they are in from_state
+        """
+        for filepath in filepaths:
+            for thumbWidget in self.getThumbWidgets(filepath):
+                if (thumbWidget.image_state == from_state):
+                    thumbWidget.image_state = to_state
+
+    def uncacheFile(self, filepath):
+        """
+        Remove filepath from the file cache, unmapping it if not in use, see
+        SharedMapping
+
+        @return the removed entry or None if not cached
+        """
+        data = self.cached_files.remove(filepath)
+        if (data is not None):
+            uncache_file_data(data[0])
+        return data
+
+    def cancelledDecode(self, payload):
+        """
+        Release the file data of a decode request removed from the queue, see
+        requestDecode
+        """
+        release_file_data(payload[0])
+
+    def requestDecode(self, filepath, file_data, imageWidget, scale, reader, priority):
+        """
+        Queue decoding filepath for imageWidget, or for the decoded cache if
+        imageWidget is None, see PixmapReader. 
         
+        The request holds a use of file_data, released by PixmapReader once
+        decoded or by cancelledDecode if removed from the queue.
+
+        @return False if file_data was already unmapped, the caller needs to
+                fetch the file again
+        """
+        if (not acquire_file_data(file_data)):
+            info("Not decoding %r, file data already unmapped", filepath)
+            return False
+        self.pipeline_states.set(filepath, FILE_STATE_DECODE_QUEUED)
+        replaced = self.decoder_request_queue.put((filepath, (file_data, imageWidget, scale, reader)), 
+            priority, (filepath, imageWidget))
+        if (replaced is not None):
+            self.cancelledDecode(replaced[1])
+        return True
+
+    def getScreenDecodeSize(self, size, headroom=screen_decode_headroom, orientation=None):
+        """
+        @param orientation EXIF orientation of the image, None for the one
+               currently displayed
+        @return size to decode an image of the given full size at so it covers
+                the image widget times the headroom with the current fit and
+                rotation, or size if the full resolution is needed
+        """
+        widget_size = self.imageWidget.size()
+        if (self.imageWidget.isTransposed(orientation)):
+            widget_size.transpose()
+        decode_size = size.scaled(widget_size * headroom, 
+            Qt.KeepAspectRatioByExpanding if (self.imageWidget.fitToSmallest) else Qt.KeepAspectRatio)
+        if ((not size.isValid()) or (decode_size.width() >= size.width()) or 
+            (decode_size.height() >= size.height())):
+            return size
+
+        return decode_size
+
+    def getOrientation(self, filepath):
+        """
+        @return the EXIF orientation of filepath from the probe or from the
+                cached file header, 1 if unknown or use_exif_orientation is
+                disabled, see parse_exif
+        """
+        if (not use_exif_orientation):
+            return 1
+
+        probe = self.probed_files.peek(filepath)
+        if (probe is not None):
+            return probe["orientation"]
+
+        data = self.cached_files.peek(filepath)
+        if ((data is None) or (data[0] is None)):
+            return 1
+
+        # Note slicing also works for mmapped files
+        return parse_exif(data[0][:probe_size_bytes]).get("orientation", 1)
+
+    def setScreenDecodeSize(self, filepath, reader):
+        """
+        Have reader decode at screen resolution if the image is larger, see
+        use_screen_resolution_decode
+        """
+        if ((not use_screen_resolution_decode) or (reader.imageCount() > 1)):
+            return
+
+        size = reader.size()
+        decode_size = self.getScreenDecodeSize(size, orientation=self.getOrientation(filepath))
+        if (decode_size != size):
+            info("Decoding %r at screen resolution %dx%d instead of %dx%d", filepath,
+                decode_size.width(), decode_size.height(), size.width(), size.height())
+            reader.setScaledSize(decode_size)
+
+    def checkDecodeSize(self):
+        """
+        Decode the main image again at the new screen resolution if it was
+        decoded at a reduced resolution and the image widget now needs more
+        pixels, eg after enlarging the window, fitting to the smallest side or
+        rotating. Images of at least tiled_min_pixels are rendered from tiles
+        instead
+        """
+        full_size = self.image_full_size
+        pixmap = self.imageWidget.originalPixmap
+        if ((self.imageWidget.image_state != IMAGE_STATE_DECODED) or 
+            (full_size is None) or (not full_size.isValid()) or 
+            (pixmap.width() >= full_size.width())):
+            return
+
+        needed_size = self.getScreenDecodeSize(full_size, 1.0)
+        if ((needed_size.width() <= pixmap.width()) and 
+            (needed_size.height() <= pixmap.height())):
+            if (self.imageWidget.tiledImage is not None):
+                info("Rendering %r without tiles", self.image_filepath)
+                self.imageWidget.setTiledImage(None)
+                self.imageWidget.resizePixmap(self.imageWidget.size())
+            return
+
+        if (self.imageWidget.tiledImage is not None):
+            # Tiles are rendered at whatever resolution is needed
+            return
+
+        filepath = self.image_filepath
+        data = self.cached_files.peek(filepath)
+        if ((data is None) or (data[0] is None)):
+            # XXX Fetch it again?
+            info("Not decoding %r at full resolution, file no longer cached", filepath)
+            return
+
+        file_data, file_stat = data
+        reader = qThreadSafeImageReader(qImageDevice(file_data))
+        # Formats that can't decode clip rects would decode the whole image
+        # for every tile
+        if (use_tiled_rendering and 
+            (full_size.width() * full_size.height() >= tiled_min_pixels) and
+            reader.supportsOption(QImageIOHandler.ClipRect)):
+            info("Rendering %r from tiles", filepath)
+            self.imageWidget.setTiledImage(TiledImage(filepath, file_data, full_size, 
+                self.tile_cache, self.requestTile, self.requestTilesFilter))
+            self.imageWidget.resizePixmap(self.imageWidget.size())
+            self.updateStatus()
+            return
+
+        # Decode with headroom again so small enlargements don't need another
+        # decode, this is the full resolution if the widget is close to it
+        decode_size = self.getScreenDecodeSize(full_size)
+        if (decode_size != full_size):
+            reader.setScaledSize(decode_size)
+        info("Decoding %r at %dx%d of %dx%d", filepath, decode_size.width(), decode_size.height(),
+            full_size.width(), full_size.height())
+        # Keep showing the reduced pixmap while decoding
+        self.showMessage("Decoding...")
+        self.imageWidget.image_state = IMAGE_STATE_DECODING
+        self.requestDecode(filepath, file_data, self.imageWidget, None, reader, PRIORITY_MAIN)
+
+    def requestPyramid(self, filepath, pixmap, image=None):
+        """
+        Set the pyramid of the main image pixmap from the cache or request
+        building it, see PyramidBuilder
+
+        @param image the image the pixmap was created from or None to convert
+               the pixmap
+        """
+        if (not use_pyramids):
+            return
+
+        # Keyed by cache key too so the pyramids of the unfiltered and the
+        # filtered pixmaps don't evict each other
+        entry = self.pyramid_cache.get((filepath, pixmap.cacheKey()))
+        if (entry is not None):
+            self.imageWidget.setPyramid(*entry)
+            return
+
+        if ((pixmap.width() / 2 < pyramid_min_size_px) or (pixmap.height() / 2 < pyramid_min_size_px)):
+            return
+
+        info("Requesting pyramid %r", filepath)
+        if (image is None):
+            # XXX This is a copy in the GUI thread, keep the images in the
+            #     decoded cache?
+            image = pixmap.toImage()
+        # Only the pyramid of the current image is worth building
+        self.pyramid_request_queue.clear()
+        self.pyramid_request_queue.put((filepath, (pixmap.cacheKey(), image)))
+
+    def requestFilter(self):
+        """
+        Set the filtered main pixmap from the cache or request filtering it,
+        and the pyramid of the pixmap displayed, see ImageFilterWorker.
+        Caller needs to call resizePixmap to update
+        """
+        pixmap = self.imageWidget.originalPixmap
+        if ((pixmap is None) or (pixmap is self.errorPixmap) or 
+            (self.imageWidget.image_state != IMAGE_STATE_DECODED)):
+            return
+
+        filepath = self.image_filepath
+        cache_key = pixmap.cacheKey()
+        image = None
+        if ((self.decoded_image is not None) and (self.decoded_image[0] == cache_key)):
+            image = self.decoded_image[1]
+
+        params = self.filter_params
+        if (self.autoLevelsAct.isChecked()):
+            auto_levels = self.auto_levels.get(filepath)
+            if (auto_levels is None):
+                if (image is None):
+                    # XXX This is a copy in the GUI thread, keep the images in
+                    #     the decoded cache?
+                    image = pixmap.toImage()
+                info("Requesting auto levels %r", filepath)
+                # Keep the current filtering until the auto levels are
+                # computed, see receive_auto_levels
+                self.filter_request_queue.clear()
+                self.tiles_filter_pending = False
+                self.filter_request_queue.put((filepath, (cache_key, image, None)))
+                return
+
+            # Gammas combine multiplying them
+            auto_gamma, levels = auto_levels
+            params = (round(params[0] * auto_gamma, 3), params[1], params[2], levels)
+
+        self.imageWidget.setFilterParams(params)
+
+        if (params == FILTER_IDENTITY):
+            if (self.animation_count == 1):
+                self.requestPyramid(filepath, pixmap, image)
+            return
+
+        filtered_pixmap = self.filtered_images.get((filepath, cache_key, params))
+        if (filtered_pixmap is not None):
+            self.imageWidget.setFilteredPixmap(cache_key, params, filtered_pixmap)
+            if (self.animation_count == 1):
+                self.requestPyramid(filepath, filtered_pixmap)
+            return
+
+        if (image is None):
+            # XXX This is a copy in the GUI thread, keep the images in the
+            #     decoded cache?
+            image = pixmap.toImage()
+
+        info("Requesting filter %r %s", filepath, params)
+        # Only the current image and parameters are worth filtering
+        self.filter_request_queue.clear()
+        self.tiles_filter_pending = False
+        self.filter_request_queue.put((filepath, (cache_key, image, params)))
+
+    def setFilterParams(self, gamma=None, brightness=None, contrast=None):
+        """
+        Change the given filter parameters of the main image, keeping the rest
+        """
+        old_gamma, old_brightness, old_contrast, levels = self.filter_params
+        params = (
+            old_gamma if (gamma is None) else gamma,
+            old_brightness if (brightness is None) else max(-1.0, min(1.0, brightness)),
+            old_contrast if (contrast is None) else max(0.0, contrast),
+            levels
+        )
+        # Round so the steps don't accumulate errors and the parameters can be
+        # found in the cache
+        params = tuple([round(param, 3) for param in params[:3]]) + (levels,)
+        if (params == self.filter_params):
+            return
+
+        self.filter_params = params
+        self.requestFilter()
+        self.imageWidget.resizePixmap(self.imageWidget.size())
+        self.updateStatus()
+
+    def requestTile(self, tile, priority):
+        """
+        Queue decoding the tile or promote it if already queued, see TiledImage
+        """
+        tiledImage = tile.tiledImage
+        key = (tiledImage.filepath, tile)
+        if (key in self.decoder_request_queue):
+            self.decoder_request_queue.promote(key, priority)
+            return
+
+        if (tile.queued):
+            # Being decoded
+            return
+
+        tile.queued = True
+        rect = tiledImage.getTileRect(tile.level, tile.col, tile.row)
+        reader = qThreadSafeImageReader(qImageDevice(tiledImage.file_data))
+        reader.setClipRect(rect)
+        reader.setScaledSize(QSize(
+            max(1, (rect.width() + tile.level - 1) / tile.level), 
+            max(1, (rect.height() + tile.level - 1) / tile.level)
+        ))
+        # Not using requestDecode, tiles don't change the pipeline state of
+        # the file. The tiled image holds a use of the file data so this
+        # can't fail
+        acquire_file_data(tiledImage.file_data)
+        self.decoder_request_queue.put((tiledImage.filepath, (tiledImage.file_data, tile, None, reader)), 
+            priority, key)
+
+    def requestTilesFilter(self, cache_key, image, params):
+        """
+        Queue filtering a composition of tiles, see
+        ImageWidget.renderTiledPixmap. Only one composition is filtered at a
+        time, compositions requested meanwhile are dropped and the redraw when
+        the filtered one arrives requests the current one
+        """
+        if (self.tiles_filter_pending):
+            return
+
+        info("Requesting tiles filter %r %s", self.image_filepath, params)
+        self.tiles_filter_pending = True
+        self.filter_request_queue.put((self.image_filepath, (cache_key, image, params)))
+
+    def redrawTiles(self):
+        self.tile_redraw_pending = False
+        if (self.imageWidget.tiledImage is not None):
+            self.imageWidget.resizePixmap(self.imageWidget.size())
+
+    def updatePipelineStates(self):
+        """
+        Update the placeholders of the thumbnails whose file changed pipeline
+        state, see PipelineStates
+        """
+        dirty = self.pipeline_states.takeDirty()
+        info("updatePipelineStates %d dirty", len(dirty))
+        if ((not use_thumbnail_placeholders) or (not self.thumbnailsWidget.isVisible())):
+            return
+
+        for filepath in dirty:
+            for thumbWidget in self.getThumbWidgets(filepath):
+                pixmap = self.getPlaceholderPixmap(thumbWidget, filepath)
+                if ((pixmap is not None) and (pixmap is not thumbWidget.originalPixmap)):
+                    thumbWidget.setPixmap(pixmap)
+                    thumbWidget.resizePixmap(thumbWidget.size())
+
+    def getPlaceholderPixmap(self, thumbWidget, filepath):
+        """
+        @param filepath filepath the thumbWidget is showing, note this is
+               different from thumbWidget.image_filepath while updateThumbnails
+               is switching the thumbnail to a new filepath
+        @return the placeholder pixmap for the thumbWidget state or None if it
+                doesn't need one
+        """
+        state = self.pipeline_states.get(filepath)
+        if (thumbWidget.image_state == IMAGE_STATE_LOOKUP):
+            return self.queuedPixmap
+
+        elif (thumbWidget.image_state == IMAGE_STATE_LOADING):
+            return self.queuedPixmap if (state == FILE_STATE_QUEUED) else self.loadingPixmap
+
+        elif (thumbWidget.image_state == IMAGE_STATE_DECODING):
+            return self.queuedDecodingPixmap if (state == FILE_STATE_DECODE_QUEUED) else self.decodingPixmap
+
+        return None
 
     def clearQueues(self):
         info("clearQueues")
-        self.prefetch_request_queue.clear()
+        for filepath in self.fetcher_lanes.clear():
+            self.pipeline_states.remove(filepath)
         self.prefetch_pending.clear()
 
-        self.decoder_request_queue.clear()
+        for filepath, (file_data, imageWidget, scale, reader) in self.decoder_request_queue.clear():
+            release_file_data(file_data)
+            if (isinstance(imageWidget, ImageTile)):
+                imageWidget.tiledImage.cancelTile(imageWidget)
+            else:
+                self.pipeline_states.set(filepath, FILE_STATE_FETCHED)
+        self.decoded_pending.clear()
+
+        self.thumbnail_lookup_queue.clear()
+
+        self.partial_decoder_request_queue.clear()
+
+        for request_queue in self.probe_request_queues.itervalues():
+            request_queue.clear()
+        self.probe_pending.clear()
+
+    def getProbeQueue(self, filepath):
+        """
+        @return the probe request queue for the mount point of filepath,
+                creating the queue and its probers if necessary
+        """
+        mountpoint, fstype = os_path_mount(filepath)
+        request_queue = self.probe_request_queues.get(mountpoint, None)
+        if (request_queue is None):
+            info("Creating %d file probers for %r %s", prober_count, mountpoint, fstype)
+            request_queue = Queue()
+            for _ in xrange(prober_count):
+                t = FileProber(request_queue, self)
+                self.connect_prober(t)
+                t.start()
+            self.probe_request_queues[mountpoint] = request_queue
+
+        return request_queue
+
+    def requestProbe(self, filepath):
+        """
+        Request probing the file header if not already probed or pending, see
+        FileProber
+        """
+        if ((filepath not in self.probed_files) and (filepath not in self.probe_pending)):
+            info("Requesting probe %r", filepath)
+            self.probe_pending.add(filepath)
+            self.getProbeQueue(filepath).put(filepath)
+
+    def getProbeText(self, filepath):
+        """
+        @return text with the probed metadata to show on placeholders or None
+                if not probed yet
+        """
+        probe = self.probed_files.peek(filepath)
+        if (probe is None):
+            return None
+
+        # The size is invalid if the header was truncated or the format
+        # doesn't store it in the header
+        size = probe["size"]
+        text = probe["format"].upper()
+        if (size.isValid()):
+            text = "%d x %d\n%s" % (size.width(), size.height(), text)
+        if (probe["frame_count"] > 1):
+            text += " %d+ frames" % probe["frame_count"]
+        if (probe["datetime"] is not None):
+            text += "\n" + probe["datetime"].strftime("%Y-%m-%d %H:%M:%S")
+
+        return text
 
     def cleanup(self):
-        info("Signaling %d prefetchers to end", self.prefetcher_count)
-        for _ in xrange(self.prefetcher_count):
-            self.prefetch_request_queue.put(None)
-            # XXX Missing .wait the QThread, but they are not stored anywhere?
+        info("Signaling prefetchers to end")
+        self.fetch_timeout_timer.stop()
+        self.fetcher_lanes.shutdown()
         info("Signaled prefetchers")
-        info("Signaling %d decoders to end", self.prefetcher_count)
+        info("Signaling %d decoders to end", self.decoder_count)
         for _ in xrange(self.decoder_count):
             self.decoder_request_queue.put(None)
             # XXX Missing .wait the QThread, but they are not stored anywhere?
+        self.partial_decoder_request_queue.put(None)
+        self.pyramid_request_queue.put(None)
+        self.filter_request_queue.put(None)
+        if (g_decoder_pool is not None):
+            g_decoder_pool.close()
         info("Signaled decoders")
+        if (use_thumbnail_store):
+            info("Signaling thumbnail store workers to end")
+            self.thumbnail_lookup_queue.put(None)
+            self.thumbnail_store_queue.put(None)
+            info("Signaled thumbnail store workers")
+        info("Signaling %d probers to end", prober_count * len(self.probe_request_queues))
+        for request_queue in self.probe_request_queues.itervalues():
+            for _ in xrange(prober_count):
+                request_queue.put(None)
+        info("Signaled probers")
         
     def closeEvent(self, event):
         info("closeEvent")
@@ -1872,8 +5230,12 @@ class ImageViewer(QMainWindow):
         #     See https://www.qtcentre.org/threads/39887-QMimeData-using-setText-and-setUrls-at-the-same-time
 
 
-    def getDataFromCache(self, filepath, clear=False):
+    def getDataFromCache(self, filepath, demote=False, priority=PRIORITY_VISIBLE):
         """
+        @param demote demote the pending requests before requesting this one,
+               see demoteRequests
+        @param priority priority to request the file with if not in the cache,
+               or to promote the request to if already pending
         @return 
         - bytes if image in cache and didn't fail to load
         - None if image in cache and failed to load
@@ -1883,93 +5245,131 @@ class ImageViewer(QMainWindow):
         # XXX Qt already has QPixmapCache, look into it?
 
         # Get the file from the cache and bring it to the front if in the cache,
-        # request it and put it in the front otherwise
+        # request it with the given priority otherwise
 
-        # XXX Use a set/dict/ordereddict for this test
-        try:
-            filepaths = [entry_filepath for entry_filepath, entry_data in self.cached_files]
-            dbg("filepaths in cache %r", filepaths)
-            i = filepaths.index(filepath)
+        # Note the cache stores the (file_data, file_stat) tuple, so a failed
+        # load is stored as (None, None) and can be told apart from a miss
+        entry_data = self.cached_files.get(filepath)
+        if (entry_data is not None):
             info("cache hit for %r", filepath)
-            entry = self.cached_files[i]
-            entry_filepath, entry_data = entry
-            self.cached_files.pop(i)
-            # Put it at the beginning of the LRU cache
-            self.cached_files.insert(0, entry)
 
-        except ValueError:
+        else:
             info("cache miss for %r", filepath)
 
-            if (clear):
-                # Empty the request queues so:
-                # - this image request takes higher priority
-                # - stale prefetches around this image don't accumulate (ok
-                #   to discard because prefetch is restarted below)
-                # - stale thumbnail requests don't accumulate when moving across
-                #   thumbnail pages (ok to discard because updateThumbnails will
-                #   also re-request as needed) 
-
-                # XXX Additionally this could signal the prefetch threads to
-                #     abort the current transfers, but to do it efficiently, it
-                #     requires the prefetch threads to chunk the reads and check
-                #     on some flag
-
-                # XXX Should this happen even if there's a cache hit so stale
-                #     thumbnails are always removed?
-                
-                # XXX Inferring there are stale thumbnails/prefetches from the
-                #     block parameter is hacky and will probably break once
-                #     reading the main image is non-blocking, should probably be
-                #     moved elsewhere, in gotoImage, etc?
-
-                entries = self.prefetch_request_queue.clear()
-                info("removing %d stale prefetch requests", len(entries))
-                # Note clearing the prefetch_pending set here may cause the
-                # prefetch_pending set to get out of sync wrt
-                # prefetch_response_queue: a prefetch request may be serviced by
-                # the prefetch thread before it had the chance to be serviced in
-                # this thread and this thread will receive a stale prefetch
-                # without a corresponding item in the prefetch_pending set
-                # cleared here. This is ok since this thread .discards items
-                # from the set instead of .removing them, and .discard doesn't
-                # require the item to be in the set
-
-                # Only remove entries that were cleared, otherwise entries that
-                # are currently being downloaded could be downloaded twice
-                self.prefetch_pending -= set(entries)
-                # XXX Handling the thumbnail state here is not very clean, find
-                #     another place to do it?
-                # XXX This could just set all pending thumbWidgets to INIT? (but
-                #     may be too conservative for files that were read just
-                #     before clearing?)
-                entries = set(entries)
-                for thumbWidget in self.thumbWidgets:
-                    if ((thumbWidget.image_filepath in entries) and 
-                        (thumbWidget.image_state == IMAGE_STATE_LOADING)):
-                        thumbWidget.image_state = IMAGE_STATE_INIT
-                
-                entries =[fp for (fp, payload) in self.decoder_request_queue.clear()]
-                info("removing %d stale decode requests", len(entries))
-                entries = set(entries)
-                for thumbWidget in self.thumbWidgets:
-                    if ((thumbWidget.image_filepath in entries) and 
-                        (thumbWidget.image_state == IMAGE_STATE_DECODING)):
-                        thumbWidget.image_state = IMAGE_STATE_LOADED
+            # XXX Inferring there are stale thumbnails/prefetches from the
+            #     demote parameter is hacky, should probably be moved
+            #     elsewhere, in gotoImage, etc?
+            if (demote):
+                self.demoteRequests(filepath)
                     
             # The filepath is not in the cache, request if not already pending
             if (filepath not in self.prefetch_pending):
                 info("prefetch pending miss for %r", filepath)
                 info("ordering prefetch for %r", filepath)
-                self.prefetch_request_queue.put(filepath)
+                self.fetcher_lanes.put(filepath, priority)
                 self.prefetch_pending.add(filepath)
 
             else:
                 info("prefetch pending hit for %r", filepath)
+                # Note this does nothing if the request is in flight
+                self.fetcher_lanes.promote(filepath, priority)
 
             entry_data = False
 
         return entry_data
 
+    def demoteRequests(self, filepath):
+        """
+        Demote the pending fetch and decode requests when navigating to
+        filepath so:
+        - the filepath request takes higher priority
+        - stale prefetches and thumbnail requests don't accumulate, requests
+          that are still wanted are promoted by updateThumbnails and
+          gotoImage, requests that were already stale are cancelled, see
+          PriorityScheduler.demote
+        """
+        entries = self.fetcher_lanes.demote()
+        info("removing %d stale prefetch requests", len(entries))
+        self.cancelledFetches(entries)
+
+        # Abort stale fetches in flight so this request gets all the bandwidth,
+        # unless this filepath is already in flight. These are requeued as
+        # stale instead of dropped, so they are fetched later if still wanted
+        for cancelled_filepath in self.cancelFetches(filepath):
+            self.fetcher_lanes.put(cancelled_filepath, PRIORITY_STALE)
+
+        # Note removing from the prefetch_pending set here may cause the
+        # prefetch_pending set to get out of sync wrt the fetchers: a prefetch
+        # request may be serviced by the prefetch thread before it had the
+        # chance to be serviced in this thread and this thread will receive a
+        # stale prefetch without a corresponding item in the prefetch_pending
+        # set. This is ok since this thread .discards items from the set
+        # instead of .removing them, and .discard doesn't require the item to
+        # be in the set
+
+        # Only entries that were cancelled are removed, otherwise entries that
+        # are currently being downloaded could be downloaded twice
+
+        self.demoteDecodes()
+
+        self.clearThumbnailLookups()
+
+    def demoteDecodes(self):
+        """
+        Demote the pending decode requests and fix up the state of the
+        cancelled ones, see PriorityScheduler.demote
+        """
+        entries = self.decoder_request_queue.demote()
+        info("removing %d stale decode requests", len(entries))
+        for filepath, (file_data, imageWidget, scale, reader) in entries:
+            release_file_data(file_data)
+            if (isinstance(imageWidget, ImageTile)):
+                # Tiles don't change the pipeline state of the file
+                imageWidget.tiledImage.cancelTile(imageWidget)
+                continue
+
+            self.pipeline_states.set(filepath, FILE_STATE_FETCHED)
+            if (imageWidget is None):
+                self.decoded_pending.discard(filepath)
+
+            elif ((imageWidget is not self.imageWidget) and 
+                (imageWidget.image_filepath == filepath) and 
+                (imageWidget.image_state == IMAGE_STATE_DECODING)):
+                imageWidget.image_state = IMAGE_STATE_LOADED
+
+    def requestNeighbourDecodes(self):
+        """
+        Queue decoding the images around the current one that are already in
+        the file cache, so they are in the decoded cache when navigated to
+        """
+        filepaths = self.image_filepaths
+        if ((filepaths is None) or (len(filepaths) == 0)):
+            return
+
+        for delta in xrange(-decoded_images_neighbour_count, decoded_images_neighbour_count + 1):
+            filepath = filepaths[(self.image_index + delta) % len(filepaths)]
+            if ((delta == 0) or (filepath in self.decoded_images) or 
+                (filepath in self.decoded_pending)):
+                continue
+
+            data = self.cached_files.peek(filepath)
+            if ((data is None) or (data[0] is None)):
+                continue
+
+            file_data, file_stat = data
+            reader = qThreadSafeImageReader(qImageDevice(file_data))
+            if (reader.imageCount() > 1):
+                # Animations are not cached
+                continue
+            self.setScreenDecodeSize(filepath, reader)
+
+            info("Requesting neighbour decode %r", filepath)
+            self.decoded_pending.add(filepath)
+            # Pass the reader since it was already created to check for
+            # animations, a None imageWidget tells receive_pixmap to store
+            # the result in the decoded cache
+            self.requestDecode(filepath, file_data, None, None, reader, PRIORITY_PREFETCH)
+
     def updateThumbnails(self):
         info("updateThumbnails")
         if (not self.thumbnailsWidget.isVisible()):
@@ -2004,9 +5404,29 @@ class ImageViewer(QMainWindow):
             scaled_pixmap = thumbWidget.originalPixmap
             
             if (thumbWidget.image_filepath != filepath):
+                if (thumbWidget.image_state == IMAGE_STATE_DECODING):
+                    # Cancel the decode for the previous filepath, the fetches
+                    # are left alone since they go to the file cache
+                    entry = self.decoder_request_queue.cancel((thumbWidget.image_filepath, thumbWidget))
+                    if (entry is not None):
+                        self.cancelledDecode(entry[1])
+                        self.pipeline_states.set(thumbWidget.image_filepath, FILE_STATE_FETCHED)
                 thumbWidget.image_state = IMAGE_STATE_INIT
                 thumbWidget.image_data = None
             
+            # State switch from INIT to LOOKUP if the file is not already in
+            # the cache, the store worker will switch it to DECODED if found in
+            # the thumbnail store or to LOADING otherwise
+            if ((thumbWidget.image_state == IMAGE_STATE_INIT) and use_thumbnail_store and 
+                (filepath not in self.cached_files)):
+                info("Requesting stored thumbnail %r", filepath)
+                thumbWidget.image_state = IMAGE_STATE_LOOKUP
+                self.thumbnail_lookup_queue.put((filepath, None, None))
+
+            if (thumbWidget.image_state == IMAGE_STATE_LOOKUP):
+                if (use_thumbnail_placeholders):
+                    scaled_pixmap = self.queuedPixmap
+
             # State switch from INIT to LOADING, set the placeholder pixmap to
             # loading/queued if INIT or LOADING ,and state switch to LOADED if
             # done LOADING
@@ -2017,21 +5437,17 @@ class ImageViewer(QMainWindow):
                 #     if the prefetch count is improperly set wrt the number of
                 #     thumbnails. Does an LRU cache make any sense when the
                 #     cache is properly sized wrt thumbnails and prefetch?
+                # Note this also promotes the request if it was pending and
+                # demoted
                 entry = self.getDataFromCache(filepath)
-                # XXX Checking the internal queue member variable is not nice,
-                #     but it's only used for UI status and not worth doing
-                #     something thread-safe that is going to be racy anyway?
-                #     Note this doesn't trigger "deque mutated during iteration"
-                #     exception because "in" is atomic from GIL point of view
-                if (use_thumbnail_placeholders):
-                    scaled_pixmap = self.queuedPixmap if filepath in self.prefetch_request_queue.queue else self.loadingPixmap
-                
                 if (entry is False):
                     # Note there's no race condition here between getDataFromCache
                     # request finishing before this state is set, because the 
                     # state is only modified on this thread and this thread is
                     # still busy
                     thumbWidget.image_state = IMAGE_STATE_LOADING
+                    if (use_thumbnail_placeholders):
+                        scaled_pixmap = self.getPlaceholderPixmap(thumbWidget, filepath)
                     
                 else:
                     thumbWidget.image_state = IMAGE_STATE_LOADED
@@ -2052,25 +5468,44 @@ class ImageViewer(QMainWindow):
 
                 # This could use the thumbWidget.size() but then it
                 # needs refreshing when the splitter changes
-                # XXX Use screen DPI to calculate the best thumbnail size?
                 # Note it's ok for this request to race the setPixmap below
                 # since the response is handled in this thread so it's not racy
-                self.decoder_request_queue.put((filepath, (file_data, thumbWidget, QSize(150, 150), None)))
+                if (not self.requestDecode(filepath, file_data, thumbWidget, 
+                    QSize(thumbnail_size_px, thumbnail_size_px), None, PRIORITY_VISIBLE)):
+                    # The file was evicted and unmapped since it was stored
+                    # in image_data, fetch it again
+                    thumbWidget.image_state = IMAGE_STATE_INIT
+                    thumbWidget.image_data = None
+
+            elif (thumbWidget.image_state == IMAGE_STATE_DECODING):
+                # Promote in case it was demoted
+                self.decoder_request_queue.promote((filepath, thumbWidget), PRIORITY_VISIBLE)
 
             if (thumbWidget.image_state == IMAGE_STATE_DECODING):
-                # XXX Checking the internal queue member variable is not nice,
-                #     but it's only used for UI status and not worth doing
-                #     something thread-safe that is going to be racy anyway?
-                # XXX Without converting to list, this can return deque mutated
-                #     during iteration?
                 if (use_thumbnail_placeholders):
-                    q = list(self.decoder_request_queue.queue)
-                    scaled_pixmap = self.queuedDecodingPixmap if any([(filepath == fp) for (fp, payload) in q]) else self.decodingPixmap
+                    scaled_pixmap = self.getPlaceholderPixmap(thumbWidget, filepath)
+
+            # Show the probed metadata on the placeholder until decoded
+            if (thumbWidget.image_state == IMAGE_STATE_DECODED):
+                text = None
+                if (use_exif_orientation):
+                    # Thumbnails from the store need the probe for the
+                    # orientation, see receive_probe
+                    self.requestProbe(filepath)
+            else:
+                self.requestProbe(filepath)
+                text = self.getProbeText(filepath)
+            text_changed = (text != thumbWidget.text)
+            if (text_changed):
+                thumbWidget.setText(text)
 
             # Don't cause continuous bitmap setting if already set
-            if (scaled_pixmap is not thumbWidget.originalPixmap):
+            if ((scaled_pixmap is not thumbWidget.originalPixmap) or 
+                (text_changed and (scaled_pixmap is not None))):
                 info("Setting thumbnail %r", filepath)
-                thumbWidget.setPixmap(scaled_pixmap)
+                # Keep the orientation if only the text changed
+                thumbWidget.setPixmap(scaled_pixmap, thumbWidget.orientation 
+                    if (scaled_pixmap is thumbWidget.originalPixmap) else 1)
                 # XXX Can the grid be updated instead of each individual imagewidget?
                 thumbWidget.resizePixmap(thumbWidget.size())
                 
@@ -2088,6 +5523,11 @@ class ImageViewer(QMainWindow):
 
             thumbWidget.image_filepath = filepath
         
+        # Index the thumbnails by filepath, see getThumbWidgets
+        self.thumb_widgets_by_filepath = {}
+        for thumbWidget in self.thumbWidgets[:len(filepaths)]:
+            self.thumb_widgets_by_filepath.setdefault(thumbWidget.image_filepath, []).append(thumbWidget)
+
         # Set all unused thumbnail slots to empty
         for i in xrange(len(self.thumbWidgets)-len(filepaths)):
             thumbWidget = self.thumbWidgets[len(filepaths)+i]
@@ -2172,11 +5612,39 @@ class ImageViewer(QMainWindow):
 
         self.image_filepath = filepath
         self.imageWidget.image_state = IMAGE_STATE_INIT
+        self.partial_filepath = None
+        if (frame is None):
+            self.image_full_size = None
+
+        # Animation frames are never in the decoded cache, don't bother
+        entry = None if (frame is not None) else self.decoded_images.get(filepath)
+        if (entry is not None):
+            info("decoded cache hit for %r", filepath)
+            pixmap, self.image_full_size = entry
+            if (self.animation_reader is not None):
+                self.cleanupAnimation()
+            self.clearMessage()
+            self.imageWidget.image_state = IMAGE_STATE_DECODED
+            self.imageWidget.setPixmap(pixmap, self.getOrientation(filepath))
+            self.requestFilter()
+            self.updateImage()
+            self.updateThumbnails()
+            self.updateStatus()
+            self.updateActions()
+            # The pixmap may have been decoded for a smaller window
+            self.checkDecodeSize()
+            return
 
         info("Caching %r", filepath)
         self.showMessage("Loading...")
         self.imageWidget.image_state = IMAGE_STATE_LOADING
-        data = self.getDataFromCache(filepath, clear=True)
+        # Have the fetchers stream this file if it's large, including if it's
+        # already being prefetched
+        self.fetcher_lanes.setStreamFilepath(filepath)
+        # Probe the header so the status bar shows the metadata before the
+        # whole file is loaded
+        self.requestProbe(filepath)
+        data = self.getDataFromCache(filepath, demote=True, priority=PRIORITY_MAIN)
         
         # XXX Unify the path so it always goes through the FileFetcher thread
         #     even if the data is in the cache?
@@ -2192,6 +5660,17 @@ class ImageViewer(QMainWindow):
 
         self.updateStatus()
 
+    def cleanupAnimation(self):
+        info("Cleaning up animation machinery")
+        self.animation_reader = None
+        release_file_data(self.animation_file_data)
+        self.animation_file_data = None
+        if (self.animationAct.isChecked()):
+            self.animation_timer.stop()
+        self.animation_timer = None
+        self.animation_count = 1
+        self.animation_frame = 0
+
     def updateImageData(self, filepath, frame, data):
         info("updateImageData %r", filepath)
         if (data is None):
@@ -2200,9 +5679,10 @@ class ImageViewer(QMainWindow):
             pixmap = self.errorPixmap
             
         else:
-            if (use_image_placeholders):
+            if (use_image_placeholders and (self.partial_filepath != filepath)):
                 pixmap = self.decodingPixmap
             else:
+                # Keep showing the partial image while decoding the full one
                 pixmap = self.imageWidget.originalPixmap
             file_data, file_stat = data
 
@@ -2232,19 +5712,12 @@ class ImageViewer(QMainWindow):
                 # 1) It's a new file
                 # 2) It requested an out of order frame (including the first frame)
                 info("Using new reader for %d bytes", len(file_data))
-                buffer = QBuffer()
-                buffer.setData(file_data)
-                reader = qThreadSafeImageReader(buffer)
+                reader = qThreadSafeImageReader(qImageDevice(file_data))
                 info("Created reader %r", reader)
-                # XXX Missing rotating images using the EXIF information
-                #     QImageReader.setAutoTransform is Qt 5.5, but 5.3.1 is the
-                #     one on pip Windows 10 
-                #     See https://stackoverflow.com/questions/15123340/qimage-loads-with-wrong-orientation-for-certain-images
-                #     Install from git instead of pip which has Qt 5.7.1? 
-                #     See https://github.com/pyqt/python-qt5
-                #     XP from Anaconda has Qt 5.6 and Linux from apt has Qt 5.11 
-                # XXX Or use pillow
-                # XXX Or use native (see chatgpt: APP1 marker, orientation tag 0x0112)
+                # The EXIF orientation is not applied when decoding
+                # (QImageReader.setAutoTransform is Qt 5.5, but 5.3.1 is the
+                # one on pip Windows 10) but when displaying, see
+                # ImageWidget.getTransform
 
                 if (reader.imageCount() > 1):
                     # XXX Get other from reader.loopCount(), reader.nextImageDelay()
@@ -2265,6 +5738,12 @@ class ImageViewer(QMainWindow):
                     self.animation_frame = 0
                     self.animation_count = reader.imageCount()
                     self.animation_reader = reader
+                    # The reader is kept across frames, hold the file data
+                    # in case it's evicted from the file cache meanwhile
+                    if (self.animation_file_data is not file_data):
+                        release_file_data(self.animation_file_data)
+                        acquire_file_data(file_data)
+                        self.animation_file_data = file_data
                     
                     if (frame is not None):
                         # This is a non-sequential frame, advance as many frames
@@ -2279,14 +5758,10 @@ class ImageViewer(QMainWindow):
                 elif (self.animation_reader is not None):
                     # No animations in this image but the previous image had,
                     # cleanup animation machinery
-                    info("Cleaning up animation machinery")
                     assert frame is None
-                    self.animation_reader = None
-                    if (self.animationAct.isChecked()):
-                        self.animation_timer.stop()
-                    self.animation_timer = None
-                    self.animation_count = 1
-                    self.animation_frame = 0
+                    self.cleanupAnimation()
+
+                self.setScreenDecodeSize(filepath, reader)
             
             else:
                 info("Recycling reader %r", self.animation_reader)
@@ -2313,21 +5788,16 @@ class ImageViewer(QMainWindow):
             # Reading takes the most time, especially for svg, queue on a QT
             # thread (verified it releases the GIL)
             
-            # XXX This is replicated in getDataFromCache, refactor?
-            entries =[fp for (fp, payload) in self.decoder_request_queue.clear()]
-            info("removing ~%d stale decode requests", len(entries))
-            entries = set(entries)
-            for thumbWidget in self.thumbWidgets:
-                if ((thumbWidget.image_filepath in entries) and 
-                    (thumbWidget.image_state == IMAGE_STATE_DECODING)):
-                    thumbWidget.image_state = IMAGE_STATE_LOADED
+            # Animation frames don't need to demote, there are no other
+            # requests to compete with
+            if (frame is None):
+                self.demoteDecodes()
 
             self.animation_frame = frame or 0
             self.imageWidget.image_state = IMAGE_STATE_DECODING
-            self.decoder_request_queue.put((filepath, (file_data, self.imageWidget, None, reader)))
+            self.requestDecode(filepath, file_data, self.imageWidget, None, reader, PRIORITY_MAIN)
 
-            # Pending thumbnails have been removed from the decoder queue,
-            # refresh
+            # Pending thumbnails have been demoted or cancelled, refresh
             self.updateThumbnails()
 
         
@@ -2375,21 +5845,32 @@ class ImageViewer(QMainWindow):
         #     state and show ?? instead?
         orig_pixmap = self.imageWidget.originalPixmap
         orig_pixmap_size = orig_pixmap.size()
-        pixmap_size = self.imageWidget.pixmap().size()
+        pixmap_size = self.imageWidget.getDisplaySize()
+        # Report the zoom and resolution relative to the full resolution, the
+        # pixmap may have been decoded at screen resolution
+        if ((self.image_full_size is not None) and self.image_full_size.isValid()):
+            orig_pixmap_size = self.image_full_size
 
         info("pixmap size %s widget_size %s", widget_size, pixmap_size)
-        if (widget_size.width() != self.imageWidget.pixmap().width()):
+        if (widget_size.width() != pixmap_size.width()):
             zoom_factor = (pixmap_size.width() * 100) / orig_pixmap_size.width()
         else:
             zoom_factor = (pixmap_size.height() * 100) / orig_pixmap_size.height()
 
+        # Use the probed header until the image is decoded, otherwise this
+        # would show the placeholder's
+        probe = self.probed_files.peek(self.image_filepath)
+
         self.statusIndex.setText("%d / %d" % (self.image_index + 1, self.image_count))
-        self.statusResolution.setText("%d x %d x %d BPP" % (orig_pixmap.width(), orig_pixmap.height(), orig_pixmap.depth()))
+        if ((self.imageWidget.image_state != IMAGE_STATE_DECODED) and (probe is not None)):
+            self.statusResolution.setText("%d x %d %s" % (probe["size"].width(), probe["size"].height(), probe["format"].upper()))
+        else:
+            self.statusResolution.setText("%d x %d x %d BPP" % (orig_pixmap_size.width(), orig_pixmap_size.height(), orig_pixmap.depth()))
 
         self.statusZoom.setText("%d%% %s %s %d d %d/%d%s" % (
             zoom_factor,
             "S" if self.imageWidget.fitToSmallest else "L",
-            "%2.1fg" % self.imageWidget.gamma,
+            "%2.1fg%s" % (self.imageWidget.filterParams[0], " A" if (self.autoLevelsAct.isChecked()) else ""),
             self.imageWidget.rotation_degrees,
             self.animation_frame + 1,
             self.animation_count, 
@@ -2399,9 +5880,9 @@ class ImageViewer(QMainWindow):
         self.statusFilepath.setText(os_path_abspath(self.image_filepath))
 
         info("Statusing")
-        # XXX Store elsewhere instead of hitting the cache which will mess with
-        #     the LRU? Find it directly in cached_files?
-        data = self.getDataFromCache(self.image_filepath) 
+        # Peek instead of going through getDataFromCache so the LRU order and
+        # the hit/miss counters are not disturbed by the status bar
+        data = self.cached_files.peek(self.image_filepath)
         if (data):
             file_data, file_stat = data
             if (file_data is None):
@@ -2409,23 +5890,31 @@ class ImageViewer(QMainWindow):
         else:
             file_data = None
             file_stat = None
-        self.statusSize.setText("%s / %s (%d: %s)" % (
-            "?? MB" if (file_data is None) else size_to_human_friendly_units(len(file_data)), 
+        if ((file_stat is None) and (probe is not None)):
+            file_stat = probe["filestat"]
+        cached_files = self.cached_files
+        fetcher_count, fetcher_bandwidth = self.fetcher_lanes.getStats()
+        self.statusSize.setText("%s / %s (%d: %s %d/%d) %dx %s/s" % (
+            "?? MB" if (file_stat is None) else size_to_human_friendly_units(file_stat.st_size), 
             # XXX This should use image.byteCount() but there's none for QPixmap
             size_to_human_friendly_units(orig_pixmap.width() * orig_pixmap.height()*orig_pixmap.depth()),
             # XXX This accesses the queue directly, could use prefetch_pending
             #     but it's not updated frequently
             len(self.prefetch_pending),
-            size_to_human_friendly_units(
-                sum([(0 if entry_file_data is None else len(entry_file_data)) for entry_filepath, (entry_file_data, entry_file_stat) in self.cached_files]) + 
-                # XXX These getsize cause a noticeable stall, and they are not
-                #     cached yet so can't be obtained from the cache
-                # sum([os.path.getsize(entry_filepath) for entry_filepath in self.prefetch_pending])
-                0
-                )
+            # XXX The pending prefetches are not accounted since the sizes are
+            #     not known until fetched
+            size_to_human_friendly_units(cached_files.bytes),
+            cached_files.hits,
+            cached_files.hits + cached_files.misses,
+            fetcher_count,
+            size_to_human_friendly_units(int(fetcher_bandwidth))
         ))
 
-        filedate = None if file_stat is None else datetime.datetime.fromtimestamp(file_stat.st_mtime)
+        # Prefer the EXIF capture date over the modification date
+        if ((probe is not None) and (probe["datetime"] is not None)):
+            filedate = probe["datetime"]
+        else:
+            filedate = None if file_stat is None else datetime.datetime.fromtimestamp(file_stat.st_mtime)
         self.statusDate.setText("%s" % ("??-??-?? ??:??:??" if (filedate is None) else filedate.strftime("%Y-%m-%d %H:%M:%S")))
 
         info("Statused")
@@ -2444,7 +5933,25 @@ class ImageViewer(QMainWindow):
             
             # XXX What to do when a single file was loaded and it's deleted?
             self.image_filepaths = None
-            os.remove(self.image_filepath)
+            self.decoded_images.remove(self.image_filepath)
+            # Release the cache reference to the file, otherwise the file 
+            # mapping prevents deletion on Windows
+            self.uncacheFile(self.image_filepath)
+            for thumbWidget in self.thumbWidgets:
+                if (thumbWidget.image_filepath == self.image_filepath):
+                    thumbWidget.image_filepath = None
+                    thumbWidget.image_state = IMAGE_STATE_INIT
+                    thumbWidget.image_data = None
+            try:
+                os.remove(self.image_filepath)
+
+            except OSError:
+                exc("Unable to delete %r", self.image_filepath)
+                QMessageBox.information(self, "Image Viewer",
+                    "Cannot delete %s." % self.image_filepath)
+            # The directory mtime revalidation would catch the deletion, but
+            # invalidate explicitly in case of coarse mtime granularity
+            g_dir_listing_cache.invalidate(os.path.dirname(self.image_filepath))
             # Filling the file cache will reset self.image_index when
             # self.image_filepath is not found, so the delta has to be the
             # current self.image_index
@@ -2457,28 +5964,26 @@ class ImageViewer(QMainWindow):
             #     current image directory is loaded instead of reloading the
             #     .lst file, fix
             self.image_filepaths = None
-            self.cached_files = []
+            for filepath in self.cached_files.keys():
+                self.uncacheFile(filepath)
+            self.decoded_images.clear()
+            g_dir_listing_cache.invalidate(os.path.dirname(self.image_filepath))
             for thumbWidget in self.thumbWidgets:
                 thumbWidget.image_filepath = None
                 thumbWidget.image_state = IMAGE_STATE_INIT
                 thumbWidget.image_data = None
 
         else:
-            # XXX This try is not necessary unless loadimage is non-blocking 
-            #     because cached_files.index should always have the image?
-            try:
-                filepath = self.image_filepath
-                filepaths = [entry_filepath for entry_filepath, entry_data in self.cached_files]
-                i = filepaths.index(filepath)
-                self.cached_files.pop(i)
+            # Note the image may not be in the cache if it's still loading or
+            # if it has been evicted
+            filepath = self.image_filepath
+            self.decoded_images.remove(filepath)
+            if (self.uncacheFile(filepath) is not None):
                 for thumbWidget in self.thumbWidgets:
                     if (thumbWidget.image_filepath == filepath):
                         thumbWidget.image_filepath = None
                         thumbWidget.image_state = IMAGE_STATE_INIT
                         thumbWidget.image_data = None
-                        
-            except ValueError:
-                pass
 
         self.gotoImage(0)
         
@@ -2529,12 +6034,29 @@ class ImageViewer(QMainWindow):
         # XXX Allow increment/decrement or several values and cycle through them
         #     like it's done with background colors
         if (self.gammaCorrectAct.isChecked()):
-            self.imageWidget.gammaCorrectPixmap(2.2)
+            self.setFilterParams(gamma=2.2)
         else:
-            self.imageWidget.gammaCorrectPixmap(1.0)
+            self.setFilterParams(gamma=1.0)
 
+    def autoLevelsToggled(self):
+        # The levels are cached per file, so this only costs applying them
+        self.requestFilter()
+        self.imageWidget.resizePixmap(self.imageWidget.size())
         self.updateStatus()
 
+    def changeBrightness(self, delta):
+        self.setFilterParams(brightness=self.filter_params[1] + delta)
+
+    def changeContrast(self, delta):
+        self.setFilterParams(contrast=self.filter_params[2] + delta)
+
+    def resetFilters(self):
+        self.gammaCorrectAct.setChecked(False)
+        if (self.autoLevelsAct.isChecked()):
+            self.autoLevelsAct.setChecked(False)
+            self.autoLevelsToggled()
+        self.setFilterParams(*FILTER_IDENTITY[:3])
+
     def thumbnailsToggled(self):
         info("thumbnailsToggled")
         states = ((True, False), (True, True), (False, True))
@@ -2598,24 +6120,33 @@ class ImageViewer(QMainWindow):
             QApplication.setOverrideCursor(Qt.WaitCursor)
             try:
                 # XXX This could happen on another thread
-                filenames = os.listdir(image_dirname)
+                names = g_dir_listing_cache.listdir(image_dirname)
 
             except:
                 # This can fail if the host is down or if the path is invalid,
                 # in that case return empty filenames
                 warn("Error listing dir %r", image_dirname)
-                filenames = []
+                names = []
             QApplication.restoreOverrideCursor()
             info("listed %r", image_dirname)
-            
-            # XXX Right now this ignores .lst files because it would replace 
-            #     image_filepaths, fix?
-            filenames = filter(lambda s: any([s.lower().endswith(ext) for ext in image_extensions]), filenames)
-            # XXX Allow sorting by date (getting the date will be slow, will
-            #     need latency hiding)
-            filenames.sort(cmp=cmp_numerically)
-
-            filepaths = [os.path.join(image_dirname, filename) for filename in filenames]
+
+            # The listing cache returns the same names list if the directory
+            # didn't change, reuse the filtered and sorted filepaths in that
+            # case since sorting large directories is slow
+            if ((self.listed_filepaths is not None) and (self.listed_filepaths[0] is names)):
+                info("reusing sorted filepaths for %r", image_dirname)
+                filepaths = self.listed_filepaths[1]
+
+            else:
+                # XXX Right now this ignores .lst files because it would replace 
+                #     image_filepaths, fix?
+                filenames = filter(lambda s: any([s.lower().endswith(ext) for ext in image_extensions]), names)
+                # XXX Allow sorting by date (getting the date will be slow, will
+                #     need latency hiding)
+                filenames.sort(cmp=cmp_numerically)
+
+                filepaths = [os.path.join(image_dirname, filename) for filename in filenames]
+                self.listed_filepaths = (names, filepaths)
             
             self.image_filepaths = filepaths
 
@@ -2669,11 +6200,8 @@ class ImageViewer(QMainWindow):
             # of order with multiple prefetch threads, but still prioritizes
             # what is probably visible)
             
-            # XXX When navigating (eg by pgup/pgdown) to the middle of a new
-            #     thumbnail page, blindly prioritizing forward images can cause
-            #     invisibile thumbnails in the next page to be fetched before a
-            #     previous visible thumbnail in this page, should prioritize 
-            #     visible thumbnails?
+            # Images in the visible thumbnail page and in the next one are
+            # prioritized over the rest
             # XXX This should favor the browsing direction?
             # XXX Think if this is the right prefetch behavior, right now when
             #     moving up/down/left/right it's fetching and evicting images,
@@ -2683,6 +6211,8 @@ class ImageViewer(QMainWindow):
             #     are requested first and then any additional prefetches, but
             #     will still fight and evict thumbnails if one and the other are
             #     not aware of each other?
+            page_start = (i / self.thumbnails_per_page) * self.thumbnails_per_page
+            thumbnails_visible = self.thumbnailsWidget.isVisible()
             for j in xrange(self.prefetched_images_max_count):
                 delta = j
                 if (j <= self.prefetched_images_max_count / 2):
@@ -2690,13 +6220,27 @@ class ImageViewer(QMainWindow):
                 else:
                     # prefetch backwards, starting with the previous image
                     delta = (self.prefetched_images_max_count / 2) - j 
-                filepath = filepaths[(i + delta + len(filepaths)) % len(filepaths)]
-                if ((filepath not in self.prefetch_pending) and 
-                    # XXX Have a set for cached images instead of a an all() reduce
-                    all([entry_filepath != filepath for entry_filepath, entry_data in self.cached_files])):
+                index = (i + delta + len(filepaths)) % len(filepaths)
+                filepath = filepaths[index]
+
+                priority = PRIORITY_PREFETCH
+                if (thumbnails_visible):
+                    page_offset = index - page_start
+                    if (0 <= page_offset < self.thumbnails_per_page):
+                        priority = PRIORITY_VISIBLE
+                    elif (self.thumbnails_per_page <= page_offset < 2 * self.thumbnails_per_page):
+                        priority = PRIORITY_NEXT_PAGE
+
+                if (filepath in self.prefetch_pending):
+                    # Promote in case it was demoted
+                    self.fetcher_lanes.promote(filepath, priority)
+
+                elif (filepath not in self.cached_files):
                     info("ordering prefetch for %r", filepath)
-                    self.prefetch_request_queue.put(filepath)
+                    self.fetcher_lanes.put(filepath, priority)
                     self.prefetch_pending.add(filepath)
+
+            self.requestNeighbourDecodes()
                 
         if (self.slideshow_timer is not None):
             self.slideshow_timer.start(slideshow_interval_ms)
@@ -2715,12 +6259,14 @@ class ImageViewer(QMainWindow):
             self.toggleFitAct.setText("&Fit To Smallest")
 
         self.updateStatus()
+        self.checkDecodeSize()
         
     def rotateImage(self, delta_degrees):
         self.imageWidget.rotatePixmap(
             ((self.imageWidget.rotation_degrees + delta_degrees) % 360) )
 
         self.updateStatus()
+        self.checkDecodeSize()
 
     def firstImage(self):
         self.gotoImage(FIRST_IMAGE_DELTA)
@@ -2730,16 +6276,16 @@ class ImageViewer(QMainWindow):
 
 
     def getCanvasPixmapLimits(self):
-        pixmap = self.imageWidget.pixmap()
+        pixmap_size = self.imageWidget.getDisplaySize()
         size = self.imageWidget.size()
         
-        if (pixmap.width() != size.width()):
+        if (pixmap_size.width() != size.width()):
             canvas_limit = size.width()
-            pixmap_limit = pixmap.width()
+            pixmap_limit = pixmap_size.width()
 
         else:
             canvas_limit = size.height()
-            pixmap_limit = pixmap.height()
+            pixmap_limit = pixmap_size.height()
         
         return canvas_limit, pixmap_limit
 
@@ -2943,6 +6489,18 @@ class ImageViewer(QMainWindow):
 
         self.gammaCorrectAct = createGlobalAction("&Gamma Correct", enabled=False, 
             checkable=True, shortcut="G", triggered=self.gammaCorrectionToggled)
+        self.autoLevelsAct = createGlobalAction("Auto &Levels", enabled=False, 
+            checkable=True, shortcut="L", triggered=self.autoLevelsToggled)
+        self.increaseBrightnessAct = createGlobalAction("Increase Brightness", enabled=False, 
+            shortcut="]", triggered=lambda : self.changeBrightness(filter_brightness_step))
+        self.decreaseBrightnessAct = createGlobalAction("Decrease Brightness", enabled=False, 
+            shortcut="[", triggered=lambda : self.changeBrightness(-filter_brightness_step))
+        self.increaseContrastAct = createGlobalAction("Increase Contrast", enabled=False, 
+            shortcut="}", triggered=lambda : self.changeContrast(filter_contrast_step))
+        self.decreaseContrastAct = createGlobalAction("Decrease Contrast", enabled=False, 
+            shortcut="{", triggered=lambda : self.changeContrast(-filter_contrast_step))
+        self.resetFiltersAct = createGlobalAction("Reset Filters", enabled=False, 
+            shortcut="Shift+G", triggered=self.resetFilters)
 
         self.fullscreenAct = createGlobalAction("&Fullscreen", enabled=False,
             checkable=True, shortcut="return", triggered=self.fullscreenToggled)
@@ -3010,6 +6568,12 @@ class ImageViewer(QMainWindow):
         self.viewMenu.addAction(self.rotateRightAct)
         self.viewMenu.addSeparator()
         self.viewMenu.addAction(self.gammaCorrectAct)
+        self.viewMenu.addAction(self.autoLevelsAct)
+        self.viewMenu.addAction(self.increaseBrightnessAct)
+        self.viewMenu.addAction(self.decreaseBrightnessAct)
+        self.viewMenu.addAction(self.increaseContrastAct)
+        self.viewMenu.addAction(self.decreaseContrastAct)
+        self.viewMenu.addAction(self.resetFiltersAct)
         self.viewMenu.addSeparator()
         self.viewMenu.addAction(self.prevBackgroundColorAct)
         self.viewMenu.addAction(self.nextBackgroundColorAct)
@@ -3082,6 +6646,12 @@ class ImageViewer(QMainWindow):
         self.rotateLeftAct.setEnabled(True)
         self.rotateRightAct.setEnabled(True)
         self.gammaCorrectAct.setEnabled(True)
+        self.autoLevelsAct.setEnabled(True)
+        self.increaseBrightnessAct.setEnabled(True)
+        self.decreaseBrightnessAct.setEnabled(True)
+        self.increaseContrastAct.setEnabled(True)
+        self.decreaseContrastAct.setEnabled(True)
+        self.resetFiltersAct.setEnabled(True)
         self.firstImageAct.setEnabled(True)
         self.lastImageAct.setEnabled(True)
         self.prevImageAct.setEnabled(True)
@@ -3118,6 +6688,7 @@ class ImageViewer(QMainWindow):
         # This changes the zoom level, update
         if (self.imageWidget.originalPixmap is not None):
             self.updateStatus()
+            self.checkDecodeSize()
         
         return super(ImageViewer, self).resizeEvent(event)
 
@@ -3196,7 +6767,7 @@ def verify_pyqt5_installation():
 def report_versions():
     info("Python version: %s", sys.version)
 
-    # Numpy is only needed to apply gamma correction
+    # Numpy is only needed to apply image filters
     np_version = "Not installed"
     try:
         import numpy as np
@@ -3251,6 +6822,11 @@ if (__name__ == '__main__'):
     report_versions()
     
     verify_pyqt5_installation()
+
+    if (use_process_decode):
+        # Create the processes before any thread or the QApplication, since
+        # forking those is not safe
+        g_decoder_pool = multiprocessing.Pool(decoder_process_count)
     
     app = QApplication(sys.argv)
     imageViewer = ImageViewer()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python2
+"""
+Tests for imageviewer.py, run with python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+try:
+    import imageviewer
+except ImportError:
+    # PyQt5 not installed
+    imageviewer = None
+
+
+class FakePipelineStates(object):
+    def __init__(self):
+        self.states = {}
+
+    def set(self, filepath, state):
+        self.states[filepath] = state
+
+
+class FakeViewer(object):
+    """
+    The ImageViewer state used by demoteDecodes
+    """
+    def __init__(self):
+        self.decoder_request_queue = imageviewer.PriorityScheduler()
+        self.pipeline_states = FakePipelineStates()
+        self.decoded_pending = set()
+        self.imageWidget = object()
+
+
+@unittest.skipIf(imageviewer is None, "imageviewer dependencies not installed")
+class DemoteDecodesTest(unittest.TestCase):
+    def test_demote_twice_with_queued_tiles(self):
+        viewer = FakeViewer()
+        demoteDecodes = imageviewer.ImageViewer.demoteDecodes.__func__
+
+        def request_tile(tile, priority):
+            tile.queued = True
+            key = (tile.tiledImage.filepath, tile)
+            viewer.decoder_request_queue.put(
+                (tile.tiledImage.filepath, (None, tile, None, None)), priority, key)
+
+        tiles = imageviewer.LRUCache(16)
+        tiledImage = imageviewer.TiledImage("big.tif", None, imageviewer.QSize(2048, 2048), 
+            tiles, request_tile, None)
+        for col in xrange(2):
+            tiledImage.requestTile(1, col, 0, imageviewer.PRIORITY_MAIN)
+        queued_tiles = tiledImage.pending.values()
+
+        # The first demote lowers the tiles to stale, the second cancels them
+        demoteDecodes(viewer)
+        self.assertEqual(len(tiledImage.pending), 2)
+        demoteDecodes(viewer)
+
+        self.assertEqual(tiledImage.pending, {})
+        self.assertFalse(any(tile.queued for tile in queued_tiles))
+        # Tiles don't change the pipeline state of the file
+        self.assertEqual(viewer.pipeline_states.states, {})
+
+        # Cancelled tiles are requested again when needed
+        tiledImage.requestTile(1, 0, 0, imageviewer.PRIORITY_MAIN)
+        self.assertEqual(len(tiledImage.pending), 1)
+        self.assertEqual(viewer.decoder_request_queue.get()[1][1].col, 0)
+
+
+if (__name__ == '__main__'):
+    unittest.main()